@@ -5,7 +5,7 @@ author: Fu-Jie
 author_url: https://github.com/Fu-Jie
 funding_url: https://github.com/Fu-Jie/awesome-openwebui
 description: Reduces token consumption in long conversations while maintaining coherence through intelligent summarization and message compression.
-version: 1.1.0
+version: 1.2.0
 license: MIT
 
 ═══════════════════════════════════════════════════════════════════════════════
@@ -134,6 +134,34 @@ summary_temperature
   Default: 0.3
   Description: Controls the randomness of the summary generation. Lower values produce more deterministic output.
 
+summary_cache_ttl
+  Default: 300
+  Description: Seconds a cached summary record is used without checking the database. Summaries saved by this process update the cache directly; after the TTL, the cached record is revalidated against the stored `updated_at`, which picks up summaries written by other workers.
+
+max_concurrent_summaries
+  Default: 2
+  Description: Maximum number of summaries generated at the same time across all chats. Each chat runs at most one summary at a time; if it crosses the threshold again while one is waiting, only the latest state is summarized.
+
+max_queued_summaries
+  Default: 50
+  Description: Maximum number of chats waiting for a summary. Further requests are dropped until the queue drains. Set to 0 for no limit.
+
+map_reduce_summary
+  Default: false
+  Description: When the content to summarize exceeds `map_reduce_chunk_tokens`, the middle of the conversation is split into Token-bounded chunks that are summarized concurrently, and the partial summaries are merged in a final pass. Nothing is dropped, and each call stays well below the context limit. When disabled, the oldest middle messages are dropped until the content fits `max_context_tokens`.
+
+map_reduce_chunk_tokens
+  Default: 32000
+  Description: Maximum Tokens of conversation text per chunk in map-reduce mode. Capped at the summary model's `max_context_tokens`.
+
+map_reduce_parallelism
+  Default: 4
+  Description: Maximum number of chunk summaries generated at the same time for one conversation.
+
+rolling_summary
+  Default: false
+  Description: When enabled, each update feeds the previous summary together with only the messages added since the last compression, so the cost of an update stays roughly constant as the chat grows. When disabled, the whole middle of the conversation is re-summarized each time.
+
 debug_mode
   Default: true
   Description: Prints detailed debug information to the log. Recommended to set to `false` in production.
@@ -239,11 +267,13 @@ Solution:
 """
 
 from pydantic import BaseModel, Field, model_validator
-from typing import Optional, Dict, Any, List, Union, Callable, Awaitable
+from typing import Optional, Dict, Any, List, Tuple, Union, Callable, Awaitable
 import asyncio
 import json
 import hashlib
+import threading
 import time
+from collections import OrderedDict, deque
 
 # Open WebUI built-in imports
 from open_webui.utils.chat import generate_chat_completion
@@ -264,8 +294,30 @@ except ImportError:
 
 # Database imports
 from sqlalchemy import Column, String, Text, DateTime, Integer, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
 
+# Encoding used for all token counts (adapted for latest models)
+TOKEN_ENCODING_NAME = "o200k_base"
+# Maximum number of per-message token counts kept in memory
+TOKEN_COUNT_CACHE_SIZE = 50000
+# Maximum number of chat summary records kept in memory
+SUMMARY_CACHE_SIZE = 1000
+
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+
+def _get_token_encoding():
+    """Returns the process-wide tiktoken encoding, loading it on first use."""
+    global _token_encoding
+    if _token_encoding is None:
+        with _token_encoding_lock:
+            if _token_encoding is None:
+                _token_encoding = tiktoken.get_encoding(TOKEN_ENCODING_NAME)
+    return _token_encoding
+
 
 class ChatSummary(owui_Base):
     """Chat Summary Storage Table"""
@@ -287,6 +339,24 @@ class Filter:
         self._db_engine = owui_engine
         self._SessionLocal = owui_Session
         self.temp_state = {}  # Used to pass temporary data between inlet and outlet
+        # Per-message token counts, keyed by (message id, content hash)
+        self._token_count_cache: "OrderedDict[tuple, int]" = OrderedDict()
+        self._token_count_lock = threading.Lock()
+        self._token_cache_misses = 0
+        # Write-through cache of summary records: chat_id -> (record or None, time of last check)
+        self._summary_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._summary_cache_lock = threading.Lock()
+        # Summary worker pool: at most one worker per chat, with a global concurrency limit
+        self._summary_workers: Dict[str, asyncio.Task] = {}  # Strong references to worker tasks
+        self._pending_summaries: Dict[str, tuple] = {}  # Latest queued job per chat
+        self._summary_slot_waiters: "deque[asyncio.Future]" = deque()  # Workers waiting for a free slot
+        self._running_summaries = 0
+        self._summary_stats = {
+            "scheduled": 0,
+            "superseded": 0,
+            "dropped": 0,
+            "completed": 0,
+        }
         self._init_database()
 
     def _init_database(self):
@@ -351,59 +421,191 @@ class Filter:
             le=2.0,
             description="The temperature for summary generation.",
         )
+        summary_cache_ttl: int = Field(
+            default=300,
+            ge=0,
+            description="Seconds a cached summary is used without checking the database. After that, it is revalidated against the stored updated_at. Set to 0 to always check.",
+        )
+        max_concurrent_summaries: int = Field(
+            default=2,
+            ge=1,
+            description="Maximum number of summaries generated at the same time across all chats.",
+        )
+        max_queued_summaries: int = Field(
+            default=50,
+            ge=0,
+            description="Maximum number of chats waiting for a summary. Further requests are dropped until the queue drains. Set to 0 for no limit.",
+        )
+        map_reduce_summary: bool = Field(
+            default=False,
+            description="When the content to summarize exceeds map_reduce_chunk_tokens, summarize it in chunks concurrently and merge the partial summaries, instead of dropping the oldest messages.",
+        )
+        map_reduce_chunk_tokens: int = Field(
+            default=32000,
+            ge=1000,
+            description="Maximum Tokens of conversation text per chunk in map-reduce mode. Capped at the summary model's max_context_tokens.",
+        )
+        map_reduce_parallelism: int = Field(
+            default=4,
+            ge=1,
+            description="Maximum number of chunk summaries generated at the same time for one conversation in map-reduce mode.",
+        )
+        rolling_summary: bool = Field(
+            default=False,
+            description="Extend the previous summary with only the messages added since the last compression, instead of re-summarizing the whole history each time.",
+        )
         debug_mode: bool = Field(
             default=True, description="Enable detailed logging for debugging."
         )
 
     def _save_summary(self, chat_id: str, summary: str, compressed_count: int):
-        """Saves the summary to the database."""
+        """Saves the summary to the database with a single atomic upsert and updates the cache."""
+        now = datetime.utcnow()
         try:
             with self._SessionLocal() as session:
-                # Find existing record
-                existing = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
-
-                if existing:
-                    # [Optimization] Optimistic lock check: update only if progress moves forward
-                    if compressed_count <= existing.compressed_message_count:
-                        if self.valves.debug_mode:
-                            print(
-                                f"[Storage] Skipping update: New progress ({compressed_count}) is not greater than existing progress ({existing.compressed_message_count})"
-                            )
-                        return
-
-                    # Update existing record
-                    existing.summary = summary
-                    existing.compressed_message_count = compressed_count
-                    existing.updated_at = datetime.utcnow()
-                else:
-                    # Create new record
-                    new_summary = ChatSummary(
+                dialect = self._db_engine.dialect.name
+                if dialect in ("postgresql", "sqlite"):
+                    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+                    stmt = insert(ChatSummary).values(
                         chat_id=chat_id,
                         summary=summary,
                         compressed_message_count=compressed_count,
+                        created_at=now,
+                        updated_at=now,
+                    )
+                    # [Optimization] Optimistic lock check: update only if progress moves forward
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[ChatSummary.chat_id],
+                        set_={
+                            "summary": stmt.excluded.summary,
+                            "compressed_message_count": stmt.excluded.compressed_message_count,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                        where=ChatSummary.compressed_message_count
+                        < stmt.excluded.compressed_message_count,
+                    )
+                    saved = session.execute(stmt).rowcount > 0
+                else:
+                    saved = self._save_summary_with_select(
+                        session, chat_id, summary, compressed_count, now
                     )
-                    session.add(new_summary)
-
                 session.commit()
 
+            if not saved:
+                # The database holds newer progress than this process knows about
+                self._invalidate_summary_cache(chat_id)
                 if self.valves.debug_mode:
-                    action = "Updated" if existing else "Created"
                     print(
-                        f"[Storage] Summary has been {action.lower()} in the database (Chat ID: {chat_id})"
+                        f"[Storage] Skipping update: New progress ({compressed_count}) is not greater than existing progress"
                     )
+                return
+
+            self._cache_summary_record(
+                chat_id,
+                ChatSummary(
+                    chat_id=chat_id,
+                    summary=summary,
+                    compressed_message_count=compressed_count,
+                    updated_at=now,
+                ),
+            )
+            if self.valves.debug_mode:
+                print(
+                    f"[Storage] Summary has been saved in the database (Chat ID: {chat_id})"
+                )
 
         except Exception as e:
+            self._invalidate_summary_cache(chat_id)
             print(f"[Storage] ❌ Database save failed: {str(e)}")
 
+    def _save_summary_with_select(
+        self,
+        session,
+        chat_id: str,
+        summary: str,
+        compressed_count: int,
+        now: datetime,
+    ) -> bool:
+        """Saves the summary with a select followed by an update or insert, for databases without upsert support."""
+        # Find existing record
+        existing = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
+
+        if existing:
+            # [Optimization] Optimistic lock check: update only if progress moves forward
+            if compressed_count <= existing.compressed_message_count:
+                return False
+
+            # Update existing record
+            existing.summary = summary
+            existing.compressed_message_count = compressed_count
+            existing.updated_at = now
+        else:
+            # Create new record
+            session.add(
+                ChatSummary(
+                    chat_id=chat_id,
+                    summary=summary,
+                    compressed_message_count=compressed_count,
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+        return True
+
+    def _get_cached_summary_record(
+        self, chat_id: str
+    ) -> Tuple[bool, Optional[ChatSummary]]:
+        """Returns (True, record) if the chat's summary record is cached and fresh, without touching the database."""
+        with self._summary_cache_lock:
+            entry = self._summary_cache.get(chat_id)
+            if entry is None:
+                return False, None
+            record, checked_at = entry
+            if time.monotonic() - checked_at > self.valves.summary_cache_ttl:
+                return False, None
+            self._summary_cache.move_to_end(chat_id)
+            return True, record
+
+    def _cache_summary_record(self, chat_id: str, record: Optional[ChatSummary]):
+        with self._summary_cache_lock:
+            self._summary_cache[chat_id] = (record, time.monotonic())
+            self._summary_cache.move_to_end(chat_id)
+            if len(self._summary_cache) > SUMMARY_CACHE_SIZE:
+                self._summary_cache.popitem(last=False)
+
+    def _invalidate_summary_cache(self, chat_id: str):
+        with self._summary_cache_lock:
+            self._summary_cache.pop(chat_id, None)
+
     def _load_summary_record(self, chat_id: str) -> Optional[ChatSummary]:
-        """Loads the summary record object from the database."""
+        """Loads the summary record object, from the cache when it is fresh, otherwise from the database.
+
+        A stale cached record is revalidated by reading only `updated_at`, and is reused if it has not changed.
+        """
+        hit, record = self._get_cached_summary_record(chat_id)
+        if hit:
+            return record
+
+        with self._summary_cache_lock:
+            cached_record = self._summary_cache.get(chat_id, (None, 0))[0]
         try:
             with self._SessionLocal() as session:
+                if cached_record is not None:
+                    updated_at = (
+                        session.query(ChatSummary.updated_at)
+                        .filter_by(chat_id=chat_id)
+                        .scalar()
+                    )
+                    if updated_at == cached_record.updated_at:
+                        self._cache_summary_record(chat_id, cached_record)
+                        return cached_record
+
                 record = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
                 if record:
                     # Detach the object from the session so it can be used after session close
                     session.expunge(record)
-                    return record
+                self._cache_summary_record(chat_id, record)
+                return record
         except Exception as e:
             print(f"[Load] ❌ Database read failed: {str(e)}")
         return None
@@ -427,8 +629,8 @@ class Filter:
 
         if tiktoken:
             try:
-                # Uniformly use o200k_base encoding (adapted for latest models)
-                encoding = tiktoken.get_encoding("o200k_base")
+                # The encoding is loaded once per process and reused
+                encoding = _get_token_encoding()
                 return len(encoding.encode(text))
             except Exception as e:
                 if self.valves.debug_mode:
@@ -439,20 +641,48 @@ class Filter:
         # Fallback strategy: Rough estimation (1 token ≈ 4 chars)
         return len(text) // 4
 
+    def _get_message_text(self, msg: dict) -> str:
+        """Returns the text content of a message (text parts only for multimodal content)."""
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            return "".join(
+                part.get("text", "")
+                for part in content
+                if isinstance(part, dict) and part.get("type") == "text"
+            )
+        return str(content)
+
+    def _count_message_tokens(self, msg: dict) -> int:
+        """Counts the tokens of a message.
+
+        Counts are memoized by message ID plus a hash of the text, so recounting a conversation
+        only tokenizes messages that are new or were edited.
+        """
+        text = self._get_message_text(msg)
+        key = (msg.get("id") or "", hashlib.sha1(text.encode("utf-8")).hexdigest())
+        with self._token_count_lock:
+            tokens = self._token_count_cache.get(key)
+            if tokens is not None:
+                self._token_count_cache.move_to_end(key)
+                return tokens
+
+        tokens = self._count_tokens(text)
+        with self._token_count_lock:
+            self._token_cache_misses += 1
+            self._token_count_cache[key] = tokens
+            if len(self._token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+                self._token_count_cache.popitem(last=False)
+        return tokens
+
     def _calculate_messages_tokens(self, messages: List[Dict]) -> int:
         """Calculates the total tokens for a list of messages."""
-        total_tokens = 0
-        for msg in messages:
-            content = msg.get("content", "")
-            if isinstance(content, list):
-                # Handle multimodal content
-                text_content = ""
-                for part in content:
-                    if isinstance(part, dict) and part.get("type") == "text":
-                        text_content += part.get("text", "")
-                total_tokens += self._count_tokens(text_content)
-            else:
-                total_tokens += self._count_tokens(str(content))
+        misses_before = self._token_cache_misses
+        total_tokens = sum(self._count_message_tokens(msg) for msg in messages)
+        if self.valves.debug_mode:
+            tokenized = self._token_cache_misses - misses_before
+            print(
+                f"[Token Count] Tokenized {tokenized} of {len(messages)} messages, the rest were cached"
+            )
         return total_tokens
 
     def _get_model_thresholds(self, model_id: str) -> Dict[str, int]:
@@ -552,8 +782,10 @@ class Filter:
                 f"[Inlet] Recorded target compression progress: {target_compressed_count}"
             )
 
-        # Load summary record
-        summary_record = await asyncio.to_thread(self._load_summary_record, chat_id)
+        # Load summary record (a fresh cached record skips the thread hop and the database)
+        cache_hit, summary_record = self._get_cached_summary_record(chat_id)
+        if not cache_hit:
+            summary_record = await asyncio.to_thread(self._load_summary_record, chat_id)
 
         final_messages = []
 
@@ -635,18 +867,116 @@ class Filter:
             print(f"[Outlet] Response complete")
 
         # Process Token calculation and summary generation asynchronously in the background (do not wait for completion, do not affect output)
-        asyncio.create_task(
-            self._check_and_generate_summary_async(
-                chat_id, model, body, __user__, __event_emitter__
-            )
+        # The target progress is taken now, because the job may only run after the next inlet has overwritten it
+        target_compressed_count = self.temp_state.pop(chat_id, None)
+        self._schedule_summary(
+            chat_id,
+            (
+                chat_id,
+                model,
+                body,
+                __user__,
+                __event_emitter__,
+                target_compressed_count,
+            ),
         )
 
         if self.valves.debug_mode:
-            print(f"[Outlet] Background processing started")
+            print(
+                f"[Outlet] Background processing queued ({self._summary_queue_stats()})"
+            )
             print(f"{'='*60}\n")
 
         return body
 
+    async def _acquire_summary_slot(self):
+        """
+        Waits until fewer than max_concurrent_summaries summaries are running, then takes a slot.
+        The limit is read on every check, so a changed valve applies in place without
+        letting more summaries run than the current limit allows.
+        """
+        while self._running_summaries >= self.valves.max_concurrent_summaries:
+            waiter = asyncio.get_running_loop().create_future()
+            self._summary_slot_waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken right before cancellation, so pass the free slot on
+                    self._wake_summary_waiters()
+                raise
+        self._running_summaries += 1
+
+    def _release_summary_slot(self):
+        """Frees a slot and wakes as many waiting workers as there are free slots."""
+        self._running_summaries -= 1
+        self._wake_summary_waiters()
+
+    def _wake_summary_waiters(self):
+        free_slots = self.valves.max_concurrent_summaries - self._running_summaries
+        while free_slots > 0 and self._summary_slot_waiters:
+            waiter = self._summary_slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def _summary_queue_stats(self) -> str:
+        """Formats the queue depth and counters of the summary worker pool for logging."""
+        counters = ", ".join(f"{k}: {v}" for k, v in self._summary_stats.items())
+        return (
+            f"queued: {len(self._pending_summaries)}, "
+            f"running: {self._running_summaries}, {counters}"
+        )
+
+    def _schedule_summary(self, chat_id: str, job: tuple):
+        """
+        Queues a summary check for a chat.
+        If the chat already has a job waiting, it is replaced, so the latest state wins.
+        Only one worker runs per chat, and workers share a global concurrency limit.
+        """
+        if chat_id in self._pending_summaries:
+            self._summary_stats["superseded"] += 1
+        elif (
+            self.valves.max_queued_summaries
+            and len(self._pending_summaries) >= self.valves.max_queued_summaries
+        ):
+            self._summary_stats["dropped"] += 1
+            print(
+                f"[Summary Queue] ⚠️ Queue is full, dropping summary request (Chat ID: {chat_id}, {self._summary_queue_stats()})"
+            )
+            return
+
+        self._pending_summaries[chat_id] = job
+        self._summary_stats["scheduled"] += 1
+        if chat_id not in self._summary_workers:
+            self._summary_workers[chat_id] = asyncio.create_task(
+                self._run_summary_worker(chat_id)
+            )
+
+    async def _run_summary_worker(self, chat_id: str):
+        """Runs the queued jobs of a chat one at a time until none are left."""
+        try:
+            while chat_id in self._pending_summaries:
+                await self._acquire_summary_slot()
+                try:
+                    # Take the job only once a slot is free, so a newer job that replaced it is used
+                    job = self._pending_summaries.pop(chat_id, None)
+                    if job is None:
+                        continue
+                    try:
+                        await self._check_and_generate_summary_async(*job)
+                    finally:
+                        self._summary_stats["completed"] += 1
+                finally:
+                    self._release_summary_slot()
+                if self.valves.debug_mode:
+                    print(
+                        f"[Summary Queue] Finished job (Chat ID: {chat_id}, {self._summary_queue_stats()})"
+                    )
+        finally:
+            # No await between the loop check and this, so a new job can't slip in unnoticed
+            self._summary_workers.pop(chat_id, None)
+
     async def _check_and_generate_summary_async(
         self,
         chat_id: str,
@@ -654,6 +984,7 @@ class Filter:
         body: dict,
         user_data: Optional[dict],
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        target_compressed_count: Optional[int] = None,
     ):
         """
         Background processing: Calculates Token count and generates summary (does not block response).
@@ -687,7 +1018,12 @@ class Filter:
 
                 # Proceed to generate summary
                 await self._generate_summary_async(
-                    messages, chat_id, body, user_data, __event_emitter__
+                    messages,
+                    chat_id,
+                    body,
+                    user_data,
+                    __event_emitter__,
+                    target_compressed_count,
                 )
             else:
                 if self.valves.debug_mode:
@@ -705,12 +1041,15 @@ class Filter:
         body: dict,
         user_data: Optional[dict],
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        target_compressed_count: Optional[int] = None,
     ):
         """
         Generates summary asynchronously (runs in background, does not block response).
         Logic:
         1. Extract middle messages (remove keep_first and keep_last).
+           In rolling mode, only the messages added since the last compression are taken, and the previous summary is extended.
         2. Check Token limit, if exceeding max_context_tokens, remove from the head of middle messages.
+           In map-reduce mode, content over map_reduce_chunk_tokens is summarized in chunks instead, so nothing is removed.
         3. Generate summary for the remaining middle messages.
         """
         try:
@@ -718,8 +1057,7 @@ class Filter:
                 print(f"\n[🤖 Async Summary Task] Starting...")
 
             # 1. Get target compression progress
-            # Prioritize getting from temp_state (calculated by inlet). If unavailable (e.g., after restart), assume current is full history.
-            target_compressed_count = self.temp_state.pop(chat_id, None)
+            # Prioritize the one taken from temp_state by outlet (calculated by inlet). If unavailable (e.g., after restart), assume current is full history.
             if target_compressed_count is None:
                 target_compressed_count = max(0, len(messages) - self.valves.keep_last)
                 if self.valves.debug_mode:
@@ -732,6 +1070,10 @@ class Filter:
             end_index = len(messages) - self.valves.keep_last
             if self.valves.keep_last == 0:
                 end_index = len(messages)
+            # [Rolling summary] The saved progress is target_compressed_count, so summarize exactly up to it.
+            # Otherwise the last message before it would be merged again in the next round.
+            if self.valves.rolling_summary:
+                end_index = min(end_index, target_compressed_count)
 
             # Ensure indices are valid
             if start_index >= end_index:
@@ -743,6 +1085,33 @@ class Filter:
 
             middle_messages = messages[start_index:end_index]
 
+            # [Rolling summary] Extend the previous summary with the messages added since the last compression
+            previous_summary = None
+            if self.valves.rolling_summary:
+                summary_record = await asyncio.to_thread(
+                    self._load_summary_record, chat_id
+                )
+                # A progress beyond the current history means the chat was edited, so start over
+                if (
+                    summary_record
+                    and summary_record.compressed_message_count <= len(messages)
+                ):
+                    compressed_count = max(
+                        summary_record.compressed_message_count, start_index
+                    )
+                    if compressed_count >= end_index:
+                        if self.valves.debug_mode:
+                            print(
+                                f"[🤖 Async Summary Task] No new messages since the last compression ({compressed_count}), skipping"
+                            )
+                        return
+                    previous_summary = summary_record.summary
+                    middle_messages = messages[compressed_count:end_index]
+                    if self.valves.debug_mode:
+                        print(
+                            f"[🤖 Async Summary Task] Rolling summary: extending the previous summary from message {compressed_count}"
+                        )
+
             if self.valves.debug_mode:
                 print(
                     f"[🤖 Async Summary Task] Middle messages to process: {len(middle_messages)}"
@@ -767,11 +1136,30 @@ class Filter:
                 )
 
             # Calculate current total Tokens (using summary model for counting)
+            # In rolling mode, only the previous summary and the new messages are sent
             total_tokens = await asyncio.to_thread(
-                self._calculate_messages_tokens, messages
+                self._calculate_messages_tokens,
+                middle_messages if previous_summary is not None else messages,
+            )
+            if previous_summary is not None:
+                total_tokens += await asyncio.to_thread(
+                    self._count_tokens, previous_summary
+                )
+
+            # [Map-Reduce] Summarize long content in chunks instead of dropping messages from the head
+            max_chunk_tokens = min(
+                self.valves.map_reduce_chunk_tokens, max_context_tokens
+            )
+            use_map_reduce = (
+                self.valves.map_reduce_summary and total_tokens > max_chunk_tokens
             )
 
-            if total_tokens > max_context_tokens:
+            if use_map_reduce:
+                if self.valves.debug_mode:
+                    print(
+                        f"[🤖 Async Summary Task] Total Tokens ({total_tokens}) exceed the chunk size ({max_chunk_tokens}), using map-reduce summarization"
+                    )
+            elif total_tokens > max_context_tokens:
                 excess_tokens = total_tokens - max_context_tokens
                 if self.valves.debug_mode:
                     print(
@@ -784,7 +1172,7 @@ class Filter:
 
                 while removed_tokens < excess_tokens and middle_messages:
                     msg_to_remove = middle_messages.pop(0)
-                    msg_tokens = self._count_tokens(str(msg_to_remove.get("content", "")))
+                    msg_tokens = self._count_message_tokens(msg_to_remove)
                     removed_tokens += msg_tokens
                     removed_count += 1
 
@@ -800,11 +1188,13 @@ class Filter:
                     )
                 return
 
-            # 4. Build conversation text
-            conversation_text = self._format_messages_for_summary(middle_messages)
+            # 4. Build conversation text (in map-reduce mode, each chunk is formatted separately)
+            conversation_text = ""
+            if not use_map_reduce:
+                conversation_text = self._format_messages_for_summary(middle_messages)
 
             # 5. Call LLM to generate new summary
-            # Note: previous_summary is not passed here because old summary (if any) is already included in middle_messages
+            # Note: previous_summary is only passed in rolling mode, otherwise the whole middle is summarized from scratch
 
             # Send status notification for starting summary generation
             if __event_emitter__:
@@ -818,9 +1208,18 @@ class Filter:
                     }
                 )
 
-            new_summary = await self._call_summary_llm(
-                None, conversation_text, body, user_data
-            )
+            if use_map_reduce:
+                new_summary = await self._map_reduce_summary(
+                    previous_summary,
+                    middle_messages,
+                    body,
+                    user_data,
+                    max_chunk_tokens,
+                )
+            else:
+                new_summary = await self._call_summary_llm(
+                    previous_summary, conversation_text, body, user_data
+                )
 
             # 6. Save new summary
             if self.valves.debug_mode:
@@ -858,10 +1257,10 @@ class Filter:
 
             traceback.print_exc()
 
-    def _format_messages_for_summary(self, messages: list) -> str:
-        """Formats messages for summarization."""
+    def _format_messages_for_summary(self, messages: list, start: int = 1) -> str:
+        """Formats messages for summarization, numbering them from `start`."""
         formatted = []
-        for i, msg in enumerate(messages, 1):
+        for i, msg in enumerate(messages, start):
             role = msg.get("role", "unknown")
             content = msg.get("content", "")
 
@@ -884,6 +1283,111 @@ class Filter:
 
         return "\n\n".join(formatted)
 
+    def _split_messages_into_chunks(
+        self, messages: list, max_chunk_tokens: int
+    ) -> List[Tuple[int, list]]:
+        """
+        Splits messages into consecutive chunks whose formatted text fits within max_chunk_tokens.
+        Returns (index of the first message, messages) per chunk. A message larger than the limit gets a chunk of its own.
+        """
+        chunks = []
+        current, current_tokens, current_start = [], 0, 0
+        for i, msg in enumerate(messages):
+            msg_tokens = self._count_tokens(self._format_messages_for_summary([msg]))
+            if current and current_tokens + msg_tokens > max_chunk_tokens:
+                chunks.append((current_start, current))
+                current, current_tokens, current_start = [], 0, i
+            current.append(msg)
+            current_tokens += msg_tokens
+        if current:
+            chunks.append((current_start, current))
+        return chunks
+
+    def _group_summaries(
+        self, summaries: List[str], max_chunk_tokens: int
+    ) -> List[List[str]]:
+        """Groups consecutive partial summaries so that each group fits within max_chunk_tokens."""
+        groups = []
+        current, current_tokens = [], 0
+        for summary in summaries:
+            summary_tokens = self._count_tokens(summary)
+            if current and current_tokens + summary_tokens > max_chunk_tokens:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += summary_tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def _format_partial_summaries(self, summaries: List[str]) -> str:
+        """Formats partial summaries of consecutive parts of the conversation for merging."""
+        return "\n\n".join(
+            f"[Summary of conversation part {i} of {len(summaries)}]\n{summary}"
+            for i, summary in enumerate(summaries, 1)
+        )
+
+    async def _map_reduce_summary(
+        self,
+        previous_summary: Optional[str],
+        messages: list,
+        body: dict,
+        user_data: Optional[dict],
+        max_chunk_tokens: int,
+    ) -> str:
+        """
+        Summarizes messages that don't fit in one call.
+        Map: the messages are split into Token-bounded chunks that are summarized concurrently (up to map_reduce_parallelism at a time).
+        Reduce: the partial summaries (and the previous summary, in rolling mode) are merged in a final call.
+        If the partial summaries are too long to merge at once, they are merged in groups first.
+        """
+        semaphore = asyncio.Semaphore(self.valves.map_reduce_parallelism)
+
+        async def summarize(text: str) -> str:
+            async with semaphore:
+                return await self._call_summary_llm(None, text, body, user_data)
+
+        chunks = await asyncio.to_thread(
+            self._split_messages_into_chunks, messages, max_chunk_tokens
+        )
+        if self.valves.debug_mode:
+            print(
+                f"[🤖 Map-Reduce] Summarizing {len(messages)} messages in {len(chunks)} chunks"
+            )
+
+        partial_summaries = await asyncio.gather(
+            *(
+                summarize(self._format_messages_for_summary(chunk, start + 1))
+                for start, chunk in chunks
+            )
+        )
+
+        while len(partial_summaries) > 1:
+            groups = self._group_summaries(partial_summaries, max_chunk_tokens)
+            if len(groups) == 1 or len(groups) == len(partial_summaries):
+                break
+            if self.valves.debug_mode:
+                print(
+                    f"[🤖 Map-Reduce] Merging {len(partial_summaries)} partial summaries in {len(groups)} groups"
+                )
+            partial_summaries = await asyncio.gather(
+                *(summarize(self._format_partial_summaries(group)) for group in groups)
+            )
+
+        if len(partial_summaries) == 1 and previous_summary is None:
+            return partial_summaries[0]
+
+        if self.valves.debug_mode:
+            print(
+                f"[🤖 Map-Reduce] Merging {len(partial_summaries)} partial summaries into the final summary"
+            )
+        return await self._call_summary_llm(
+            previous_summary,
+            self._format_partial_summaries(partial_summaries),
+            body,
+            user_data,
+        )
+
     async def _call_summary_llm(
         self,
         previous_summary: Optional[str],
@@ -897,6 +1401,16 @@ class Filter:
         if self.valves.debug_mode:
             print(f"[🤖 LLM Call] Using Open WebUI's built-in method")
 
+        # In rolling mode, the new conversation content is merged into the previous summary
+        previous_summary_block = ""
+        if previous_summary:
+            previous_summary_block = f"""
+### Previous Summary
+The conversation below continues from this existing summary. Merge the new content into it and output a single updated summary covering both. Keep the information from the previous summary unless the new content supersedes it.
+
+{previous_summary}
+"""
+
         # Build summary prompt (Optimized)
         summary_prompt = f"""
 You are a professional conversation context compression expert. Your task is to create a high-fidelity summary of the following conversation content.
@@ -924,7 +1438,7 @@ This conversation may contain previous summaries (as system messages or text) an
     *   **Code/Technical Details** (Wrap in code blocks).
 *   **Progress & Conclusions**: Completed steps and reached consensus.
 *   **Action Items/Next Steps**: Clear follow-up actions.
-
+{previous_summary_block}
 ---
 {new_conversation_text}
 ---
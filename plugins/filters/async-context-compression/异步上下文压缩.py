@@ -5,7 +5,7 @@ author: Fu-Jie
 author_url: https://github.com/Fu-Jie
 funding_url: https://github.com/Fu-Jie/awesome-openwebui
 description: 通过智能摘要和消息压缩，降低长对话的 token 消耗，同时保持对话连贯性。
-version: 1.1.0
+version: 1.2.0
 license: MIT
 
 ═══════════════════════════════════════════════════════════════════════════════
@@ -133,6 +133,34 @@ summary_temperature (摘要温度)
   默认: 0.3
   说明: 控制摘要生成的随机性，较低的值会产生更确定性的输出。
 
+summary_cache_ttl (摘要缓存有效期)
+  默认: 300
+  说明: 缓存的摘要记录在不查询数据库的情况下可直接使用的秒数。本进程保存的摘要会直接更新缓存；超时后会根据数据库中的 `updated_at` 重新校验缓存，从而获取其他 worker 写入的摘要。
+
+max_concurrent_summaries (最大并发摘要数)
+  默认: 2
+  说明: 所有对话中同时生成摘要的最大数量。每个对话同一时间最多生成一个摘要；如果在等待期间再次达到阈值，只会对最新状态生成摘要。
+
+max_queued_summaries (最大排队摘要数)
+  默认: 50
+  说明: 等待生成摘要的最大对话数，超出后新的请求将被丢弃，直到队列消化。设置为 0 表示不限制。
+
+map_reduce_summary (Map-Reduce 摘要)
+  默认: false
+  说明: 待摘要内容超过 `map_reduce_chunk_tokens` 时，将中间部分按 Token 上限切分为多个分块并发生成摘要，最后再合并各部分摘要。不会丢弃任何消息，每次调用也远低于上下文上限。关闭时，会丢弃最早的中间消息直到内容不超过 `max_context_tokens`。
+
+map_reduce_chunk_tokens (分块 Token 上限)
+  默认: 32000
+  说明: Map-Reduce 模式下每个分块对话文本的最大 Token 数，不超过摘要模型的 `max_context_tokens`。
+
+map_reduce_parallelism (分块并发数)
+  默认: 4
+  说明: 单个对话同时生成分块摘要的最大数量。
+
+rolling_summary (滚动摘要)
+  默认: false
+  说明: 启用后，每次更新只将上次压缩之后新增的消息与已有摘要一起发送给摘要模型，单次更新的开销不会随对话变长而增加。关闭时，每次都会重新总结整个中间部分。
+
 debug_mode (调试模式)
   默认: true
   说明: 在日志中打印详细的调试信息。生产环境建议设为 `false`。
@@ -238,11 +266,13 @@ debug_mode (调试模式)
 """
 
 from pydantic import BaseModel, Field, model_validator
-from typing import Optional, Dict, Any, List, Union, Callable, Awaitable
+from typing import Optional, Dict, Any, List, Tuple, Union, Callable, Awaitable
 import asyncio
 import json
 import hashlib
+import threading
 import time
+from collections import OrderedDict, deque
 
 # Open WebUI 内置导入
 from open_webui.utils.chat import generate_chat_completion
@@ -263,8 +293,30 @@ except ImportError:
 
 # 数据库导入
 from sqlalchemy import Column, String, Text, DateTime, Integer, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
 
+# 所有 Token 计数统一使用的编码 (适配最新模型)
+TOKEN_ENCODING_NAME = "o200k_base"
+# 内存中最多保留的单条消息 Token 计数数量
+TOKEN_COUNT_CACHE_SIZE = 50000
+# 内存中最多缓存的对话摘要记录数量
+SUMMARY_CACHE_SIZE = 1000
+
+_token_encoding = None
+_token_encoding_lock = threading.Lock()
+
+
+def _get_token_encoding():
+    """返回进程级共享的 tiktoken 编码，首次使用时加载"""
+    global _token_encoding
+    if _token_encoding is None:
+        with _token_encoding_lock:
+            if _token_encoding is None:
+                _token_encoding = tiktoken.get_encoding(TOKEN_ENCODING_NAME)
+    return _token_encoding
+
 
 class ChatSummary(owui_Base):
     """对话摘要存储表"""
@@ -286,6 +338,24 @@ class Filter:
         self._db_engine = owui_engine
         self._SessionLocal = owui_Session
         self.temp_state = {}  # 用于在 inlet 和 outlet 之间传递临时数据
+        # 单条消息的 Token 计数，键为 (消息 ID, 内容哈希)
+        self._token_count_cache: "OrderedDict[tuple, int]" = OrderedDict()
+        self._token_count_lock = threading.Lock()
+        self._token_cache_misses = 0
+        # 摘要记录的直写缓存: chat_id -> (记录或 None, 上次校验时间)
+        self._summary_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._summary_cache_lock = threading.Lock()
+        # 摘要工作池：每个对话最多一个 worker，并受全局并发上限约束
+        self._summary_workers: Dict[str, asyncio.Task] = {}  # 持有 worker 任务的强引用
+        self._pending_summaries: Dict[str, tuple] = {}  # 每个对话最新的排队任务
+        self._summary_slot_waiters: "deque[asyncio.Future]" = deque()  # 等待空闲名额的 worker
+        self._running_summaries = 0
+        self._summary_stats = {
+            "scheduled": 0,
+            "superseded": 0,
+            "dropped": 0,
+            "completed": 0,
+        }
         self._init_database()
 
     def _init_database(self):
@@ -343,55 +413,183 @@ class Filter:
         summary_temperature: float = Field(
             default=0.1, ge=0.0, le=2.0, description="摘要生成的温度参数"
         )
+        summary_cache_ttl: int = Field(
+            default=300,
+            ge=0,
+            description="缓存的摘要在不查询数据库的情况下可直接使用的秒数，超时后根据数据库中的 updated_at 重新校验。设置为 0 表示每次都校验",
+        )
+        max_concurrent_summaries: int = Field(
+            default=2, ge=1, description="所有对话中同时生成摘要的最大数量"
+        )
+        max_queued_summaries: int = Field(
+            default=50,
+            ge=0,
+            description="等待生成摘要的最大对话数，超出后新的请求将被丢弃，直到队列消化。设置为 0 表示不限制",
+        )
+        map_reduce_summary: bool = Field(
+            default=False,
+            description="待摘要内容超过 map_reduce_chunk_tokens 时，分块并发生成摘要再合并，而不是丢弃最早的消息",
+        )
+        map_reduce_chunk_tokens: int = Field(
+            default=32000,
+            ge=1000,
+            description="Map-Reduce 模式下每个分块对话文本的最大 Token 数，不超过摘要模型的 max_context_tokens",
+        )
+        map_reduce_parallelism: int = Field(
+            default=4,
+            ge=1,
+            description="Map-Reduce 模式下单个对话同时生成分块摘要的最大数量",
+        )
+        rolling_summary: bool = Field(
+            default=False,
+            description="滚动摘要：只将上次压缩之后新增的消息合并到已有摘要中，而不是每次重新总结全部历史",
+        )
         debug_mode: bool = Field(default=True, description="调试模式，打印详细日志")
 
     def _save_summary(self, chat_id: str, summary: str, compressed_count: int):
-        """保存摘要到数据库"""
+        """使用一次原子 upsert 保存摘要到数据库，并更新缓存"""
+        now = datetime.utcnow()
         try:
             with self._SessionLocal() as session:
-                # 查找现有记录
-                existing = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
-
-                if existing:
-                    # [优化] 乐观锁检查：只有进度向前推进时才更新
-                    if compressed_count <= existing.compressed_message_count:
-                        if self.valves.debug_mode:
-                            print(
-                                f"[存储] 跳过更新：新进度 ({compressed_count}) 不大于现有进度 ({existing.compressed_message_count})"
-                            )
-                        return
-
-                    # 更新现有记录
-                    existing.summary = summary
-                    existing.compressed_message_count = compressed_count
-                    existing.updated_at = datetime.utcnow()
-                else:
-                    # 创建新记录
-                    new_summary = ChatSummary(
+                dialect = self._db_engine.dialect.name
+                if dialect in ("postgresql", "sqlite"):
+                    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+                    stmt = insert(ChatSummary).values(
                         chat_id=chat_id,
                         summary=summary,
                         compressed_message_count=compressed_count,
+                        created_at=now,
+                        updated_at=now,
+                    )
+                    # [优化] 乐观锁检查：只有进度向前推进时才更新
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[ChatSummary.chat_id],
+                        set_={
+                            "summary": stmt.excluded.summary,
+                            "compressed_message_count": stmt.excluded.compressed_message_count,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                        where=ChatSummary.compressed_message_count
+                        < stmt.excluded.compressed_message_count,
+                    )
+                    saved = session.execute(stmt).rowcount > 0
+                else:
+                    saved = self._save_summary_with_select(
+                        session, chat_id, summary, compressed_count, now
                     )
-                    session.add(new_summary)
-
                 session.commit()
 
+            if not saved:
+                # 数据库中的进度比本进程已知的更新
+                self._invalidate_summary_cache(chat_id)
                 if self.valves.debug_mode:
-                    action = "更新" if existing else "创建"
-                    print(f"[存储] 摘要已{action}到数据库 (Chat ID: {chat_id})")
+                    print(f"[存储] 跳过更新：新进度 ({compressed_count}) 不大于现有进度")
+                return
+
+            self._cache_summary_record(
+                chat_id,
+                ChatSummary(
+                    chat_id=chat_id,
+                    summary=summary,
+                    compressed_message_count=compressed_count,
+                    updated_at=now,
+                ),
+            )
+            if self.valves.debug_mode:
+                print(f"[存储] 摘要已保存到数据库 (Chat ID: {chat_id})")
 
         except Exception as e:
+            self._invalidate_summary_cache(chat_id)
             print(f"[存储] ❌ 数据库保存失败: {str(e)}")
 
+    def _save_summary_with_select(
+        self,
+        session,
+        chat_id: str,
+        summary: str,
+        compressed_count: int,
+        now: datetime,
+    ) -> bool:
+        """先查询再更新或插入的方式保存摘要，用于不支持 upsert 的数据库"""
+        # 查找现有记录
+        existing = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
+
+        if existing:
+            # [优化] 乐观锁检查：只有进度向前推进时才更新
+            if compressed_count <= existing.compressed_message_count:
+                return False
+
+            # 更新现有记录
+            existing.summary = summary
+            existing.compressed_message_count = compressed_count
+            existing.updated_at = now
+        else:
+            # 创建新记录
+            session.add(
+                ChatSummary(
+                    chat_id=chat_id,
+                    summary=summary,
+                    compressed_message_count=compressed_count,
+                    created_at=now,
+                    updated_at=now,
+                )
+            )
+        return True
+
+    def _get_cached_summary_record(
+        self, chat_id: str
+    ) -> Tuple[bool, Optional[ChatSummary]]:
+        """如果该对话的摘要记录已缓存且未过期，返回 (True, 记录)，不访问数据库"""
+        with self._summary_cache_lock:
+            entry = self._summary_cache.get(chat_id)
+            if entry is None:
+                return False, None
+            record, checked_at = entry
+            if time.monotonic() - checked_at > self.valves.summary_cache_ttl:
+                return False, None
+            self._summary_cache.move_to_end(chat_id)
+            return True, record
+
+    def _cache_summary_record(self, chat_id: str, record: Optional[ChatSummary]):
+        with self._summary_cache_lock:
+            self._summary_cache[chat_id] = (record, time.monotonic())
+            self._summary_cache.move_to_end(chat_id)
+            if len(self._summary_cache) > SUMMARY_CACHE_SIZE:
+                self._summary_cache.popitem(last=False)
+
+    def _invalidate_summary_cache(self, chat_id: str):
+        with self._summary_cache_lock:
+            self._summary_cache.pop(chat_id, None)
+
     def _load_summary_record(self, chat_id: str) -> Optional[ChatSummary]:
-        """从数据库加载摘要记录对象"""
+        """加载摘要记录对象，缓存未过期时直接使用缓存，否则从数据库加载
+
+        过期的缓存记录只读取 `updated_at` 进行校验，未变化时继续复用。
+        """
+        hit, record = self._get_cached_summary_record(chat_id)
+        if hit:
+            return record
+
+        with self._summary_cache_lock:
+            cached_record = self._summary_cache.get(chat_id, (None, 0))[0]
         try:
             with self._SessionLocal() as session:
+                if cached_record is not None:
+                    updated_at = (
+                        session.query(ChatSummary.updated_at)
+                        .filter_by(chat_id=chat_id)
+                        .scalar()
+                    )
+                    if updated_at == cached_record.updated_at:
+                        self._cache_summary_record(chat_id, cached_record)
+                        return cached_record
+
                 record = session.query(ChatSummary).filter_by(chat_id=chat_id).first()
                 if record:
                     # Detach the object from the session so it can be used after session close
                     session.expunge(record)
-                    return record
+                self._cache_summary_record(chat_id, record)
+                return record
         except Exception as e:
             print(f"[加载] ❌ 数据库读取失败: {str(e)}")
         return None
@@ -415,8 +613,8 @@ class Filter:
 
         if tiktoken:
             try:
-                # 统一使用 o200k_base 编码 (适配最新模型)
-                encoding = tiktoken.get_encoding("o200k_base")
+                # 编码在每个进程中只加载一次并复用
+                encoding = _get_token_encoding()
                 return len(encoding.encode(text))
             except Exception as e:
                 if self.valves.debug_mode:
@@ -425,22 +623,47 @@ class Filter:
         # 回退策略：粗略估算 (1 token ≈ 4 chars)
         return len(text) // 4
 
-    def _calculate_messages_tokens(
-        self, messages: List[Dict]
-    ) -> int:
+    def _get_message_text(self, msg: dict) -> str:
+        """返回消息的文本内容 (多模态内容只取文本部分)"""
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            return "".join(
+                part.get("text", "")
+                for part in content
+                if isinstance(part, dict) and part.get("type") == "text"
+            )
+        return str(content)
+
+    def _count_message_tokens(self, msg: dict) -> int:
+        """计算单条消息的 Token 数
+
+        计数按消息 ID 加文本哈希缓存，重新计算对话时只会对新增或被编辑的消息进行分词。
+        """
+        text = self._get_message_text(msg)
+        key = (msg.get("id") or "", hashlib.sha1(text.encode("utf-8")).hexdigest())
+        with self._token_count_lock:
+            tokens = self._token_count_cache.get(key)
+            if tokens is not None:
+                self._token_count_cache.move_to_end(key)
+                return tokens
+
+        tokens = self._count_tokens(text)
+        with self._token_count_lock:
+            self._token_cache_misses += 1
+            self._token_count_cache[key] = tokens
+            if len(self._token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+                self._token_count_cache.popitem(last=False)
+        return tokens
+
+    def _calculate_messages_tokens(self, messages: List[Dict]) -> int:
         """计算消息列表的总 Token 数"""
-        total_tokens = 0
-        for msg in messages:
-            content = msg.get("content", "")
-            if isinstance(content, list):
-                # 多模态内容处理
-                text_content = ""
-                for part in content:
-                    if isinstance(part, dict) and part.get("type") == "text":
-                        text_content += part.get("text", "")
-                total_tokens += self._count_tokens(text_content)
-            else:
-                total_tokens += self._count_tokens(str(content))
+        misses_before = self._token_cache_misses
+        total_tokens = sum(self._count_message_tokens(msg) for msg in messages)
+        if self.valves.debug_mode:
+            tokenized = self._token_cache_misses - misses_before
+            print(
+                f"[Token计数] 本次分词 {tokenized} / {len(messages)} 条消息，其余命中缓存"
+            )
         return total_tokens
 
     def _get_model_thresholds(self, model_id: str) -> Dict[str, int]:
@@ -534,8 +757,10 @@ class Filter:
         if self.valves.debug_mode:
             print(f"[Inlet] 记录目标压缩进度: {target_compressed_count}")
 
-        # 加载摘要记录
-        summary_record = await asyncio.to_thread(self._load_summary_record, chat_id)
+        # 加载摘要记录 (缓存未过期时不切换线程，也不访问数据库)
+        cache_hit, summary_record = self._get_cached_summary_record(chat_id)
+        if not cache_hit:
+            summary_record = await asyncio.to_thread(self._load_summary_record, chat_id)
 
         final_messages = []
 
@@ -617,18 +842,115 @@ class Filter:
             print(f"[Outlet] 响应完成")
 
         # 在后台异步处理 Token 计算和摘要生成（不等待完成，不影响输出）
-        asyncio.create_task(
-            self._check_and_generate_summary_async(
-                chat_id, model, body, __user__, __event_emitter__
-            )
+        # 目标进度在此时取出，因为任务可能在下一次 inlet 覆盖它之后才执行
+        target_compressed_count = self.temp_state.pop(chat_id, None)
+        self._schedule_summary(
+            chat_id,
+            (
+                chat_id,
+                model,
+                body,
+                __user__,
+                __event_emitter__,
+                target_compressed_count,
+            ),
         )
 
         if self.valves.debug_mode:
-            print(f"[Outlet] 后台处理已启动")
+            print(
+                f"[Outlet] 后台处理已排队 ({self._summary_queue_stats()})"
+            )
             print(f"{'='*60}\n")
 
         return body
 
+    async def _acquire_summary_slot(self):
+        """
+        等待正在运行的摘要数低于 max_concurrent_summaries，然后占用一个名额
+        每次检查都会读取当前上限，因此修改配置会立即生效，且运行数不会超过当前上限。
+        """
+        while self._running_summaries >= self.valves.max_concurrent_summaries:
+            waiter = asyncio.get_running_loop().create_future()
+            self._summary_slot_waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 在取消前刚被唤醒，把空闲名额交给下一个等待者
+                    self._wake_summary_waiters()
+                raise
+        self._running_summaries += 1
+
+    def _release_summary_slot(self):
+        """释放一个名额，并按空闲名额数唤醒等待中的 worker"""
+        self._running_summaries -= 1
+        self._wake_summary_waiters()
+
+    def _wake_summary_waiters(self):
+        free_slots = self.valves.max_concurrent_summaries - self._running_summaries
+        while free_slots > 0 and self._summary_slot_waiters:
+            waiter = self._summary_slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def _summary_queue_stats(self) -> str:
+        """格式化摘要工作池的队列深度和计数器，用于日志输出"""
+        counters = ", ".join(f"{k}: {v}" for k, v in self._summary_stats.items())
+        return (
+            f"queued: {len(self._pending_summaries)}, "
+            f"running: {self._running_summaries}, {counters}"
+        )
+
+    def _schedule_summary(self, chat_id: str, job: tuple):
+        """
+        为对话排队一次摘要检查
+        如果该对话已有等待中的任务，则用新任务替换（以最新状态为准）。
+        每个对话只运行一个 worker，所有 worker 共享全局并发上限。
+        """
+        if chat_id in self._pending_summaries:
+            self._summary_stats["superseded"] += 1
+        elif (
+            self.valves.max_queued_summaries
+            and len(self._pending_summaries) >= self.valves.max_queued_summaries
+        ):
+            self._summary_stats["dropped"] += 1
+            print(
+                f"[摘要队列] ⚠️ 队列已满，丢弃摘要请求 (Chat ID: {chat_id}, {self._summary_queue_stats()})"
+            )
+            return
+
+        self._pending_summaries[chat_id] = job
+        self._summary_stats["scheduled"] += 1
+        if chat_id not in self._summary_workers:
+            self._summary_workers[chat_id] = asyncio.create_task(
+                self._run_summary_worker(chat_id)
+            )
+
+    async def _run_summary_worker(self, chat_id: str):
+        """逐个执行该对话排队的任务，直到没有剩余任务"""
+        try:
+            while chat_id in self._pending_summaries:
+                await self._acquire_summary_slot()
+                try:
+                    # 获得执行名额后才取出任务，这样会使用替换它的最新任务
+                    job = self._pending_summaries.pop(chat_id, None)
+                    if job is None:
+                        continue
+                    try:
+                        await self._check_and_generate_summary_async(*job)
+                    finally:
+                        self._summary_stats["completed"] += 1
+                finally:
+                    self._release_summary_slot()
+                if self.valves.debug_mode:
+                    print(
+                        f"[摘要队列] 任务完成 (Chat ID: {chat_id}, {self._summary_queue_stats()})"
+                    )
+        finally:
+            # 循环判断与此处之间没有 await，因此新任务不会被遗漏
+            self._summary_workers.pop(chat_id, None)
+
     async def _check_and_generate_summary_async(
         self,
         chat_id: str,
@@ -636,6 +958,7 @@ class Filter:
         body: dict,
         user_data: Optional[dict],
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        target_compressed_count: Optional[int] = None,
     ):
         """
         后台处理：计算 Token 数并生成摘要（不阻塞响应）
@@ -669,7 +992,12 @@ class Filter:
 
                 # 继续生成摘要
                 await self._generate_summary_async(
-                    messages, chat_id, body, user_data, __event_emitter__
+                    messages,
+                    chat_id,
+                    body,
+                    user_data,
+                    __event_emitter__,
+                    target_compressed_count,
                 )
             else:
                 if self.valves.debug_mode:
@@ -687,12 +1015,15 @@ class Filter:
         body: dict,
         user_data: Optional[dict],
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+        target_compressed_count: Optional[int] = None,
     ):
         """
         异步生成摘要（后台执行，不阻塞响应）
         逻辑：
         1. 提取中间消息（去除 keep_first 和 keep_last）。
+           滚动模式下只提取上次压缩之后新增的消息，并在已有摘要的基础上更新。
         2. 检查 Token 上限，如果超过 max_context_tokens，从中间消息头部移除。
+           Map-Reduce 模式下，超过 map_reduce_chunk_tokens 的内容改为分块摘要，不会移除任何消息。
         3. 对剩余的中间消息生成摘要。
         """
         try:
@@ -700,8 +1031,7 @@ class Filter:
                 print(f"\n[🤖 异步摘要任务] 开始...")
 
             # 1. 获取目标压缩进度
-            # 优先从 temp_state 获取（由 inlet 计算），如果获取不到（例如重启后），则假设当前是完整历史
-            target_compressed_count = self.temp_state.pop(chat_id, None)
+            # 优先使用 outlet 从 temp_state 取出的值（由 inlet 计算），如果获取不到（例如重启后），则假设当前是完整历史
             if target_compressed_count is None:
                 target_compressed_count = max(0, len(messages) - self.valves.keep_last)
                 if self.valves.debug_mode:
@@ -714,6 +1044,10 @@ class Filter:
             end_index = len(messages) - self.valves.keep_last
             if self.valves.keep_last == 0:
                 end_index = len(messages)
+            # [滚动摘要] 保存的进度是 target_compressed_count，因此只摘要到该位置为止
+            # 否则该位置之前的最后一条消息会在下一轮被重复合并
+            if self.valves.rolling_summary:
+                end_index = min(end_index, target_compressed_count)
 
             # 确保索引有效
             if start_index >= end_index:
@@ -725,6 +1059,33 @@ class Filter:
 
             middle_messages = messages[start_index:end_index]
 
+            # [滚动摘要] 将上次压缩之后新增的消息合并到已有摘要中
+            previous_summary = None
+            if self.valves.rolling_summary:
+                summary_record = await asyncio.to_thread(
+                    self._load_summary_record, chat_id
+                )
+                # 进度超过当前历史长度说明对话被编辑过，此时重新完整总结
+                if (
+                    summary_record
+                    and summary_record.compressed_message_count <= len(messages)
+                ):
+                    compressed_count = max(
+                        summary_record.compressed_message_count, start_index
+                    )
+                    if compressed_count >= end_index:
+                        if self.valves.debug_mode:
+                            print(
+                                f"[🤖 异步摘要任务] 上次压缩 ({compressed_count}) 之后没有新消息，跳过"
+                            )
+                        return
+                    previous_summary = summary_record.summary
+                    middle_messages = messages[compressed_count:end_index]
+                    if self.valves.debug_mode:
+                        print(
+                            f"[🤖 异步摘要任务] 滚动摘要: 从第 {compressed_count} 条消息开始扩展已有摘要"
+                        )
+
             if self.valves.debug_mode:
                 print(f"[🤖 异步摘要任务] 待处理中间消息: {len(middle_messages)} 条")
 
@@ -745,11 +1106,30 @@ class Filter:
                 )
 
             # 计算当前总 Token (使用摘要模型进行计数)
+            # 滚动模式下只发送已有摘要和新增消息
             total_tokens = await asyncio.to_thread(
-                self._calculate_messages_tokens, messages
+                self._calculate_messages_tokens,
+                middle_messages if previous_summary is not None else messages,
+            )
+            if previous_summary is not None:
+                total_tokens += await asyncio.to_thread(
+                    self._count_tokens, previous_summary
+                )
+
+            # [Map-Reduce] 内容过长时分块摘要，而不是从头部丢弃消息
+            max_chunk_tokens = min(
+                self.valves.map_reduce_chunk_tokens, max_context_tokens
+            )
+            use_map_reduce = (
+                self.valves.map_reduce_summary and total_tokens > max_chunk_tokens
             )
 
-            if total_tokens > max_context_tokens:
+            if use_map_reduce:
+                if self.valves.debug_mode:
+                    print(
+                        f"[🤖 异步摘要任务] 总 Token ({total_tokens}) 超过分块上限 ({max_chunk_tokens})，使用 Map-Reduce 摘要"
+                    )
+            elif total_tokens > max_context_tokens:
                 excess_tokens = total_tokens - max_context_tokens
                 if self.valves.debug_mode:
                     print(
@@ -762,9 +1142,7 @@ class Filter:
 
                 while removed_tokens < excess_tokens and middle_messages:
                     msg_to_remove = middle_messages.pop(0)
-                    msg_tokens = self._count_tokens(
-                        str(msg_to_remove.get("content", ""))
-                    )
+                    msg_tokens = self._count_message_tokens(msg_to_remove)
                     removed_tokens += msg_tokens
                     removed_count += 1
 
@@ -778,11 +1156,13 @@ class Filter:
                     print(f"[🤖 异步摘要任务] 截断后中间消息为空，跳过摘要生成")
                 return
 
-            # 4. 构建对话文本
-            conversation_text = self._format_messages_for_summary(middle_messages)
+            # 4. 构建对话文本 (Map-Reduce 模式下每个分块单独格式化)
+            conversation_text = ""
+            if not use_map_reduce:
+                conversation_text = self._format_messages_for_summary(middle_messages)
 
             # 5. 调用 LLM 生成新摘要
-            # 注意：这里不再传入 previous_summary，因为旧摘要（如果有）已经包含在 middle_messages 里了
+            # 注意：只有滚动模式才传入 previous_summary，否则对整个中间部分重新生成摘要
 
             # 发送开始生成摘要的状态通知
             if __event_emitter__:
@@ -796,9 +1176,18 @@ class Filter:
                     }
                 )
 
-            new_summary = await self._call_summary_llm(
-                None, conversation_text, body, user_data
-            )
+            if use_map_reduce:
+                new_summary = await self._map_reduce_summary(
+                    previous_summary,
+                    middle_messages,
+                    body,
+                    user_data,
+                    max_chunk_tokens,
+                )
+            else:
+                new_summary = await self._call_summary_llm(
+                    previous_summary, conversation_text, body, user_data
+                )
 
             # 6. 保存新摘要
             if self.valves.debug_mode:
@@ -832,10 +1221,10 @@ class Filter:
 
             traceback.print_exc()
 
-    def _format_messages_for_summary(self, messages: list) -> str:
-        """格式化消息用于摘要"""
+    def _format_messages_for_summary(self, messages: list, start: int = 1) -> str:
+        """格式化消息用于摘要，编号从 start 开始"""
         formatted = []
-        for i, msg in enumerate(messages, 1):
+        for i, msg in enumerate(messages, start):
             role = msg.get("role", "unknown")
             content = msg.get("content", "")
 
@@ -858,6 +1247,107 @@ class Filter:
 
         return "\n\n".join(formatted)
 
+    def _split_messages_into_chunks(
+        self, messages: list, max_chunk_tokens: int
+    ) -> List[Tuple[int, list]]:
+        """
+        将消息切分为连续的分块，每个分块格式化后的文本不超过 max_chunk_tokens
+        返回每个分块的 (首条消息索引, 消息列表)。超过上限的单条消息单独成为一个分块。
+        """
+        chunks = []
+        current, current_tokens, current_start = [], 0, 0
+        for i, msg in enumerate(messages):
+            msg_tokens = self._count_tokens(self._format_messages_for_summary([msg]))
+            if current and current_tokens + msg_tokens > max_chunk_tokens:
+                chunks.append((current_start, current))
+                current, current_tokens, current_start = [], 0, i
+            current.append(msg)
+            current_tokens += msg_tokens
+        if current:
+            chunks.append((current_start, current))
+        return chunks
+
+    def _group_summaries(
+        self, summaries: List[str], max_chunk_tokens: int
+    ) -> List[List[str]]:
+        """将连续的部分摘要分组，使每组不超过 max_chunk_tokens"""
+        groups = []
+        current, current_tokens = [], 0
+        for summary in summaries:
+            summary_tokens = self._count_tokens(summary)
+            if current and current_tokens + summary_tokens > max_chunk_tokens:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += summary_tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def _format_partial_summaries(self, summaries: List[str]) -> str:
+        """格式化对话中连续各部分的摘要，用于合并"""
+        return "\n\n".join(
+            f"[对话第 {i} 部分（共 {len(summaries)} 部分）的摘要]\n{summary}"
+            for i, summary in enumerate(summaries, 1)
+        )
+
+    async def _map_reduce_summary(
+        self,
+        previous_summary: Optional[str],
+        messages: list,
+        body: dict,
+        user_data: Optional[dict],
+        max_chunk_tokens: int,
+    ) -> str:
+        """
+        为一次调用放不下的消息生成摘要
+        Map: 将消息按 Token 上限切分为多个分块，并发生成摘要（同时最多 map_reduce_parallelism 个）。
+        Reduce: 在最后一次调用中合并各部分摘要（滚动模式下还包括已有摘要）。
+        如果部分摘要太长无法一次合并，则先分组合并。
+        """
+        semaphore = asyncio.Semaphore(self.valves.map_reduce_parallelism)
+
+        async def summarize(text: str) -> str:
+            async with semaphore:
+                return await self._call_summary_llm(None, text, body, user_data)
+
+        chunks = await asyncio.to_thread(
+            self._split_messages_into_chunks, messages, max_chunk_tokens
+        )
+        if self.valves.debug_mode:
+            print(f"[🤖 Map-Reduce] 将 {len(messages)} 条消息分为 {len(chunks)} 个分块生成摘要")
+
+        partial_summaries = await asyncio.gather(
+            *(
+                summarize(self._format_messages_for_summary(chunk, start + 1))
+                for start, chunk in chunks
+            )
+        )
+
+        while len(partial_summaries) > 1:
+            groups = self._group_summaries(partial_summaries, max_chunk_tokens)
+            if len(groups) == 1 or len(groups) == len(partial_summaries):
+                break
+            if self.valves.debug_mode:
+                print(
+                    f"[🤖 Map-Reduce] 将 {len(partial_summaries)} 个部分摘要分为 {len(groups)} 组合并"
+                )
+            partial_summaries = await asyncio.gather(
+                *(summarize(self._format_partial_summaries(group)) for group in groups)
+            )
+
+        if len(partial_summaries) == 1 and previous_summary is None:
+            return partial_summaries[0]
+
+        if self.valves.debug_mode:
+            print(f"[🤖 Map-Reduce] 将 {len(partial_summaries)} 个部分摘要合并为最终摘要")
+        return await self._call_summary_llm(
+            previous_summary,
+            self._format_partial_summaries(partial_summaries),
+            body,
+            user_data,
+        )
+
     async def _call_summary_llm(
         self,
         previous_summary: Optional[str],
@@ -872,6 +1362,16 @@ class Filter:
             print(f"[🤖 LLM 调用] 使用 Open WebUI 内置方法")
 
         # 构建摘要提示词 (优化版)
+        # 滚动模式下，将新的对话内容合并到已有摘要中
+        previous_summary_block = ""
+        if previous_summary:
+            previous_summary_block = f"""
+### 已有摘要
+下面的对话是在这份已有摘要之后继续进行的。请将新内容合并进去，输出一份同时涵盖两者的完整摘要。除非新内容取代了已有信息，否则请保留已有摘要中的信息。
+
+{previous_summary}
+"""
+
         summary_prompt = f"""
 你是一个专业的对话上下文压缩专家。你的任务是对以下对话内容进行高保真摘要。
 这段对话可能包含之前的摘要（作为系统消息或文本）以及后续的对话内容。
@@ -898,7 +1398,7 @@ class Filter:
     *   **代码/技术细节** (使用代码块包裹)。
 *   **进展与结论**：已完成的步骤和达成的共识。
 *   **待办/下一步**：明确的后续行动。
-
+{previous_summary_block}
 ---
 {new_conversation_text}
 ---
@@ -6,10 +6,10 @@ author: suurt8ll
 author_url: https://github.com/suurt8ll
 funding_url: https://github.com/suurt8ll/open_webui_functions
 license: MIT
-version: 1.7.0
+version: 1.8.0
 """
 
-VERSION = "1.7.0"
+VERSION = "1.8.0"
 
 # This filter can detect that a feature like web search or code execution is enabled in the front-end,
 # set the feature back to False so Open WebUI does not run it's own logic and then
@@ -28,7 +28,9 @@ from fastapi.datastructures import State
 from loguru import logger
 from pydantic import BaseModel, Field
 import pydantic_core
+from collections import OrderedDict
 from collections.abc import Awaitable, Callable
+from urllib.parse import urljoin
 from typing import Any, Literal, TYPE_CHECKING, cast
 
 from open_webui.models.functions import Functions
@@ -92,10 +94,171 @@ ALLOWED_CODE_EXECUTION_MODELS = {
 # TODO: Move to Pipe.Valves.
 DEFAULT_URL_TIMEOUT = aiohttp.ClientTimeout(total=10)  # 10 seconds total timeout
 
+GROUNDING_REDIRECT_PREFIX = "https://vertexaisearch.cloud.google.com/grounding-api-redirect/"
+# Seconds after which background URL resolution gives up and the original URLs are kept.
+BACKGROUND_RESOLUTION_TIMEOUT = 60
+# Maximum number of resolved redirects kept in memory.
+REDIRECT_CACHE_MAX_ENTRIES = 10_000
+# The Manifold pipe finds citation markers by the segment text that precedes them and tells
+# supports apart by the last 32 characters of it, so compact sources only keep that tail.
+COMPACT_SEGMENT_TAIL_CHARS = 32
+
 # Setting auditable=False avoids duplicate output for log levels that would be printed out by the main log.
 log = logger.bind(auditable=False)
 
 
+class RedirectResolver:
+    """
+    Resolves grounding redirect URLs to the URLs of the actual sources.
+
+    One instance is shared by all requests. It keeps a pooled HTTP session, caps the number
+    of concurrent lookups, shares lookups of the same URL that are in flight and caches
+    resolved URLs for a while, since popular sources show up in many grounded answers.
+    Only the redirect response is requested, the target page is never downloaded.
+    """
+
+    def __init__(self):
+        self.max_concurrency = 16
+        self.cache_ttl = 24 * 3600
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session: aiohttp.ClientSession | None = None
+        # redirect URL -> (final URL, monotonic expiry time)
+        self.cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.inflight: dict[str, asyncio.Task[tuple[str, bool]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def configure(self, max_concurrency: int, cache_ttl: int) -> None:
+        """Applies the current settings. A new concurrency limit applies to lookups started afterwards."""
+        if max_concurrency != self.max_concurrency:
+            self.max_concurrency = max_concurrency
+            self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache_ttl = cache_ttl
+
+    async def resolve_many(self, urls: list[str]) -> dict[str, tuple[str, bool]]:
+        """Resolves `urls` concurrently. Returns `url -> (final URL, success)` for each unique URL."""
+        unique_urls = list(dict.fromkeys(urls))
+        results = await asyncio.gather(*(self.resolve(url) for url in unique_urls))
+        log.info(
+            f"Resolved {len(unique_urls)} URL(s). Redirect cache hit rate: {self.hit_rate:.0%} "
+            f"(hits: {self.hits}, misses: {self.misses}, failures: {self.failures}, "
+            f"entries: {len(self.cache)})."
+        )
+        return dict(zip(unique_urls, results))
+
+    async def resolve(self, url: str) -> tuple[str, bool]:
+        """Returns the final URL of `url` and whether it was resolved, using the cache when possible."""
+        if not url:
+            return "", False
+        if cached := self.cache.get(url):
+            final_url, expires_at = cached
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self.cache.move_to_end(url)
+                return final_url, True
+            del self.cache[url]
+
+        self.misses += 1
+        task = self.inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._resolve_and_cache(url))
+            self.inflight[url] = task
+        # Shielding keeps a shared lookup alive if one of the callers is cancelled.
+        return await asyncio.shield(task)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    async def _resolve_and_cache(self, url: str) -> tuple[str, bool]:
+        try:
+            async with self.semaphore:
+                final_url, success = await self._resolve_url(url)
+        finally:
+            self.inflight.pop(url, None)
+        if success:
+            self.cache[url] = (final_url, time.monotonic() + self.cache_ttl)
+            while len(self.cache) > REDIRECT_CACHE_MAX_ENTRIES:
+                self.cache.popitem(last=False)
+        else:
+            self.failures += 1
+        return final_url, success
+
+    async def _resolve_url(
+        self,
+        url: str,
+        timeout: aiohttp.ClientTimeout = DEFAULT_URL_TIMEOUT,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+    ) -> tuple[str, bool]:
+        """
+        Reads the target of a redirect URL, with multiple retries on failure.
+        Returns the final URL and a boolean indicating success.
+
+        Only a redirect with a `Location` header, or a 2xx response for a URL that is not
+        a grounding redirect, counts as success. Error responses (e.g. 429 or 5xx from the
+        redirect service) are failures, so they are not cached and are retried later.
+        """
+        for attempt in range(max_retries + 1):
+            try:
+                async with self._get_session().get(
+                    url,
+                    allow_redirects=False,
+                    timeout=timeout,
+                ) as response:
+                    location = response.headers.get("Location")
+                    if 300 <= response.status < 400 and location:
+                        final_url = urljoin(url, location)
+                    elif 200 <= response.status < 300 and not url.startswith(
+                        GROUNDING_REDIRECT_PREFIX
+                    ):
+                        # A URL that does not redirect is already the final one.
+                        final_url = str(response.url)
+                    else:
+                        final_url = None
+                    status = response.status
+                if final_url:
+                    log.debug(
+                        f"Resolved URL '{url}' to '{final_url}' after {attempt} retries"
+                    )
+                    return final_url, True
+                if (status == 429 or status >= 500) and attempt < max_retries:
+                    delay = min(base_delay * (2**attempt), 10.0)
+                    log.warning(
+                        f"Retry {attempt + 1}/{max_retries + 1} for URL '{url}': HTTP {status}. Waiting {delay:.1f}s..."
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                log.error(f"Failed to resolve URL '{url}': HTTP {status} without a redirect.")
+                return url, False
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                if attempt == max_retries:
+                    log.error(
+                        f"Failed to resolve URL '{url}' after {max_retries + 1} attempts: {e}"
+                    )
+                    return url, False
+                else:
+                    delay = min(base_delay * (2**attempt), 10.0)
+                    log.warning(
+                        f"Retry {attempt + 1}/{max_retries + 1} for URL '{url}': {e}. Waiting {delay:.1f}s..."
+                    )
+                    await asyncio.sleep(delay)
+            except Exception as e:
+                log.error(f"Unexpected error resolving URL '{url}': {e}")
+                return url, False
+        return url, False
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created on first use, because a session must be created inside the running event loop.
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+            )
+        return self.session
+
+
 class Filter:
 
     class Valves(BaseModel):
@@ -125,6 +288,54 @@ class Filter:
             description="""Decide if you want ot bypass Open WebUI's RAG and send your documents directly to Google API.
             Default value is True.""",
         )
+        PREUPLOAD_FILES: bool = Field(
+            default=False,
+            description="""Whether to start uploading attached files to the Google Files API in the background
+            as soon as a message with attachments is sent, before Open WebUI reaches the Manifold pipe.
+            Only applies when BYPASS_BACKEND_RAG is enabled and the pipe uses the Files API.
+            Default value is False.""",
+        )
+        RESOLVE_SOURCES_IN_BACKGROUND: bool = Field(
+            default=False,
+            description="""Whether to emit grounding sources with their redirect URLs and finish the response right away,
+            then resolve the URLs in the background and emit the sources again with the final URLs.
+            When disabled, the response is finished only after all source URLs are resolved.
+            Default value is False.""",
+        )
+        PREFETCH_SOURCE_URLS: bool = Field(
+            default=True,
+            description="""Whether to start resolving grounding source URLs as soon as the Manifold pipe receives them,
+            while the rest of the response is still streaming, instead of after the response has finished.
+            Default value is True.""",
+        )
+        URL_RESOLUTION_CONCURRENCY: int = Field(
+            default=16,
+            ge=1,
+            description="""Maximum number of grounding source URLs resolved at the same time, across all requests.
+            Default value is 16.""",
+        )
+        URL_RESOLUTION_CACHE_TTL: int = Field(
+            default=86400,
+            ge=0,
+            description="""Seconds to remember the resolved URL of a grounding source.
+            Default value is 86400 (24 hours).""",
+        )
+        COMPACT_SOURCES: bool = Field(
+            default=False,
+            description="""Whether to emit grounding sources in a compact form. Each support is stored once instead of
+            under every source it cites, sources reference the message by index ranges and each supported
+            snippet is written out only once. Sources are persisted in the chat, so this keeps heavily grounded
+            chats small and fast to load. Default value is False.""",
+        )
+        COMPACT_SOURCES_MAX_SIZE_KB: int = Field(
+            default=256,
+            ge=0,
+            description="""Size cap for compact sources in kilobytes. If the serialized sources exceed it,
+            the snippet texts are dropped from the source documents, keeping only their index ranges,
+            and if that is not enough, the snippet lists are dropped as well. The supports the Manifold pipe
+            needs to strip citation markers are always kept. 0 disables the cap.
+            Only applies when COMPACT_SOURCES is enabled. Default value is 256.""",
+        )
         LOG_LEVEL: Literal[
             "TRACE", "DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR", "CRITICAL"
         ] = Field(
@@ -141,10 +352,19 @@ class Filter:
         self.valves = self.Valves(**(valves if valves else {}))
         self.log_level = self.valves.LOG_LEVEL
         self._add_log_handler()
+        # Strong references to fire-and-forget tasks, so they are not garbage collected mid-flight.
+        self.background_tasks: set[asyncio.Task] = set()
+        self.redirect_resolver = RedirectResolver()
         log.success("Function has been initialized.")
         log.trace("Full self object:", payload=self.__dict__)
 
-    def inlet(self, body: "Body", __metadata__: dict[str, Any]) -> "Body":
+    def inlet(
+        self,
+        body: "Body",
+        __metadata__: dict[str, Any],
+        __request__: Request,
+        __user__: "UserData",
+    ) -> "Body":
         """Modifies the incoming request payload before it's sent to the LLM. Operates on the `form_data` dictionary."""
 
         # Detect log level change inside self.valves
@@ -241,6 +461,8 @@ class Filter:
                 log.info(
                     "BYPASS_BACKEND_RAG is enabled, bypassing Open WebUI RAG to let the Manifold pipe handle documents."
                 )
+                if self.valves.PREUPLOAD_FILES:
+                    self._start_files_preupload(body, __request__, __user__, __metadata__)
                 if files := body.get("files"):
                     log.info(
                         f"Removing {len(files)} files from the Open WebUI RAG pipeline."
@@ -289,8 +511,15 @@ class Filter:
         log.debug("inlet method has finished.")
         return body
 
-    def stream(self, event: dict) -> dict:
+    def stream(
+        self,
+        event: dict,
+        __request__: Request | None = None,
+        __metadata__: dict[str, Any] | None = None,
+    ) -> dict:
         """Modifies the streaming response from the LLM in real-time. Operates on individual chunks of data."""
+        if self.valves.PREFETCH_SOURCE_URLS and __request__ and __metadata__:
+            self._start_source_urls_prefetch(__request__, __metadata__)
         return event
 
     async def outlet(
@@ -352,7 +581,12 @@ class Filter:
             gs_supports = stored_metadata.grounding_supports
             gs_chunks = stored_metadata.grounding_chunks
             if gs_supports and gs_chunks:
-                await self._resolve_and_emit_sources(
+                emit_sources = (
+                    self._emit_sources_and_resolve_later
+                    if self.valves.RESOLVE_SOURCES_IN_BACKGROUND
+                    else self._resolve_and_emit_sources
+                )
+                await emit_sources(
                     grounding_chunks=gs_chunks,
                     supports=gs_supports,
                     event_emitter=__event_emitter__,
@@ -379,6 +613,60 @@ class Filter:
 
     # region 1. Helper methods inside the Filter class
 
+    # region 1.0 Pre-upload files
+
+    def _start_files_preupload(
+        self,
+        body: "Body",
+        __request__: Request,
+        __user__: "UserData",
+        __metadata__: dict[str, Any],
+    ) -> None:
+        """Starts uploading the attached files through the Manifold pipe without waiting for it."""
+        file_ids = [
+            file["id"]
+            for file in body.get("files") or []
+            if file.get("type") == "file" and file.get("id")
+        ]
+        if not file_ids:
+            return
+
+        pipe_id = "gemini_manifold_google_genai"
+        pipe = getattr(__request__.app.state, "FUNCTIONS", {}).get(pipe_id)
+        if not hasattr(pipe, "preupload_files"):
+            log.debug(
+                "The Manifold pipe is not loaded yet or does not support pre-uploading files. Skipping."
+            )
+            return
+
+        log.info(f"Starting background pre-upload of {len(file_ids)} file(s).")
+        self._start_background_task(
+            self._preupload_files(
+                pipe, pipe_id, file_ids, body.get("model", ""), __user__, __metadata__
+            )
+        )
+
+    @staticmethod
+    async def _preupload_files(
+        pipe: Any,
+        pipe_id: str,
+        file_ids: list[str],
+        model_id: str,
+        __user__: "UserData",
+        __metadata__: dict[str, Any],
+    ) -> None:
+        try:
+            # The pipe expects the user's valves for itself, like Open WebUI passes them to `pipe`.
+            user_valves = await asyncio.to_thread(
+                Functions.get_user_valves_by_id_and_user_id, pipe_id, __user__["id"]
+            )
+            user = {**__user__, "valves": pipe.UserValves(**(user_valves or {}))}
+            await pipe.preupload_files(file_ids, model_id, user, __metadata__)
+        except Exception:
+            log.exception("Background pre-upload of files failed.")
+
+    # endregion 1.0 Pre-upload files
+
     # region 1.1 Add citations
 
     def _get_text_w_citation_markers(
@@ -437,10 +725,10 @@ class Filter:
 
         if content_for_citation_processing:
             try:
-                modified_content_bytes = bytearray(
-                    content_for_citation_processing.encode("utf-8")
-                )
-                for support in reversed(supports):
+                # Segment indices are byte offsets into the UTF-8 encoded content.
+                content_bytes = content_for_citation_processing.encode("utf-8")
+                insertions: list[tuple[int, bytes]] = []
+                for support in supports:
                     segment = support.segment
                     indices = support.grounding_chunk_indices
                     if not (
@@ -451,19 +739,28 @@ class Filter:
                         log.debug(f"Skipping support due to missing data: {support}")
                         continue
                     end_pos = segment.end_index
-                    if not (0 <= end_pos <= len(modified_content_bytes)):
+                    if not (0 <= end_pos <= len(content_bytes)):
                         log.warning(
                             f"Support segment end_index ({end_pos}) is out of bounds for the processable content "
-                            f"(length {len(modified_content_bytes)} bytes after potential thought stripping). "
+                            f"(length {len(content_bytes)} bytes after potential thought stripping). "
                             f"Content (first 50 chars): '{content_for_citation_processing[:50]}...'. Skipping this support. Support: {support}"
                         )
                         continue
                     citation_markers = "".join(f"[{index + 1}]" for index in indices)
-                    encoded_citation_markers = citation_markers.encode("utf-8")
-                    modified_content_bytes[end_pos:end_pos] = encoded_citation_markers
-                processed_content_part_with_markers = modified_content_bytes.decode(
-                    "utf-8"
-                )
+                    insertions.append((end_pos, citation_markers.encode("utf-8")))
+
+                # Assemble the output from slices in one pass instead of splicing into the buffer
+                # once per support. The sort is stable, so markers of supports that end at the
+                # same position keep the order of the supports.
+                insertions.sort(key=lambda insertion: insertion[0])
+                pieces: list[bytes] = []
+                cursor = 0
+                for end_pos, encoded_citation_markers in insertions:
+                    pieces.append(content_bytes[cursor:end_pos])
+                    pieces.append(encoded_citation_markers)
+                    cursor = end_pos
+                pieces.append(content_bytes[cursor:])
+                processed_content_part_with_markers = b"".join(pieces).decode("utf-8")
             except Exception as e:
                 log.error(
                     f"Error injecting citation markers into content: {e}. "
@@ -481,50 +778,38 @@ class Filter:
         final_result_str = thought_prefix + processed_content_part_with_markers
         return final_result_str
 
-    async def _resolve_url(
+    async def _resolve_and_emit_sources(
         self,
-        session: aiohttp.ClientSession,
-        url: str,
-        timeout: aiohttp.ClientTimeout = DEFAULT_URL_TIMEOUT,
-        max_retries: int = 3,
-        base_delay: float = 0.5,
-    ) -> tuple[str, bool]:
+        grounding_chunks: list[types.GroundingChunk],
+        supports: list[types.GroundingSupport],
+        event_emitter: Callable[["Event"], Awaitable[None]],
+        pipe_start_time: float | None,
+    ):
         """
-        Resolves a given URL using the provided aiohttp session, with multiple retries on failure.
-        Returns the final URL and a boolean indicating success.
+        Resolves URLs and emits a chat completion event
+        containing only the source information, along with status updates.
         """
-        if not url:
-            return "", False
-        for attempt in range(max_retries + 1):
-            try:
-                async with session.get(
-                    url,
-                    allow_redirects=True,
-                    timeout=timeout,
-                ) as response:
-                    final_url = str(response.url)
-                    log.debug(
-                        f"Resolved URL '{url}' to '{final_url}' after {attempt} retries"
-                    )
-                    return final_url, True
-            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                if attempt == max_retries:
-                    log.error(
-                        f"Failed to resolve URL '{url}' after {max_retries + 1} attempts: {e}"
-                    )
-                    return url, False
-                else:
-                    delay = min(base_delay * (2**attempt), 10.0)
-                    log.warning(
-                        f"Retry {attempt + 1}/{max_retries + 1} for URL '{url}': {e}. Waiting {delay:.1f}s..."
-                    )
-                    await asyncio.sleep(delay)
-            except Exception as e:
-                log.error(f"Unexpected error resolving URL '{url}': {e}")
-                return url, False
-        return url, False
+        initial_metadatas = self._get_source_uris(grounding_chunks)
+        if not initial_metadatas:
+            log.info("No source URIs found, skipping source emission.")
+            return
 
-    async def _resolve_and_emit_sources(
+        urls_to_resolve = self._get_redirect_urls(initial_metadatas)
+        resolved_uris_map = {}
+        if urls_to_resolve:
+            resolved_uris_map = await self._resolve_source_urls(
+                urls_to_resolve, event_emitter, pipe_start_time
+            )
+
+        await self._emit_sources(
+            grounding_chunks,
+            supports,
+            initial_metadatas,
+            resolved_uris_map,
+            event_emitter,
+        )
+
+    async def _emit_sources_and_resolve_later(
         self,
         grounding_chunks: list[types.GroundingChunk],
         supports: list[types.GroundingSupport],
@@ -532,9 +817,52 @@ class Filter:
         pipe_start_time: float | None,
     ):
         """
-        Resolves URLs in the background and emits a chat completion event
-        containing only the source information, along with status updates.
+        Emits the sources with their original URLs right away, then resolves the redirect URLs
+        in a background task and emits the sources again with the final URLs.
         """
+        initial_metadatas = self._get_source_uris(grounding_chunks)
+        if not initial_metadatas:
+            log.info("No source URIs found, skipping source emission.")
+            return
+
+        await self._emit_sources(
+            grounding_chunks, supports, initial_metadatas, {}, event_emitter
+        )
+        if not (urls_to_resolve := self._get_redirect_urls(initial_metadatas)):
+            return
+
+        async def resolve_and_reemit():
+            try:
+                resolved_uris_map = await asyncio.wait_for(
+                    self._resolve_source_urls(
+                        urls_to_resolve, event_emitter, pipe_start_time
+                    ),
+                    timeout=BACKGROUND_RESOLUTION_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                log.warning(
+                    f"Background URL resolution did not finish within {BACKGROUND_RESOLUTION_TIMEOUT}s. "
+                    "Keeping the original URLs."
+                )
+                return
+            if all(resolved_uris_map.get(url, url) == url for url in urls_to_resolve):
+                log.info("No source URL was resolved, not emitting the sources again.")
+                return
+            await self._emit_sources(
+                grounding_chunks,
+                supports,
+                initial_metadatas,
+                resolved_uris_map,
+                event_emitter,
+            )
+
+        self._start_background_task(resolve_and_reemit())
+
+    @staticmethod
+    def _get_source_uris(
+        grounding_chunks: list[types.GroundingChunk],
+    ) -> list[tuple[int, str]]:
+        """Returns `(chunk index, uri)` for each grounding chunk that has a URI."""
         initial_metadatas: list[tuple[int, str]] = []
         for i, g_c in enumerate(grounding_chunks):
             uri = None
@@ -545,61 +873,98 @@ class Filter:
 
             if uri:
                 initial_metadatas.append((i, uri))
+        return initial_metadatas
 
-        if not initial_metadatas:
-            log.info("No source URIs found, skipping source emission.")
-            return
-
-        urls_to_resolve = [
+    @staticmethod
+    def _get_redirect_urls(initial_metadatas: list[tuple[int, str]]) -> list[str]:
+        return [
             uri
             for _, uri in initial_metadatas
-            if uri.startswith(
-                "https://vertexaisearch.cloud.google.com/grounding-api-redirect/"
-            )
+            if uri.startswith(GROUNDING_REDIRECT_PREFIX)
         ]
-        resolved_uris_map = {}
 
-        if urls_to_resolve:
-            num_urls = len(urls_to_resolve)
+    async def _resolve_source_urls(
+        self,
+        urls_to_resolve: list[str],
+        event_emitter: Callable[["Event"], Awaitable[None]],
+        pipe_start_time: float | None,
+    ) -> dict[str, str]:
+        """Resolves the redirect URLs with status updates. Returns `redirect URL -> final URL`."""
+        num_urls = len(urls_to_resolve)
+        self._emit_status_update(
+            event_emitter,
+            f"Resolving {num_urls} source URLs...",
+            pipe_start_time,
+        )
+
+        try:
+            log.info(f"Resolving {num_urls} source URLs...")
+            self.redirect_resolver.configure(
+                self.valves.URL_RESOLUTION_CONCURRENCY,
+                self.valves.URL_RESOLUTION_CACHE_TTL,
+            )
+            results = await self.redirect_resolver.resolve_many(urls_to_resolve)
+            log.info("URL resolution completed.")
+
+            resolved_uris_map = {
+                url: final_url for url, (final_url, _) in results.items()
+            }
+
+            success_count = sum(1 for url in urls_to_resolve if results[url][1])
+            final_status_msg = (
+                "URL resolution complete"
+                if success_count == num_urls
+                else f"Resolved {success_count}/{num_urls} URLs"
+            )
             self._emit_status_update(
-                event_emitter,
-                f"Resolving {num_urls} source URLs...",
-                pipe_start_time,
+                event_emitter, final_status_msg, pipe_start_time, done=True
             )
 
-            try:
-                log.info(f"Resolving {num_urls} source URLs...")
-                async with aiohttp.ClientSession() as session:
-                    tasks = [self._resolve_url(session, url) for url in urls_to_resolve]
-                    results = await asyncio.gather(*tasks)
-                log.info("URL resolution completed.")
-
-                resolved_uris = [res[0] for res in results]
-                resolved_uris_map = dict(zip(urls_to_resolve, resolved_uris))
-
-                success_count = sum(1 for _, success in results if success)
-                final_status_msg = (
-                    "URL resolution complete"
-                    if success_count == num_urls
-                    else f"Resolved {success_count}/{num_urls} URLs"
-                )
-                self._emit_status_update(
-                    event_emitter, final_status_msg, pipe_start_time, done=True
-                )
+        except Exception as e:
+            log.error(f"Error during URL resolution: {e}")
+            resolved_uris_map = {url: url for url in urls_to_resolve}
+            self._emit_status_update(
+                event_emitter, "URL resolution failed", pipe_start_time, done=True
+            )
+        return resolved_uris_map
 
-            except Exception as e:
-                log.error(f"Error during URL resolution: {e}")
-                resolved_uris_map = {url: url for url in urls_to_resolve}
-                self._emit_status_update(
-                    event_emitter, "URL resolution failed", pipe_start_time, done=True
-                )
+    async def _emit_sources(
+        self,
+        grounding_chunks: list[types.GroundingChunk],
+        supports: list[types.GroundingSupport],
+        initial_metadatas: list[tuple[int, str]],
+        resolved_uris_map: dict[str, str],
+        event_emitter: Callable[["Event"], Awaitable[None]],
+    ) -> None:
+        """Emits a chat completion event containing only the source information."""
+        build_sources = (
+            self._build_compact_sources
+            if self.valves.COMPACT_SOURCES
+            else self._build_sources
+        )
+        sources_list = build_sources(
+            grounding_chunks, supports, initial_metadatas, resolved_uris_map
+        )
 
-        source_metadatas_template: list["SourceMetadata"] = [
+        event: "ChatCompletionEvent" = {
+            "type": "chat:completion",
+            "data": {"sources": sources_list},
+        }
+        await event_emitter(event)
+        log.info("Emitted sources event.")
+        log.trace("ChatCompletionEvent:", payload=event)
+
+    @staticmethod
+    def _get_source_metadatas(
+        grounding_chunks: list[types.GroundingChunk],
+        initial_metadatas: list[tuple[int, str]],
+        resolved_uris_map: dict[str, str],
+    ) -> list["SourceMetadata"]:
+        """Returns one metadata dict per grounding chunk, with the URLs filled in for chunks that have one."""
+        populated_metadatas: list["SourceMetadata"] = [
             {"source": None, "original_url": None, "supports": []}
             for _ in grounding_chunks
         ]
-        populated_metadatas = [m.copy() for m in source_metadatas_template]
-
         for chunk_index, original_uri in initial_metadatas:
             final_uri = resolved_uris_map.get(original_uri, original_uri)
             if 0 <= chunk_index < len(populated_metadatas):
@@ -609,6 +974,27 @@ class Filter:
                 log.warning(
                     f"Chunk index {chunk_index} out of bounds when populating resolved URLs."
                 )
+        return populated_metadatas
+
+    @staticmethod
+    def _get_chunk_title_lines(chunk: types.GroundingChunk) -> list[str]:
+        if maps_info := chunk.maps:
+            title = maps_info.title or "N/A"
+            place_id = maps_info.place_id or "N/A"
+            return [f"Title: {title}\nPlace ID: {place_id}"]
+        return []
+
+    def _build_sources(
+        self,
+        grounding_chunks: list[types.GroundingChunk],
+        supports: list[types.GroundingSupport],
+        initial_metadatas: list[tuple[int, str]],
+        resolved_uris_map: dict[str, str],
+    ) -> list["Source"]:
+        """Builds the sources with every support stored in full under each source it cites."""
+        populated_metadatas = self._get_source_metadatas(
+            grounding_chunks, initial_metadatas, resolved_uris_map
+        )
 
         # Create a mapping from each chunk index to the text segments it supports.
         chunk_index_to_segments: dict[int, list[types.Segment]] = {}
@@ -631,13 +1017,7 @@ class Filter:
             if meta.get("original_url") is not None:
                 valid_source_metadatas.append(meta)
 
-                content_parts: list[str] = []
-                chunk = grounding_chunks[i]
-
-                if maps_info := chunk.maps:
-                    title = maps_info.title or "N/A"
-                    place_id = maps_info.place_id or "N/A"
-                    content_parts.append(f"Title: {title}\nPlace ID: {place_id}")
+                content_parts = self._get_chunk_title_lines(grounding_chunks[i])
 
                 supported_segments = chunk_index_to_segments.get(i)
                 if supported_segments:
@@ -672,14 +1052,153 @@ class Filter:
                     "metadata": valid_source_metadatas,
                 }
             )
+        return sources_list
 
-        event: "ChatCompletionEvent" = {
-            "type": "chat:completion",
-            "data": {"sources": sources_list},
+    def _build_compact_sources(
+        self,
+        grounding_chunks: list[types.GroundingChunk],
+        supports: list[types.GroundingSupport],
+        initial_metadatas: list[tuple[int, str]],
+        resolved_uris_map: dict[str, str],
+    ) -> list["Source"]:
+        """
+        Builds the sources in compact form:
+        - Each support is stored once, under the first source it cites, with only the fields
+          the Manifold pipe reads and the tail of the segment text.
+        - Every source lists the `[start_index, end_index]` ranges of the segments it supports.
+        - Each snippet is written out only in the document of the first source that cites it,
+          other sources refer to that source by its citation number.
+        """
+        populated_metadatas = self._get_source_metadatas(
+            grounding_chunks, initial_metadatas, resolved_uris_map
+        )
+
+        # chunk index -> sorted unique (start, end, text) of the segments it supports.
+        chunk_index_to_snippets: dict[int, set[tuple[int, int, str]]] = {}
+        for support in supports:
+            segment = support.segment
+            indices = support.grounding_chunk_indices
+            if not (segment and segment.text and indices):
+                continue
+            start, end = segment.start_index or 0, segment.end_index or 0
+            valid_indices = [
+                index
+                for index in indices
+                if 0 <= index < len(populated_metadatas)
+                and populated_metadatas[index].get("original_url") is not None
+            ]
+            if not valid_indices:
+                continue
+            populated_metadatas[valid_indices[0]]["supports"].append(  # type: ignore
+                {
+                    "segment": {
+                        "start_index": start,
+                        "end_index": end,
+                        "text": segment.text[-COMPACT_SEGMENT_TAIL_CHARS:],
+                    },
+                    "grounding_chunk_indices": indices,
+                }
+            )
+            for index in valid_indices:
+                chunk_index_to_snippets.setdefault(index, set()).add(
+                    (start, end, segment.text)
+                )
+
+        valid_source_metadatas: list["SourceMetadata"] = []
+        documents: list[list[str]] = []
+        snippet_ranges_only: list[list[str]] = []
+        titles_only: list[list[str]] = []
+        # (start, end) of a snippet -> citation number of the first source that wrote it out.
+        written_snippets: dict[tuple[int, int], int] = {}
+
+        for i, meta in enumerate(populated_metadatas):
+            if meta.get("original_url") is None:
+                continue
+            snippets = sorted(chunk_index_to_snippets.get(i, ()))
+            meta["segments"] = [[start, end] for start, end, _ in snippets]  # type: ignore
+            valid_source_metadatas.append(meta)
+
+            content_parts = self._get_chunk_title_lines(grounding_chunks[i])
+            titles_only.append(list(content_parts))
+            range_parts = list(content_parts)
+            if snippets:
+                if content_parts:
+                    content_parts.append("")  # Add a blank line for separation
+                    range_parts.append("")
+                content_parts.append("Supported text snippets:")
+                range_parts.append("Supported text snippets:")
+                for start, end, text in snippets:
+                    if (start, end) in written_snippets:
+                        content_parts.append(
+                            f"- Same as in source [{written_snippets[(start, end)]}] (Indices: {start}-{end})"
+                        )
+                    else:
+                        written_snippets[(start, end)] = i + 1
+                        content_parts.append(f'- "{text}" (Indices: {start}-{end})')
+                    range_parts.append(f"- Indices: {start}-{end}")
+            documents.append(content_parts)
+            snippet_ranges_only.append(range_parts)
+
+        if not valid_source_metadatas:
+            return []
+
+        source: "Source" = {
+            "source": {"name": "web_search"},
+            "document": ["\n".join(parts) for parts in documents],
+            "metadata": valid_source_metadatas,
         }
-        await event_emitter(event)
-        log.info("Emitted sources event.")
-        log.trace("ChatCompletionEvent:", payload=event)
+        max_size = self.valves.COMPACT_SOURCES_MAX_SIZE_KB * 1024
+        if not max_size:
+            return [source]
+        # Fall back to smaller documents until the sources fit under the cap.
+        for fallback_documents, dropped in (
+            (snippet_ranges_only, "snippet texts"),
+            (titles_only, "snippet lists"),
+        ):
+            size = len(json.dumps([source], ensure_ascii=False).encode("utf-8"))
+            if size <= max_size:
+                break
+            log.warning(
+                f"Compact sources are {size / 1024:.1f} KB, over the {self.valves.COMPACT_SOURCES_MAX_SIZE_KB} KB cap. "
+                f"Dropping the {dropped} from the source documents."
+            )
+            source["document"] = ["\n".join(parts) for parts in fallback_documents]
+            if fallback_documents is titles_only:
+                for meta in valid_source_metadatas:
+                    meta.pop("segments", None)  # type: ignore
+        return [source]
+
+    def _start_source_urls_prefetch(
+        self, __request__: Request, __metadata__: dict[str, Any]
+    ) -> None:
+        """
+        Starts resolving the grounding source URLs that the pipe has handed off so far,
+        without waiting for them. The resolver caches the results, so the lookups in `outlet`
+        find them ready or join the ones still in flight.
+        """
+        uris_key = (
+            f"grounding_uris_{__metadata__.get('chat_id', '')}_{__metadata__.get('message_id', '')}"
+        )
+        uris: list[str] | None = __request__.app.state._state.pop(uris_key, None)
+        if not uris:
+            return
+        urls_to_resolve = [uri for uri in uris if uri.startswith(GROUNDING_REDIRECT_PREFIX)]
+        if not urls_to_resolve:
+            return
+
+        log.info(f"Prefetching {len(urls_to_resolve)} source URL(s) while the response streams.")
+        self.redirect_resolver.configure(
+            self.valves.URL_RESOLUTION_CONCURRENCY,
+            self.valves.URL_RESOLUTION_CACHE_TTL,
+        )
+
+        async def prefetch():
+            try:
+                await self.redirect_resolver.resolve_many(urls_to_resolve)
+            except Exception:
+                log.exception("Prefetching source URLs failed.")
+
+        self._start_background_task(prefetch())
 
     async def _emit_status_event_w_queries(
         self,
@@ -806,7 +1325,13 @@ class Filter:
                 log.exception("Error emitting status.")
 
         # Fire-and-forget the emission task.
-        asyncio.create_task(emit_task())
+        self._start_background_task(emit_task())
+
+    def _start_background_task(self, coro: Awaitable[None]) -> None:
+        """Runs `coro` without waiting for it, keeping a reference until it finishes."""
+        task = asyncio.ensure_future(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
 
     def _get_first_candidate(
         self, candidates: list[types.Candidate] | None
@@ -6,15 +6,15 @@ author: suurt8ll
 author_url: https://github.com/suurt8ll
 funding_url: https://github.com/suurt8ll/open_webui_functions
 license: MIT
-version: 1.26.0
+version: 1.27.0
 requirements: google-genai==1.49.0
 """
 
-VERSION = "1.26.0"
+VERSION = "1.27.0"
 # This is the recommended version for the companion filter.
 # Older versions might still work, but backward compatibility is not guaranteed
 # during the development of this personal use plugin.
-RECOMMENDED_COMPANION_VERSION = "1.7.0"
+RECOMMENDED_COMPANION_VERSION = "1.8.0"
 
 
 # Keys `title`, `id` and `description` in the frontmatter above are used for my own development purposes.
@@ -36,12 +36,14 @@ import json
 from urllib.parse import urlparse, parse_qs
 import xxhash
 import asyncio
+import bisect
 import aiofiles
 from aiocache import cached
 from aiocache.base import BaseCache
 from aiocache.serializers import NullSerializer
 from aiocache.backends.memory import SimpleMemoryCache
-from functools import cache
+from functools import cache, partial
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 from fastapi.datastructures import State
 import io
@@ -51,11 +53,12 @@ import base64
 import re
 import fnmatch
 import sys
+import weakref
 from loguru import logger
 from fastapi import Request
 import pydantic_core
 from pydantic import BaseModel, Field, field_validator
-from collections.abc import AsyncIterator, Awaitable, Callable
+from collections.abc import AsyncIterator, Awaitable, Callable, Coroutine
 from typing import (
     Any,
     Final,
@@ -65,6 +68,12 @@ from typing import (
     cast,
 )
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
 from open_webui.models.chats import Chats
 from open_webui.models.files import FileForm, Files
 from open_webui.storage.provider import Storage
@@ -126,6 +135,29 @@ FINISH_REASON_DESCRIPTIONS: Final = {
 # Finish reasons that are considered normal and do not require user notification.
 NORMAL_REASONS: Final = {types.FinishReason.STOP, types.FinishReason.MAX_TOKENS}
 
+# HTTP status codes for which a request can be retried on another backend.
+RETRYABLE_STATUS_CODES: Final = {429, 500, 503, 504}
+
+# Memory budget for decoded data URI images that are reused across conversation turns.
+DATA_URI_CACHE_MAX_BYTES: Final = 64 * 1024 * 1024
+DATA_URI_HEADER_PATTERN: Final = re.compile(r"data:(image/\w+);base64")
+# Memory budget for downscaled/re-encoded inline images.
+IMAGE_VARIANT_CACHE_MAX_BYTES: Final = 64 * 1024 * 1024
+# Stored in the image variant cache when re-encoding would not shrink an image,
+# so the original bytes are not kept a second time.
+KEEP_ORIGINAL_IMAGE: Final = "keep_original"
+
+# A run of citation markers, e.g. "[1][3]", inserted by the companion filter after a grounded segment.
+# Starting with a literal marker (instead of a repeated group) lets the regex engine skip ahead to each "[".
+CITATION_MARKER_RUN_PATTERN: Final = re.compile(r"\[\d+\](?:\[\d+\])*")
+
+# Rough input token estimate used to reserve tokens-per-minute budget when a pooled request is sent.
+ESTIMATED_CHARS_PER_TOKEN: Final = 4
+ESTIMATED_TOKENS_PER_MEDIA_PART: Final = 258
+
+# Admission lanes for requests: chat replies and background tasks (titles, tags, ...).
+RequestLane = Literal["interactive", "task"]
+
 # These tags will be "disabled" in the response, meaning that they will not be parsed by the backend.
 SPECIAL_TAGS_TO_DISABLE = [
     "details",
@@ -140,6 +172,23 @@ SPECIAL_TAGS_TO_DISABLE = [
     "|begin_of_solution|",
 ]
 ZWS = "\u200b"
+_SPECIAL_TAGS_ALTERNATION = "|".join(re.escape(tag) for tag in SPECIAL_TAGS_TO_DISABLE)
+# Finds '<' followed by an optional '/' and then one of the special tags.
+# The inner parentheses group the tags, so the optional '/' applies to all of them.
+SPECIAL_TAG_REGEX: Final = re.compile(rf"<(/?({_SPECIAL_TAGS_ALTERNATION}))")
+# Finds '<ZWS' followed by an optional '/' and then one of the special tags.
+DISABLED_SPECIAL_TAG_REGEX: Final = re.compile(rf"<{ZWS}(/?({_SPECIAL_TAGS_ALTERNATION}))")
+
+# Maximum number of media links in one text part that are resolved concurrently.
+MAX_CONCURRENT_URI_RESOLUTIONS: Final = 4
+
+# Minimum number of seconds between two status events sent for the same request.
+STATUS_COALESCE_WINDOW: Final = 0.25
+
+# Seconds between checks for frequently used Files API objects that are about to expire.
+HOT_FILE_SWEEP_INTERVAL: Final = 600
+# Files that have not been used for this many seconds are not refreshed anymore.
+HOT_FILE_IDLE_TIMEOUT: Final = 24 * 3600
 
 
 class GenaiApiError(Exception):
@@ -155,7 +204,14 @@ class FilesAPIError(Exception):
 
 
 class EventEmitter:
-    """A helper class to abstract web-socket event emissions to the front-end."""
+    """
+    A helper class to abstract web-socket event emissions to the front-end.
+
+    Status updates are coalesced: at most one status event is sent per
+    `STATUS_COALESCE_WINDOW`, and a status that is replaced by a newer one before it is sent
+    is dropped. Identical toasts are only sent once. Emissions run as background tasks that
+    are referenced until they finish; `flush` sends whatever is pending and waits for them.
+    """
 
     def __init__(
         self,
@@ -165,6 +221,20 @@ class EventEmitter:
     ):
         self.event_emitter = event_emitter
         self.hide_successful_status = hide_successful_status
+        self.pending_status: "StatusEvent | None" = None
+        # Scheduled send of `pending_status`, if one is waiting for the window to pass.
+        self.status_task: asyncio.Task | None = None
+        self.status_lock = asyncio.Lock()
+        self.last_status_sent = 0.0
+        self.sent_toasts: set[tuple[str, str]] = set()
+        self.tasks: set[asyncio.Task] = set()
+        # Emissions requested by the caller vs. events actually sent.
+        self.counters = {
+            "status_requested": 0,
+            "status_sent": 0,
+            "toast_requested": 0,
+            "toast_sent": 0,
+        }
 
     def emit_toast(
         self,
@@ -175,6 +245,12 @@ class EventEmitter:
         if not self.event_emitter:
             return
 
+        self.counters["toast_requested"] += 1
+        if (toastType, msg) in self.sent_toasts:
+            log.debug(f"Skipping duplicate toast: '{msg}'")
+            return
+        self.sent_toasts.add((toastType, msg))
+
         event: "NotificationEvent" = {
             "type": "notification",
             "data": {"type": toastType, "content": msg},
@@ -188,10 +264,11 @@ class EventEmitter:
                 # Re-check in case the event loop runs this later and state has changed.
                 if self.event_emitter:
                     await self.event_emitter(event)
+                    self.counters["toast_sent"] += 1
             except Exception:
                 log.exception("Error emitting toast notification.")
 
-        asyncio.create_task(send_toast())
+        self._track(asyncio.create_task(send_toast()))
 
     async def emit_status(
         self,
@@ -201,7 +278,7 @@ class EventEmitter:
         *,
         is_successful_finish: bool = False,
     ) -> None:
-        """Emit status updates asynchronously."""
+        """Queues a status update. It is sent in the background, or replaced if a newer one comes first."""
         if not self.event_emitter:
             return
 
@@ -215,13 +292,61 @@ class EventEmitter:
             "data": {"description": message, "done": done, "hidden": hidden},
         }
 
-        log.debug(f"Emitting status: '{message}'")
-        log.trace("Status payload:", payload=status_event)
+        self.counters["status_requested"] += 1
+        if self.pending_status:
+            log.trace(
+                f"Status '{self.pending_status['data']['description']}' was superseded before it was sent."
+            )
+        self.pending_status = status_event
+        if self.status_task is None:
+            delay = self.last_status_sent + STATUS_COALESCE_WINDOW - time.monotonic()
+            self.status_task = self._track(
+                asyncio.create_task(self._send_status_after(max(delay, 0)))
+            )
+
+    async def flush(self) -> None:
+        """Sends the pending status update right away and waits for all emissions in progress."""
+        await self._flush_status()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.counters["status_requested"] or self.counters["toast_requested"]:
+            log.debug("Event emission counts:", payload=self.counters)
+
+    async def _send_status_after(self, delay: float) -> None:
+        if delay:
+            await asyncio.sleep(delay)
+        # From here on, a new status update schedules a new send.
+        self.status_task = None
+        await self._send_pending_status()
+
+    async def _flush_status(self) -> None:
+        if self.status_task:
+            self.status_task.cancel()
+            self.status_task = None
+        await self._send_pending_status()
+
+    async def _send_pending_status(self) -> None:
+        # The lock keeps status events in order when a send is slower than the window.
+        async with self.status_lock:
+            status_event, self.pending_status = self.pending_status, None
+            if not (status_event and self.event_emitter):
+                return
+            self.last_status_sent = time.monotonic()
+
+            log.debug(f"Emitting status: '{status_event['data']['description']}'")
+            log.trace("Status payload:", payload=status_event)
 
-        try:
-            await self.event_emitter(status_event)
-        except Exception:
-            log.exception("Error emitting status.")
+            try:
+                await self.event_emitter(status_event)
+                self.counters["status_sent"] += 1
+            except Exception:
+                log.exception("Error emitting status.")
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        # The event loop only keeps weak references to tasks.
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
 
     async def emit_completion(
         self,
@@ -234,6 +359,8 @@ class EventEmitter:
         """Constructs and emits completion event."""
         if not self.event_emitter:
             return
+        # Status updates queued before this event are sent first.
+        await self._flush_status()
 
         emission: "ChatCompletionEvent" = {
             "type": "chat:completion",
@@ -355,6 +482,97 @@ class UploadStatusManager:
         await self.event_emitter.emit_status(message, done=is_done)
 
 
+class BoundedLRUCache:
+    """
+    Synchronous in-memory LRU cache bounded by the total size of its values.
+    Each entry's size is given by the caller. Values bigger than the whole budget are not stored.
+    Entries can optionally expire after a TTL in seconds.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        # key -> (value, size, monotonic expiry time or None)
+        self.entries: OrderedDict[str, tuple[Any, int, float | None]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            del self.entries[key]
+            self.size -= entry[1]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any, size: int, ttl: float | None = None) -> None:
+        if size > self.max_size:
+            return
+        if previous := self.entries.pop(key, None):
+            self.size -= previous[1]
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.entries[key] = (value, size, expires_at)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+class InflightUpload:
+    """
+    A file recovery/upload in progress and the requests waiting for it.
+
+    The task is shared, so its status updates and toasts go to the requests that are
+    currently waiting for it instead of the request that happened to start it.
+    """
+
+    def __init__(
+        self, start: Callable[["InflightUpload"], Coroutine[Any, Any, types.File]]
+    ):
+        # (event emitter, upload status queue) of every waiting request.
+        self.waiters: list[tuple[EventEmitter, asyncio.Queue | None]] = []
+        self.upload_started = False
+        self.task = asyncio.create_task(start(self))
+
+    def add_waiter(
+        self, event_emitter: EventEmitter, status_queue: asyncio.Queue | None
+    ) -> tuple[EventEmitter, asyncio.Queue | None]:
+        waiter = (event_emitter, status_queue)
+        self.waiters.append(waiter)
+        # A request that joins a running upload still counts it in its progress status.
+        if self.upload_started and status_queue:
+            status_queue.put_nowait(("REGISTER_UPLOAD",))
+        return waiter
+
+    def remove_waiter(self, waiter: tuple[EventEmitter, asyncio.Queue | None]) -> None:
+        self.waiters.remove(waiter)
+
+    def emit_toast(
+        self,
+        msg: str,
+        toastType: Literal["info", "success", "warning", "error"] = "info",
+    ) -> None:
+        for event_emitter, _ in self.waiters:
+            event_emitter.emit_toast(msg, toastType)
+
+    def report_upload_started(self) -> None:
+        self.upload_started = True
+        self._put_status(("REGISTER_UPLOAD",))
+
+    def report_upload_finished(self) -> None:
+        self._put_status(("COMPLETE_UPLOAD",))
+
+    def _put_status(self, message: tuple[str]) -> None:
+        for _, status_queue in self.waiters:
+            if status_queue:
+                status_queue.put_nowait(message)
+
+
 class FilesAPIManager:
     """
     Manages uploading, caching, and retrieving files using the Google Gemini Files API.
@@ -379,6 +597,10 @@ class FilesAPIManager:
         file_cache: SimpleMemoryCache,
         id_hash_cache: SimpleMemoryCache,
         event_emitter: EventEmitter,
+        cache_namespace: str = "",
+        inflight_uploads: dict[str, "InflightUpload"] | None = None,
+        hot_file_refresher: "HotFileRefresher | None" = None,
+        use_id: str | None = None,
     ):
         """
         Initializes the FilesAPIManager.
@@ -390,14 +612,24 @@ class FilesAPIManager:
             id_hash_cache: An aiocache instance for mapping `owui_file_id -> content_hash`.
                            This is an optimization to avoid re-hashing known files.
             event_emitter: An abstract class for emitting events to the front-end.
+            cache_namespace: Prefix for `file_cache` keys. Uploads are bound to the project of
+                             the API key, so clients using different keys must not share entries.
+            inflight_uploads: Registry of recoveries/uploads in progress, keyed like `file_cache`.
+                              Sharing it between managers lets concurrent requests wait on the
+                              same upload instead of starting their own.
+            hot_file_refresher: Optional tracker that is told about every file served to a request,
+                                so it can re-upload frequently used files before they expire.
+            use_id: Identifies the message the files are served for. The tracker counts a file
+                    at most once per message, even if it is served more than once for it.
         """
         self.client = client
         self.file_cache = file_cache
+        self.cache_namespace = cache_namespace
         self.id_hash_cache = id_hash_cache
         self.event_emitter = event_emitter
-        # A dictionary to manage locks for concurrent uploads.
-        # The key is the content_hash, the value is an asyncio.Lock.
-        self.upload_locks: dict[str, asyncio.Lock] = {}
+        self.inflight_uploads = inflight_uploads if inflight_uploads is not None else {}
+        self.hot_file_refresher = hot_file_refresher
+        self.use_id = use_id
 
     async def get_or_upload_file(
         self,
@@ -406,6 +638,7 @@ class FilesAPIManager:
         *,
         owui_file_id: str | None = None,
         status_queue: asyncio.Queue | None = None,
+        content_hash: str | None = None,
     ) -> types.File:
         """
         The main public method to get a file, using caching, recovery, or uploading.
@@ -420,6 +653,7 @@ class FilesAPIManager:
             owui_file_id: The unique ID of the file from Open WebUI, if available.
                           Used for logging and as a key for the hash cache optimization.
             status_queue: An optional asyncio.Queue to report upload lifecycle events.
+            content_hash: The content hash of `file_bytes`, if the caller already knows it.
 
         Returns:
             An `ACTIVE` `google.genai.types.File` object.
@@ -428,103 +662,177 @@ class FilesAPIManager:
             FilesAPIError: If the file fails to upload or process.
         """
         # Step 1: Get the fast content hash, using the ID cache as an optimization if possible.
-        content_hash = await self._get_content_hash(file_bytes, owui_file_id)
+        if not content_hash:
+            content_hash = await self._get_content_hash(file_bytes, owui_file_id)
+        cache_key = self._file_cache_key(content_hash)
 
         # Step 2: The Hot Path (Check Local File Cache)
         # A cache hit means the file is valid and we can return immediately.
-        cached_file: types.File | None = await self.file_cache.get(content_hash)
+        cached_file: types.File | None = await self.file_cache.get(cache_key)
         if cached_file:
             log_id = f"OWUI ID: {owui_file_id}" if owui_file_id else "anonymous file"
             log.debug(
                 f"Cache HIT for file hash {content_hash} ({log_id}). Returning immediately."
             )
+            self._record_access(content_hash, cached_file, mime_type, owui_file_id)
             return cached_file
 
-        # On cache miss, acquire a lock specific to this file's content to prevent race conditions.
-        # dict.setdefault is atomic, ensuring only one lock is created per hash.
-        lock = self.upload_locks.setdefault(content_hash, asyncio.Lock())
-        if lock.locked():
+        # On cache miss, join the recovery/upload of this file if one is already in progress
+        # (possibly started by another request), otherwise start one.
+        upload = self.inflight_uploads.get(cache_key)
+        if upload is None:
+            upload = InflightUpload(
+                partial(
+                    self._recover_or_upload,
+                    content_hash,
+                    file_bytes,
+                    mime_type,
+                    owui_file_id,
+                )
+            )
+            self.inflight_uploads[cache_key] = upload
+        else:
             log.debug(
-                f"Lock for hash {content_hash} is held by another task. "
-                f"This call will now wait for the lock to be released."
+                f"Upload for hash {content_hash} is already in progress. "
+                f"This call will now wait for it to finish."
             )
 
-        async with lock:
-            # Step 2.5: Double-Checked Locking
-            # After acquiring the lock, check the cache again. Another task might have
-            # completed the upload while we were waiting for the lock.
-            cached_file = await self.file_cache.get(content_hash)
-            if cached_file:
-                log.debug(
-                    f"Cache HIT for file hash {content_hash} after acquiring lock. Returning."
+        waiter = upload.add_waiter(self.event_emitter, status_queue)
+        try:
+            # Shielding lets the other waiters keep the upload alive if this request is cancelled.
+            active_file = await asyncio.shield(upload.task)
+        finally:
+            upload.remove_waiter(waiter)
+            if not upload.waiters and not upload.task.done():
+                log.info(
+                    f"No request is waiting for the upload of hash {content_hash} anymore. Cancelling it."
                 )
-                return cached_file
+                # Unregister it first, so a new request for this file starts a fresh upload
+                # instead of joining one that is being cancelled.
+                if self.inflight_uploads.get(cache_key) is upload:
+                    del self.inflight_uploads[cache_key]
+                upload.task.cancel()
+        self._record_access(content_hash, active_file, mime_type, owui_file_id)
+        return active_file
+
+    async def refresh_file(
+        self,
+        content_hash: str,
+        file_bytes: bytes,
+        mime_type: str,
+        owui_file_id: str | None = None,
+    ) -> types.File:
+        """
+        Uploads a fresh copy of a file that is already cached and replaces the cache entry with it.
 
-            # Step 3: The Warm/Cold Path (On Cache Miss)
-            deterministic_name = f"files/owui-v1-{content_hash}"
-            log.debug(
-                f"Cache MISS for hash {content_hash}. Attempting stateless recovery with GET: {deterministic_name}"
+        The deterministic name is still taken by the current copy until it expires, so the new copy
+        gets a versioned name. Requests keep using the current copy until the new one is `ACTIVE`.
+        """
+        versioned_name = f"files/owui-v1-{content_hash}-r{int(time.time()) // 60:x}"
+        return await self._upload_and_process_file(
+            content_hash, file_bytes, mime_type, versioned_name, owui_file_id
+        )
+
+    def _record_access(
+        self,
+        content_hash: str,
+        file: types.File,
+        mime_type: str,
+        owui_file_id: str | None,
+    ) -> None:
+        # Only files stored in Open WebUI can be read again later for a refresh.
+        if self.hot_file_refresher and owui_file_id:
+            self.hot_file_refresher.record_access(
+                self.client,
+                self.cache_namespace,
+                content_hash,
+                file,
+                mime_type,
+                owui_file_id,
+                self.use_id,
             )
 
-            try:
-                # Attempt to get the file (Warm Path)
-                file = await self.client.aio.files.get(name=deterministic_name)
-                if not file.name:
-                    raise FilesAPIError(
-                        f"Stateless recovery for {deterministic_name} returned a file without a name."
-                    )
+    async def _recover_or_upload(
+        self,
+        content_hash: str,
+        file_bytes: bytes,
+        mime_type: str,
+        owui_file_id: str | None,
+        upload: InflightUpload,
+    ) -> types.File:
+        """Recovers the file by its deterministic name or uploads it. Runs once per hash at a time."""
+        cache_key = self._file_cache_key(content_hash)
 
-                log.debug(
-                    f"Stateless recovery successful for {deterministic_name}. File exists on server."
+        # Step 3: The Warm/Cold Path (On Cache Miss)
+        deterministic_name = f"files/owui-v1-{content_hash}"
+        log.debug(
+            f"Cache MISS for hash {content_hash}. Attempting stateless recovery with GET: {deterministic_name}"
+        )
+
+        try:
+            # Another upload of this file might have finished right before this one was started.
+            if cached_file := await self.file_cache.get(cache_key):
+                return cached_file
+
+            # Attempt to get the file (Warm Path)
+            file = await self.client.aio.files.get(name=deterministic_name)
+            if not file.name:
+                raise FilesAPIError(
+                    f"Stateless recovery for {deterministic_name} returned a file without a name."
                 )
-                active_file = await self._poll_for_active_state(file.name, owui_file_id)
 
-                ttl_seconds = self._calculate_ttl(active_file.expiration_time)
-                await self.file_cache.set(content_hash, active_file, ttl=ttl_seconds)
+            log.debug(
+                f"Stateless recovery successful for {deterministic_name}. File exists on server."
+            )
+            active_file = await self._poll_for_active_state(
+                file.name, owui_file_id, upload
+            )
 
-                return active_file
-            except genai_errors.ClientError as e:
-                if e.code == 403:  # "Not found" signal from the API.
-                    log.info(
-                        f"File {deterministic_name} not found on server (received 403). Proceeding to upload."
-                    )
-                    # Proceed to upload (Cold Path)
-                    return await self._upload_and_process_file(
-                        content_hash,
-                        file_bytes,
-                        mime_type,
-                        deterministic_name,
-                        owui_file_id,
-                        status_queue,
-                    )
-                else:
-                    log.exception(
-                        f"A non-403 client error occurred during stateless recovery for {deterministic_name}."
-                    )
-                    self.event_emitter.emit_toast(
-                        f"API error for file: {e.code}. Please check permissions.",
-                        "error",
-                    )
-                    raise FilesAPIError(
-                        f"Failed to check file status for {deterministic_name}: {e}"
-                    ) from e
-            except Exception as e:
+            ttl_seconds = self._calculate_ttl(active_file.expiration_time)
+            await self.file_cache.set(cache_key, active_file, ttl=ttl_seconds)
+
+            return active_file
+        except genai_errors.ClientError as e:
+            if e.code == 403:  # "Not found" signal from the API.
+                log.info(
+                    f"File {deterministic_name} not found on server (received 403). Proceeding to upload."
+                )
+                # Proceed to upload (Cold Path)
+                return await self._upload_and_process_file(
+                    content_hash,
+                    file_bytes,
+                    mime_type,
+                    deterministic_name,
+                    owui_file_id,
+                    upload,
+                )
+            else:
                 log.exception(
-                    f"An unexpected error occurred during stateless recovery for {deterministic_name}."
+                    f"A non-403 client error occurred during stateless recovery for {deterministic_name}."
                 )
-                self.event_emitter.emit_toast(
-                    "Unexpected error retrieving a file. Please try again.",
+                upload.emit_toast(
+                    f"API error for file: {e.code}. Please check permissions.",
                     "error",
                 )
                 raise FilesAPIError(
                     f"Failed to check file status for {deterministic_name}: {e}"
                 ) from e
-            finally:
-                # Clean up the lock from the dictionary once processing is complete
-                # for this hash, preventing memory growth over time.
-                # This is safe because any future request for this hash will hit the cache.
-                if content_hash in self.upload_locks:
-                    del self.upload_locks[content_hash]
+        except Exception as e:
+            log.exception(
+                f"An unexpected error occurred during stateless recovery for {deterministic_name}."
+            )
+            upload.emit_toast(
+                "Unexpected error retrieving a file. Please try again.",
+                "error",
+            )
+            raise FilesAPIError(
+                f"Failed to check file status for {deterministic_name}: {e}"
+            ) from e
+        finally:
+            # The registry only holds uploads in progress; finished ones are served from the cache.
+            # A cancelled upload may already have been replaced by a new one.
+            if self.inflight_uploads.get(cache_key) is upload:
+                del self.inflight_uploads[cache_key]
 
     async def _get_content_hash(
         self, file_bytes: bytes, owui_file_id: str | None
@@ -547,7 +855,7 @@ class FilesAPIManager:
         log.trace(
             f"Hash cache MISS for OWUI ID {owui_file_id if owui_file_id else 'N/A'}. Computing hash."
         )
-        content_hash = xxhash.xxh64(file_bytes).hexdigest()
+        content_hash = self.compute_content_hash(file_bytes)
 
         # If there was an ID, store the newly computed hash for next time.
         if owui_file_id:
@@ -555,6 +863,14 @@ class FilesAPIManager:
 
         return content_hash
 
+    @staticmethod
+    def compute_content_hash(file_bytes: bytes) -> str:
+        """The hash that identifies file contents in the caches and in deterministic file names."""
+        return xxhash.xxh64(file_bytes).hexdigest()
+
+    def _file_cache_key(self, content_hash: str) -> str:
+        return f"{self.cache_namespace}:{content_hash}" if self.cache_namespace else content_hash
+
     def _calculate_ttl(self, expiration_time: datetime | None) -> float | None:
         """Calculates the TTL in seconds from an expiration datetime."""
         if not expiration_time:
@@ -573,13 +889,16 @@ class FilesAPIManager:
         mime_type: str,
         deterministic_name: str,
         owui_file_id: str | None,
-        status_queue: asyncio.Queue | None = None,
+        upload: InflightUpload | None = None,
     ) -> types.File:
-        """Handles the full upload and post-upload processing workflow."""
+        """
+        Handles the full upload and post-upload processing workflow.
+        Status updates and toasts go to the waiters of `upload`, or to this manager's emitter without one.
+        """
 
-        # Register with the manager that an actual upload is starting.
-        if status_queue:
-            await status_queue.put(("REGISTER_UPLOAD",))
+        # Register with the status managers that an actual upload is starting.
+        if upload:
+            upload.report_upload_started()
 
         log.info(f"Starting upload for {deterministic_name}...")
 
@@ -611,13 +930,15 @@ class FilesAPIManager:
                     f"{uploaded_file.name} uploaded with state {uploaded_file.state}. Polling for ACTIVE state."
                 )
                 active_file = await self._poll_for_active_state(
-                    uploaded_file.name, owui_file_id
+                    uploaded_file.name, owui_file_id, upload
                 )
                 log.debug(f"File {active_file.name} is now ACTIVE.")
 
             # Calculate TTL and set in the main file cache using the content hash as the key.
             ttl_seconds = self._calculate_ttl(active_file.expiration_time)
-            await self.file_cache.set(content_hash, active_file, ttl=ttl_seconds)
+            await self.file_cache.set(
+                self._file_cache_key(content_hash), active_file, ttl=ttl_seconds
+            )
             log.debug(
                 f"Cached new file object for hash {content_hash} with TTL: {ttl_seconds}s."
             )
@@ -625,21 +946,22 @@ class FilesAPIManager:
             return active_file
         except Exception as e:
             log.exception(f"File upload or processing failed for {deterministic_name}.")
-            self.event_emitter.emit_toast(
+            (upload or self.event_emitter).emit_toast(
                 "Upload failed for a file. Please check connection and try again.",
                 "error",
             )
             raise FilesAPIError(f"Upload failed for {deterministic_name}: {e}") from e
         finally:
-            # Report completion (success or failure) to the status manager.
+            # Report completion (success or failure) to the status managers.
             # This ensures the progress counter always advances.
-            if status_queue:
-                await status_queue.put(("COMPLETE_UPLOAD",))
+            if upload:
+                upload.report_upload_finished()
 
     async def _poll_for_active_state(
         self,
         file_name: str,
         owui_file_id: str | None,
+        upload: InflightUpload | None = None,
         timeout: int = 60,
         poll_interval: int = 1,
     ) -> types.File:
@@ -664,7 +986,7 @@ class FilesAPIManager:
                     error_message += f" {reason}"
                     toast_message += f" Reason: {file.error.message}"
 
-                self.event_emitter.emit_toast(toast_message, "error")
+                (upload or self.event_emitter).emit_toast(toast_message, "error")
                 raise FilesAPIError(error_message)
 
             state_name = file.state.name if file.state else "UNKNOWN"
@@ -678,6 +1000,175 @@ class FilesAPIManager:
         )
 
 
+class HotFile:
+    """A Files API object tracked by `HotFileRefresher` and what is needed to upload it again."""
+
+    def __init__(
+        self,
+        client: genai.Client,
+        cache_namespace: str,
+        content_hash: str,
+        mime_type: str,
+        owui_file_id: str,
+        expiration_time: datetime,
+    ):
+        self.client = client
+        self.cache_namespace = cache_namespace
+        self.content_hash = content_hash
+        self.mime_type = mime_type
+        self.owui_file_id = owui_file_id
+        self.expiration_time = expiration_time
+        # Uses of the current copy of the file, counted once per message.
+        self.uses = 0
+        self.last_use_id: str | None = None
+        self.last_used = time.monotonic()
+
+
+class HotFileRefresher:
+    """
+    Re-uploads frequently used Files API objects before they expire.
+
+    Files API objects are deleted by Google 48 hours after upload, and the first request that
+    needs an expired file has to upload it again. The refresher is told about every file that
+    is served to a request. A background sweep uploads a fresh copy of each file that was used
+    often enough, is still in use and expires within the lead time, then swaps the entry in the
+    file cache, so requests keep getting a valid file without waiting for an upload.
+
+    File bytes are not kept in memory; they are read from Open WebUI's storage when needed.
+    """
+
+    def __init__(self, file_cache: SimpleMemoryCache, id_hash_cache: SimpleMemoryCache):
+        self.file_cache = file_cache
+        self.id_hash_cache = id_hash_cache
+        self.enabled = False
+        self.min_uses = 2
+        self.lead_time = 6 * 3600
+        # Keyed like the file cache.
+        self.files: dict[str, HotFile] = {}
+        self.sweep_task: asyncio.Task | None = None
+        self.refreshed = 0
+        self.failed = 0
+
+    def configure(self, enabled: bool, min_uses: int, lead_time_hours: int) -> None:
+        """Applies the current settings. Disabling stops tracking and the background sweep."""
+        self.enabled = enabled
+        self.min_uses = min_uses
+        self.lead_time = lead_time_hours * 3600
+        if not enabled:
+            self.files.clear()
+            if self.sweep_task:
+                self.sweep_task.cancel()
+
+    def record_access(
+        self,
+        client: genai.Client,
+        cache_namespace: str,
+        content_hash: str,
+        file: types.File,
+        mime_type: str,
+        owui_file_id: str,
+        use_id: str | None = None,
+    ) -> None:
+        """
+        Counts a use of `file` and starts the background sweep if it is not running.
+        Repeated accesses with the same `use_id` (e.g. the pre-upload and the request
+        of one message) count as a single use.
+        """
+        if not self.enabled or not file.expiration_time:
+            return
+        cache_key = f"{cache_namespace}:{content_hash}" if cache_namespace else content_hash
+        hot_file = self.files.get(cache_key)
+        if hot_file is None or hot_file.expiration_time != file.expiration_time:
+            # A new file, or a new copy of it. Uses are counted per copy.
+            hot_file = HotFile(
+                client,
+                cache_namespace,
+                content_hash,
+                mime_type,
+                owui_file_id,
+                file.expiration_time,
+            )
+            self.files[cache_key] = hot_file
+        if use_id is None or use_id != hot_file.last_use_id:
+            hot_file.uses += 1
+            hot_file.last_use_id = use_id
+        hot_file.last_used = time.monotonic()
+
+        if self.sweep_task is None:
+            self.sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def sweep(self) -> None:
+        """Refreshes the tracked files that are due and forgets the ones that are no longer used."""
+        now = datetime.now(timezone.utc)
+        for cache_key, hot_file in list(self.files.items()):
+            if (
+                hot_file.expiration_time <= now
+                or time.monotonic() - hot_file.last_used > HOT_FILE_IDLE_TIMEOUT
+            ):
+                del self.files[cache_key]
+                continue
+            if (
+                hot_file.uses < self.min_uses
+                or (hot_file.expiration_time - now).total_seconds() > self.lead_time
+            ):
+                continue
+            await self._refresh(cache_key, hot_file)
+
+    async def _sweep_loop(self) -> None:
+        try:
+            while self.files:
+                await asyncio.sleep(HOT_FILE_SWEEP_INTERVAL)
+                try:
+                    await self.sweep()
+                except Exception:
+                    log.exception("Hot file sweep failed.")
+        finally:
+            self.sweep_task = None
+
+    async def _refresh(self, cache_key: str, hot_file: HotFile) -> None:
+        log.info(
+            f"Refreshing file {hot_file.content_hash} (OWUI ID: {hot_file.owui_file_id}), "
+            f"used {hot_file.uses} time(s), expires at {hot_file.expiration_time.isoformat()}."
+        )
+        try:
+            file_bytes, _ = await GeminiContentBuilder._get_file_data(hot_file.owui_file_id)
+            if not file_bytes:
+                raise FilesAPIError("The file is no longer available in Open WebUI.")
+            if FilesAPIManager.compute_content_hash(file_bytes) != hot_file.content_hash:
+                raise FilesAPIError("The file content has changed since it was uploaded.")
+            manager = FilesAPIManager(
+                client=hot_file.client,
+                file_cache=self.file_cache,
+                id_hash_cache=self.id_hash_cache,
+                event_emitter=EventEmitter(None),
+                cache_namespace=hot_file.cache_namespace,
+            )
+            new_file = await manager.refresh_file(
+                hot_file.content_hash,
+                file_bytes,
+                hot_file.mime_type,
+                hot_file.owui_file_id,
+            )
+        except Exception as e:
+            self.failed += 1
+            # Stop tracking it; the next request that uses the file starts over.
+            self.files.pop(cache_key, None)
+            log.warning(f"Refresh of file {hot_file.content_hash} failed: {e}")
+            return
+
+        self.refreshed += 1
+        if new_file.expiration_time:
+            # Uses are counted again for the new copy.
+            hot_file.expiration_time = new_file.expiration_time
+            hot_file.uses = 0
+        else:
+            self.files.pop(cache_key, None)
+        log.info(
+            f"Refreshed file {hot_file.content_hash} as {new_file.name} "
+            f"(refreshed: {self.refreshed}, failed: {self.failed})."
+        )
+
+
 class GeminiContentBuilder:
     """Builds a list of `google.genai.types.Content` objects from the OWUI's body payload."""
 
@@ -689,6 +1180,8 @@ class GeminiContentBuilder:
         event_emitter: EventEmitter,
         valves: "Pipe.Valves",
         files_api_manager: "FilesAPIManager",
+        data_uri_cache: BoundedLRUCache | None = None,
+        image_variant_cache: BoundedLRUCache | None = None,
     ):
         self.messages_body = messages_body
         self.upload_documents = (metadata_body.get("features", {}) or {}).get(
@@ -697,6 +1190,11 @@ class GeminiContentBuilder:
         self.event_emitter = event_emitter
         self.valves = valves
         self.files_api_manager = files_api_manager
+        # Maps data URI digest -> (bytes, mime type, content hash), shared between requests.
+        self.data_uri_cache = data_uri_cache
+        # Maps content hash + optimization settings -> (bytes, mime type) of the image to send.
+        self.image_variant_cache = image_variant_cache
+        self.inline_image_bytes_saved = 0
         self.is_temp_chat = metadata_body.get("chat_id") == "local"
         self.vertexai = self.files_api_manager.client.vertexai
 
@@ -730,7 +1228,12 @@ class GeminiContentBuilder:
             for i, message in enumerate(self.messages_body)
         ]
         log.debug(f"Starting concurrent processing of {len(tasks)} message turns.")
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            # The request was aborted. The turns (and their uploads) are cancelled by gather.
+            manager_task.cancel()
+            raise
 
         # 3. Signal to the manager that no more uploads will be registered.
         await status_manager.queue.put(("FINALIZE",))
@@ -738,6 +1241,11 @@ class GeminiContentBuilder:
         # 4. Wait for the manager to finish processing all reported uploads.
         await manager_task
 
+        if self.inline_image_bytes_saved:
+            log.info(
+                f"Inline image optimization saved {self.inline_image_bytes_saved:,} bytes in this request."
+            )
+
         # 5. Filter and assemble the final contents list.
         contents: list[types.Content] = []
         for i, res in enumerate(results):
@@ -983,14 +1491,11 @@ class GeminiContentBuilder:
             file_bytes: bytes | None = None
             mime_type: str | None = None
             owui_file_id: str | None = None
+            content_hash: str | None = None
 
             # Step 1: Extract bytes and mime_type from the URI if applicable
             if uri.startswith("data:image"):
-                match = re.match(r"data:(image/\w+);base64,(.+)", uri)
-                if not match:
-                    raise ValueError("Invalid data URI for image.")
-                mime_type, base64_data = match.group(1), match.group(2)
-                file_bytes = base64.b64decode(base64_data)
+                file_bytes, mime_type, content_hash = self._decode_image_data_uri(uri)
             elif uri.startswith("/api/v1/files/"):
                 log.info(f"Processing local API file URI: {uri}")
                 file_id = uri.split("/")[4]
@@ -1036,6 +1541,7 @@ class GeminiContentBuilder:
                         mime_type=mime_type,
                         owui_file_id=owui_file_id,
                         status_queue=status_queue,
+                        content_hash=content_hash,
                     )
                     return types.Part(
                         file_data=types.FileData(
@@ -1047,6 +1553,10 @@ class GeminiContentBuilder:
                     log.info(
                         f"Sending raw bytes because {reason}. Resource from URI: {uri[:64]}..."
                     )
+                    if self.valves.INLINE_IMAGE_OPTIMIZATION and mime_type.startswith("image/"):
+                        file_bytes, mime_type = await self._optimize_inline_image(
+                            file_bytes, mime_type, content_hash
+                        )
                     return types.Part.from_bytes(data=file_bytes, mime_type=mime_type)
 
             return None  # Return None if bytes/mime_type could not be determined
@@ -1060,6 +1570,110 @@ class GeminiContentBuilder:
             log.exception(f"Error processing URI: {uri[:64]}[...]")
             return None
 
+    async def _optimize_inline_image(
+        self, image_bytes: bytes, mime_type: str, content_hash: str | None
+    ) -> tuple[bytes, str]:
+        """
+        Downscales and re-encodes an image according to the INLINE_IMAGE_* valves.
+        Returns the original image if Pillow is missing, the image is animated or cannot be
+        decoded, or the result would not be smaller. Results are cached by content hash and settings.
+        """
+        if Image is None:
+            log.warning("INLINE_IMAGE_OPTIMIZATION is enabled but Pillow is not installed. Sending images as-is.")
+            return image_bytes, mime_type
+
+        settings = (
+            self.valves.INLINE_IMAGE_MAX_EDGE,
+            self.valves.INLINE_IMAGE_MAX_PIXELS,
+            self.valves.INLINE_IMAGE_FORMAT,
+            self.valves.INLINE_IMAGE_QUALITY,
+        )
+        content_hash = content_hash or FilesAPIManager.compute_content_hash(image_bytes)
+        variant_key = f"{content_hash}:{':'.join(map(str, settings))}"
+        cached = self.image_variant_cache.get(variant_key) if self.image_variant_cache is not None else None
+        if cached == KEEP_ORIGINAL_IMAGE:
+            log.trace(f"Image variant cache HIT for hash {content_hash} (original kept).")
+            return image_bytes, mime_type
+        if cached:
+            log.trace(f"Image variant cache HIT for hash {content_hash}.")
+            variant = cached
+        else:
+            try:
+                optimized = await asyncio.to_thread(
+                    self._resize_and_encode_image, image_bytes, *settings
+                )
+            except Exception:
+                log.exception(f"Could not optimize image with hash {content_hash}. Sending it as-is.")
+                optimized = None
+            if optimized and len(optimized[0]) < len(image_bytes):
+                variant = optimized
+                saved = len(image_bytes) - len(optimized[0])
+                log.info(
+                    f"Optimized inline image {content_hash}: {len(image_bytes):,} -> "
+                    f"{len(optimized[0]):,} bytes ({saved / len(image_bytes):.0%} saved)."
+                )
+            else:
+                # Only remember the decision; the caller already holds the original bytes.
+                if self.image_variant_cache is not None:
+                    self.image_variant_cache.set(variant_key, KEEP_ORIGINAL_IMAGE, size=len(KEEP_ORIGINAL_IMAGE))
+                return image_bytes, mime_type
+            if self.image_variant_cache is not None:
+                self.image_variant_cache.set(variant_key, variant, size=len(variant[0]))
+
+        self.inline_image_bytes_saved += len(image_bytes) - len(variant[0])
+        return variant
+
+    @staticmethod
+    def _resize_and_encode_image(
+        image_bytes: bytes, max_edge: int, max_pixels: int, image_format: str, quality: int
+    ) -> tuple[bytes, str] | None:
+        """CPU-bound part of `_optimize_inline_image`, meant to run in a worker thread."""
+        assert Image is not None and ImageOps is not None
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            scale = min(1.0, max_edge / max(width, height), (max_pixels / (width * height)) ** 0.5)
+            if scale < 1.0:
+                new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+            has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+            if image_format == "webp" and has_alpha:
+                image = image.convert("RGBA")
+            else:
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format=image_format.upper(), quality=quality)
+            return output.getvalue(), f"image/{image_format}"
+
+    def _decode_image_data_uri(self, uri: str) -> tuple[bytes, str, str]:
+        """
+        Decodes a base64 image data URI into `(bytes, mime_type, content_hash)`.
+        Pasted images are sent again with every turn of the conversation, so results
+        are cached by a digest of the whole URI to skip decoding and hashing next time.
+        """
+        uri_digest = xxhash.xxh3_128_hexdigest(uri.encode())
+        if self.data_uri_cache is not None and (decoded := self.data_uri_cache.get(uri_digest)):
+            log.trace(f"Data URI cache HIT for digest {uri_digest}.")
+            return decoded
+
+        header, separator, base64_data = uri.partition(",")
+        match = DATA_URI_HEADER_PATTERN.fullmatch(header)
+        if not (separator and match):
+            raise ValueError("Invalid data URI for image.")
+        file_bytes = base64.b64decode(base64_data)
+        decoded = (
+            file_bytes,
+            match.group(1),
+            FilesAPIManager.compute_content_hash(file_bytes),
+        )
+        if self.data_uri_cache is not None:
+            self.data_uri_cache.set(uri_digest, decoded, size=len(file_bytes))
+        return decoded
+
     def _genai_part_from_youtube_uri(self, uri: str) -> types.Part | None:
         """Creates a Gemini Part from a YouTube URL, with optional video metadata.
 
@@ -1215,19 +1829,8 @@ class GeminiContentBuilder:
         if not text:
             return ""
 
-        # The regex finds '<ZWS' followed by an optional '/' and then one of the special tags.
-        # The inner parentheses group the tags, so the optional '/' applies to all of them.
-        REVERSE_TAG_REGEX = re.compile(
-            r"<"
-            + ZWS
-            + r"(/?"
-            + "("
-            + "|".join(re.escape(tag) for tag in SPECIAL_TAGS_TO_DISABLE)
-            + ")"
-            + r")"
-        )
         # The substitution restores the original tag, e.g., '<ZWS/think' becomes '</think'.
-        restored_text, count = REVERSE_TAG_REGEX.subn(r"<\1", text)
+        restored_text, count = DISABLED_SPECIAL_TAG_REGEX.subn(r"<\1", text)
         if count > 0:
             log.debug(f"Re-enabled {count} special tag(s) for model context.")
 
@@ -1240,29 +1843,18 @@ class GeminiContentBuilder:
             return []
 
         text = self._enable_special_tags(text)
-        parts: list[types.Part] = []
-        last_pos = 0
-
-        # Conditionally build a regex to find media links.
-        # If YouTube parsing is disabled, the regex will only find markdown image links,
-        # leaving YouTube URLs to be treated as plain text.
-        markdown_part = r"!\[.*?\]\(([^)]+)\)"  # Group 1: Markdown URI
-        youtube_part = r"(https?://(?:(?:www|music)\.)?youtube\.com/(?:watch\?v=|shorts/|live/)[^\s)]+|https?://youtu\.be/[^\s)]+)"  # Group 2: YouTube URL
-        if self.valves.PARSE_YOUTUBE_URLS:
-            pattern = re.compile(f"{markdown_part}|{youtube_part}")
-            process_youtube = True
-        else:
-            pattern = re.compile(markdown_part)
-            process_youtube = False
+        process_youtube = self.valves.PARSE_YOUTUBE_URLS
+        if not process_youtube:
             log.info(
                 "YouTube URL parsing is disabled. URLs will be treated as plain text."
             )
+        pattern = self._get_media_link_pattern(process_youtube)
 
+        # First split the text into text segments and media URIs, keeping their order.
+        segments: list[types.Part | str | None] = []
+        uri_slots: list[tuple[int, str]] = []
+        last_pos = 0
         for match in pattern.finditer(text):
-            # Add the text segment that precedes the media link
-            if text_segment := text[last_pos : match.start()].strip():
-                parts.append(types.Part.from_text(text=text_segment))
-
             # The URI is in group 1 for markdown, or group 2 for YouTube.
             if process_youtube:
                 uri = match.group(1) or match.group(2)
@@ -1275,12 +1867,29 @@ class GeminiContentBuilder:
                 )
                 continue
 
-            # Delegate all URI processing to the unified helper
-            if media_part := await self._genai_part_from_uri(uri, status_queue):
-                parts.append(media_part)
-
+            # Add the text segment that precedes the media link
+            if text_segment := text[last_pos : match.start()].strip():
+                segments.append(types.Part.from_text(text=text_segment))
+            uri_slots.append((len(segments), uri))
+            segments.append(uri)
             last_pos = match.end()
 
+        # Then resolve all URIs concurrently. Each resolved part replaces its URI in place.
+        if uri_slots:
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_URI_RESOLUTIONS)
+
+            async def resolve(uri: str) -> types.Part | None:
+                async with semaphore:
+                    return await self._genai_part_from_uri(uri, status_queue)
+
+            media_parts = await asyncio.gather(*(resolve(uri) for _, uri in uri_slots))
+            for (index, _), media_part in zip(uri_slots, media_parts):
+                segments[index] = media_part
+
+        parts: list[types.Part] = [
+            segment for segment in segments if isinstance(segment, types.Part)
+        ]
+
         # Add any remaining text after the last media link
         if remaining_text := text[last_pos:].strip():
             parts.append(types.Part.from_text(text=remaining_text))
@@ -1291,6 +1900,20 @@ class GeminiContentBuilder:
 
         return parts
 
+    @staticmethod
+    @cache
+    def _get_media_link_pattern(parse_youtube_urls: bool) -> re.Pattern[str]:
+        """
+        Returns the regex for media links, compiled once per configuration.
+        If YouTube parsing is disabled, the regex will only find markdown image links,
+        leaving YouTube URLs to be treated as plain text.
+        """
+        markdown_part = r"!\[.*?\]\(([^)]+)\)"  # Group 1: Markdown URI
+        youtube_part = r"(https?://(?:(?:www|music)\.)?youtube\.com/(?:watch\?v=|shorts/|live/)[^\s)]+|https?://youtu\.be/[^\s)]+)"  # Group 2: YouTube URL
+        if parse_youtube_urls:
+            return re.compile(f"{markdown_part}|{youtube_part}")
+        return re.compile(markdown_part)
+
     @staticmethod
     async def _get_file_data(file_id: str) -> tuple[bytes | None, str | None]:
         """
@@ -1373,46 +1996,694 @@ class GeminiContentBuilder:
             return None, content_type
 
     @staticmethod
-    def _remove_citation_markers(text: str, sources: list["Source"]) -> str:
-        original_text = text
-        processed: set[str] = set()
-        for source in sources:
-            supports = [
-                metadata["supports"]
-                for metadata in source.get("metadata", [])
-                if "supports" in metadata
-            ]
-            supports = [item for sublist in supports for item in sublist]
-            for support in supports:
-                support = types.GroundingSupport(**support)
-                indices = support.grounding_chunk_indices
-                segment = support.segment
-                if not (indices and segment):
-                    continue
-                segment_text = segment.text
-                if not segment_text:
-                    continue
-                # Using a shortened version because user could edit the assistant message in the front-end.
-                # If citation segment get's edited, then the markers would not be removed. Shortening reduces the
-                # chances of this happening.
-                segment_end = segment_text[-32:]
-                if segment_end in processed:
-                    continue
-                processed.add(segment_end)
-                citation_markers = "".join(f"[{index + 1}]" for index in indices)
-                # Find the position of the citation markers in the text
-                pos = text.find(segment_text + citation_markers)
-                if pos != -1:
-                    # Remove the citation markers
-                    text = (
-                        text[: pos + len(segment_text)]
-                        + text[pos + len(segment_text) + len(citation_markers) :]
-                    )
-        trim = len(original_text) - len(text)
-        log.debug(
-            f"Citation removal finished. Returning text str that is {trim} character shorter than the original input."
-        )
-        return text
+    def _remove_citation_markers(text: str, sources: list["Source"]) -> str:
+        """
+        Removes the citation markers that were inserted after the grounded segments of a response.
+
+        Supports can overlap: a support may cover several sentences that carry markers of their own,
+        and supports that end at the same offset share one marker run, e.g. `zeta.[1][2]`.
+        Each support claims its own markers inside the run that follows its segment, and the
+        claimed spans are removed with a single join in the order of their position. Supports are
+        visited by segment end, so every search can start close to the previous match. Segments
+        that contain the markers of other supports are searched for in a view of the text without
+        marker runs, which is only built when such a segment is found.
+        """
+        # The same support is stored under every source it cites, so collect the unique ones first.
+        # Supports are read from the stored dicts directly; validating them into models is costly.
+        unique_supports: dict[tuple, tuple[int, list[int], str]] = {}
+        for source in sources:
+            for metadata in source.get("metadata", []):
+                for support in metadata.get("supports", []):
+                    segment = support.get("segment") or {}
+                    indices = support.get("grounding_chunk_indices")
+                    segment_text = segment.get("text")
+                    if not (indices and segment_text):
+                        continue
+                    # Using a shortened version because user could edit the assistant message in the front-end.
+                    # If citation segment get's edited, then the markers would not be removed. Shortening reduces the
+                    # chances of this happening.
+                    segment_end = segment_text[-32:]
+                    # Different supports can share the tail and the cited chunks (e.g. a sentence and
+                    # the paragraph it ends), so the segment offsets are part of the key.
+                    end_index = segment.get("end_index")
+                    key = (segment.get("start_index"), end_index, segment_end, tuple(indices))
+                    if key not in unique_supports:
+                        unique_supports[key] = (end_index or 0, indices, segment_text)
+
+        # Marker spans to remove and the spans already claimed inside each marker run.
+        removals: list[tuple[int, int]] = []
+        claimed: dict[int, list[tuple[int, int]]] = {}
+        stripped_view: tuple[str, list[int], list[int]] | None = None
+        previous_end = 0
+        previous_stripped_end = 0
+        for _, indices, segment_text in sorted(
+            unique_supports.values(), key=lambda item: item[0]
+        ):
+            citation_markers = "".join(f"[{index + 1}]" for index in indices)
+            # Segments are visited by their end, so this segment cannot start before the end of the
+            # previous one minus its own length. Full searches are only a fallback for edited texts.
+            for full_search in (False, True):
+                span = GeminiContentBuilder._find_citation_markers(
+                    text,
+                    segment_text,
+                    0 if full_search else max(0, previous_end - len(segment_text)),
+                    citation_markers,
+                    claimed,
+                )
+                if span:
+                    break
+                # The segment contains the markers of other supports, so it is searched for
+                # in a view of the text without marker runs.
+                if stripped_view is None:
+                    stripped_view = GeminiContentBuilder._strip_citation_markers(text)
+                stripped, run_positions, removed_counts = stripped_view
+                stripped_segment = CITATION_MARKER_RUN_PATTERN.sub("", segment_text)
+                if not stripped_segment:
+                    break
+                pos = stripped.find(
+                    stripped_segment,
+                    0 if full_search else max(0, previous_stripped_end - len(stripped_segment)),
+                )
+                while pos != -1:
+                    segment_stop = pos + len(stripped_segment)
+                    # Map the end of the segment back to the original text, where its marker run starts.
+                    run = bisect.bisect_left(run_positions, segment_stop)
+                    run_start = segment_stop + (removed_counts[run - 1] if run else 0)
+                    span = GeminiContentBuilder._claim_citation_markers(
+                        text, run_start, citation_markers, claimed
+                    )
+                    if span:
+                        previous_stripped_end = max(previous_stripped_end, segment_stop)
+                        break
+                    pos = stripped.find(stripped_segment, pos + 1)
+                if span:
+                    break
+
+            if span:
+                removals.append(span)
+                previous_end = max(previous_end, span[0])
+
+        kept_parts: list[str] = []
+        cursor = 0
+        for start, stop in sorted(removals):
+            kept_parts.append(text[cursor:start])
+            cursor = stop
+        kept_parts.append(text[cursor:])
+        result = "".join(kept_parts)
+
+        trim = len(text) - len(result)
+        log.debug(
+            f"Citation removal finished. Returning text str that is {trim} character shorter than the original input."
+        )
+        return result
+
+    @staticmethod
+    def _find_citation_markers(
+        text: str,
+        segment_text: str,
+        search_start: int,
+        citation_markers: str,
+        claimed: dict[int, list[tuple[int, int]]],
+    ) -> tuple[int, int] | None:
+        """Claims `citation_markers` after the first occurrence of `segment_text` that is followed by them."""
+        pos = text.find(segment_text, search_start)
+        while pos != -1:
+            if span := GeminiContentBuilder._claim_citation_markers(
+                text, pos + len(segment_text), citation_markers, claimed
+            ):
+                return span
+            pos = text.find(segment_text, pos + 1)
+        return None
+
+    @staticmethod
+    def _strip_citation_markers(text: str) -> tuple[str, list[int], list[int]]:
+        """
+        Returns `text` without marker runs, together with the position of every marker run
+        in the stripped text and the number of characters removed up to and including it.
+        """
+        run_positions: list[int] = []
+        removed_counts: list[int] = []
+        removed = 0
+        for match in CITATION_MARKER_RUN_PATTERN.finditer(text):
+            start, end = match.span()
+            run_positions.append(start - removed)
+            removed += end - start
+            removed_counts.append(removed)
+        return CITATION_MARKER_RUN_PATTERN.sub("", text), run_positions, removed_counts
+
+    @staticmethod
+    def _claim_citation_markers(
+        text: str,
+        run_start: int,
+        citation_markers: str,
+        claimed: dict[int, list[tuple[int, int]]],
+    ) -> tuple[int, int] | None:
+        """
+        Finds `citation_markers` in the marker run that starts at `run_start` and is not yet
+        claimed by another support. Returns the span of the markers in `text`, or None.
+        """
+        match = CITATION_MARKER_RUN_PATTERN.match(text, run_start)
+        if not match:
+            return None
+        run = match.group()
+        run_claims = claimed.setdefault(run_start, [])
+        offset = run.find(citation_markers)
+        while offset != -1:
+            start = run_start + offset
+            stop = start + len(citation_markers)
+            if not run_claims or all(
+                stop <= other_start or start >= other_stop
+                for other_start, other_stop in run_claims
+            ):
+                run_claims.append((start, stop))
+                return start, stop
+            offset = run.find(citation_markers, offset + 1)
+        return None
+
+
+class BackendRouter:
+    """
+    Routes a single generation request across one or more backends.
+
+    Each backend is given as a `(name, opener)` pair, where `opener` is a
+    zero-argument coroutine function that starts the request and returns an
+    async iterator of `GenerateContentResponse` chunks. Because the router only
+    deals with openers, it can be exercised against fake backends without any
+    network access.
+
+    Policies:
+    - `pinned`: Only the first backend is used. Errors are raised as-is.
+    - `failover`: Backends are tried in order. A retryable error that happens
+      before the first chunk arrives moves the request to the next backend.
+    - `hedged`: Like `failover`, but if the first chunk has not arrived within
+      `hedge_deadline` seconds, the next backend is started in parallel.
+      Whichever backend produces the first chunk wins and the other is cancelled.
+    """
+
+    def __init__(
+        self,
+        policy: Literal["pinned", "failover", "hedged"],
+        hedge_deadline: float,
+    ):
+        self.policy = policy
+        self.hedge_deadline = hedge_deadline
+
+    async def open(
+        self,
+        backends: list[
+            tuple[str, Callable[[], Awaitable[AsyncIterator[types.GenerateContentResponse]]]]
+        ],
+    ) -> AsyncIterator[types.GenerateContentResponse]:
+        """Opens the request according to the policy and returns the winning response stream."""
+        if not backends:
+            raise GenaiApiError("No backends are available for this request.")
+
+        if self.policy == "pinned" or len(backends) == 1:
+            name, opener = backends[0]
+            log.debug(f"Sending request to {name} (routing policy: pinned).")
+            return await opener()
+
+        remaining = list(backends)
+        attempts: dict[asyncio.Task, str] = {}
+        last_error: BaseException | None = None
+        start_time = time.monotonic()
+
+        def launch_next() -> None:
+            name, opener = remaining.pop(0)
+            log.debug(
+                f"Sending request to {name} (routing policy: {self.policy}, "
+                f"+{time.monotonic() - start_time:.2f}s)."
+            )
+            attempts[asyncio.create_task(self._prime(opener))] = name
+
+        launch_next()
+        try:
+            while attempts:
+                can_hedge = self.policy == "hedged" and bool(remaining)
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=self.hedge_deadline if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    log.info(
+                        f"No response from {', '.join(attempts.values())} within "
+                        f"{self.hedge_deadline}s. Sending a hedged request to {remaining[0][0]}."
+                    )
+                    launch_next()
+                    continue
+
+                winner: AsyncIterator[types.GenerateContentResponse] | None = None
+                for task in done:
+                    name = attempts.pop(task)
+                    if task.exception() is None:
+                        if winner is None:
+                            winner = task.result()
+                            log.info(
+                                f"{name} won the request after {time.monotonic() - start_time:.2f}s."
+                            )
+                        else:
+                            # Two backends finished in the same tick; close the slower one.
+                            await self._close_stream(task.result())
+                        continue
+
+                    error = task.exception()
+                    last_error = error
+                    if not self.is_retryable(error):
+                        raise error  # type: ignore
+                    log.warning(f"{name} failed with a retryable error: {error}")
+
+                if winner is not None:
+                    return winner
+
+                # Fail over if nothing else is still in flight.
+                if not attempts and remaining:
+                    launch_next()
+        finally:
+            # Cancel the losers (or everything, if we are leaving due to an error).
+            for task, name in attempts.items():
+                log.debug(f"Cancelling the request to {name}.")
+                task.cancel()
+            if attempts:
+                results = await asyncio.gather(*attempts, return_exceptions=True)
+                for result in results:
+                    if not isinstance(result, BaseException):
+                        await self._close_stream(result)
+
+        assert last_error is not None
+        raise last_error
+
+    @staticmethod
+    def is_retryable(error: BaseException) -> bool:
+        """Whether the error is worth retrying on another backend."""
+        if isinstance(error, genai_errors.APIError):
+            return error.code in RETRYABLE_STATUS_CODES
+        return isinstance(error, asyncio.TimeoutError)
+
+    async def _prime(
+        self,
+        opener: Callable[[], Awaitable[AsyncIterator[types.GenerateContentResponse]]],
+    ) -> AsyncIterator[types.GenerateContentResponse]:
+        """Opens the stream and waits for its first chunk, so errors surface before the stream is returned."""
+        stream = await opener()
+        iterator = aiter(stream)
+        try:
+            first_chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return iterator
+        return self._prepend_chunk(first_chunk, iterator)
+
+    @staticmethod
+    async def _prepend_chunk(
+        first_chunk: types.GenerateContentResponse,
+        iterator: AsyncIterator[types.GenerateContentResponse],
+    ) -> AsyncGenerator[types.GenerateContentResponse, None]:
+        try:
+            yield first_chunk
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            await BackendRouter._close_stream(iterator)
+
+    @staticmethod
+    async def _close_stream(stream: AsyncIterator[Any]) -> None:
+        if aclose := getattr(stream, "aclose", None):
+            try:
+                await aclose()
+            except Exception:
+                log.exception("Error while closing a response stream.")
+
+
+class AdmissionController:
+    """
+    Priority-aware concurrency limiter for requests sent to the Google API.
+
+    Interactive chat requests and background task requests have separate budgets.
+    Interactive requests may also borrow idle task slots, and when all slots are taken,
+    freed slots are handed to waiting interactive requests before waiting task requests.
+    A task request never starts while an interactive request is waiting.
+    A limit of 0 means that lane is not limited.
+    """
+
+    def __init__(self):
+        self.interactive_limit = 0
+        self.task_limit = 0
+        self.active: dict[RequestLane, int] = {"interactive": 0, "task": 0}
+        self.waiters: dict[RequestLane, deque[asyncio.Future]] = {
+            "interactive": deque(),
+            "task": deque(),
+        }
+
+    def configure(self, interactive_limit: int, task_limit: int) -> None:
+        """Applies the current limits. Lowered limits take effect as active requests finish."""
+        self.interactive_limit = interactive_limit
+        self.task_limit = task_limit
+        self._wake_waiters()
+
+    async def acquire(
+        self,
+        lane: RequestLane,
+        timeout: float | None = None,
+        on_queued: Callable[[], Awaitable[None]] | None = None,
+    ) -> None:
+        """
+        Waits until a slot in `lane` is available and takes it.
+
+        Args:
+            timeout: Seconds to wait for a slot before raising `asyncio.TimeoutError`. None waits indefinitely.
+            on_queued: Called once if the request has to wait, e.g. to tell the user about it.
+        """
+        if not self._has_waiters(lane) and self._can_admit(lane):
+            self.active[lane] += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[lane].append(waiter)
+        log.debug(
+            f"Admission: {lane} request is queued "
+            f"(active: {self.active}, waiting: {self._queue_depths()})."
+        )
+        try:
+            if on_queued:
+                await on_queued()
+            # Shielded, so a timeout leaves the waiter in place to be checked below.
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before cancellation; give it back.
+                self.release(lane)
+            else:
+                waiter.cancel()
+                if waiter in self.waiters[lane]:
+                    self.waiters[lane].remove(waiter)
+            raise
+
+    def release(self, lane: RequestLane) -> None:
+        """Frees a slot taken with `acquire` and hands it to the next waiter, if any."""
+        self.active[lane] -= 1
+        self._wake_waiters()
+
+    def _can_admit(self, lane: RequestLane) -> bool:
+        if lane == "interactive":
+            if not self.interactive_limit:
+                return True
+            # Idle task slots can be borrowed, but an unlimited task lane has none to lend.
+            if not self.task_limit:
+                return self.active["interactive"] < self.interactive_limit
+            total_active = self.active["interactive"] + self.active["task"]
+            return total_active < self.interactive_limit + self.task_limit
+        if self.task_limit and self.active["task"] >= self.task_limit:
+            return False
+        if self._has_waiters("interactive"):
+            return False
+        if self.interactive_limit and self.task_limit:
+            total_active = self.active["interactive"] + self.active["task"]
+            return total_active < self.interactive_limit + self.task_limit
+        return True
+
+    def _has_waiters(self, lane: RequestLane) -> bool:
+        return any(not waiter.done() for waiter in self.waiters[lane])
+
+    def _wake_waiters(self) -> None:
+        for lane in ("interactive", "task"):
+            queue = self.waiters[lane]
+            while queue and self._can_admit(lane):
+                waiter = queue.popleft()
+                if waiter.done():
+                    continue
+                self.active[lane] += 1
+                waiter.set_result(None)
+
+    def _queue_depths(self) -> dict[str, int]:
+        return {lane: len(queue) for lane, queue in self.waiters.items()}
+
+
+class TokenBucket:
+    """A token bucket that refills continuously up to `capacity` tokens per minute. 0 means unlimited."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def resize(self, capacity: int) -> None:
+        if capacity != self.capacity:
+            self.capacity = capacity
+            self.tokens = min(self.tokens, float(capacity))
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity:
+            self.tokens = min(
+                float(self.capacity),
+                self.tokens + (now - self.updated_at) * self.capacity / 60,
+            )
+        self.updated_at = now
+
+    def debit(self, amount: float) -> None:
+        """Takes `amount` tokens. The balance may go negative, which delays the next refill."""
+        self.refill()
+        self.tokens -= amount
+
+    @property
+    def headroom(self) -> float:
+        """Fraction of the capacity that is currently available."""
+        if not self.capacity:
+            return 1.0
+        self.refill()
+        return self.tokens / self.capacity
+
+
+class ApiKeyState:
+    def __init__(self, rpm_limit: int, tpm_limit: int):
+        self.requests = TokenBucket(rpm_limit)
+        self.tokens = TokenBucket(tpm_limit)
+        self.backoff_until = 0.0
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.rate_limited_count = 0
+
+
+class ApiKeyPool:
+    """
+    Spreads Gemini Developer API requests over several API keys.
+
+    Every key has a requests-per-minute and a tokens-per-minute bucket. Requests are sent
+    with the key that has the most headroom in its tightest bucket. An estimate of the input
+    tokens is taken when the request is sent, so concurrent requests see each other's budget,
+    and is reconciled with the reported usage after the response finishes. A key that
+    receives a 429 is skipped for the backoff period.
+    """
+
+    # Upper bound for remembered chat -> key assignments.
+    MAX_STICKY_CHATS: Final = 10_000
+
+    def __init__(self):
+        self.keys: dict[str, ApiKeyState] = {}
+        self.backoff_seconds = 60.0
+        # Keeps a chat on the same key, so Files API uploads and implicit caching keep working.
+        self.sticky_keys: dict[str, str] = {}
+
+    def configure(
+        self, keys: list[str], rpm_limit: int, tpm_limit: int, backoff_seconds: float
+    ) -> None:
+        """Applies the current key list and limits. State of the keys that remain is kept."""
+        self.keys = {
+            key: self.keys.get(key) or ApiKeyState(rpm_limit, tpm_limit) for key in keys
+        }
+        for state in self.keys.values():
+            state.requests.resize(rpm_limit)
+            state.tokens.resize(tpm_limit)
+        self.backoff_seconds = backoff_seconds
+
+    def pick(self, sticky_id: str | None = None) -> str:
+        """
+        Returns the key for a new request, preferring the key previously used for `sticky_id`
+        while that key still has headroom in both buckets. Otherwise the chat moves to the
+        key with the most headroom.
+        """
+        if sticky_id and (key := self.sticky_keys.get(sticky_id)) in self.keys:
+            state = self.keys[key]
+            if (
+                not self._in_backoff(state)
+                and state.requests.headroom > 0
+                and state.tokens.headroom > 0
+            ):
+                return key
+        key = self.rank()[0]
+        if sticky_id:
+            self.sticky_keys.pop(sticky_id, None)
+            if len(self.sticky_keys) >= self.MAX_STICKY_CHATS:
+                del self.sticky_keys[next(iter(self.sticky_keys))]
+            self.sticky_keys[sticky_id] = key
+        return key
+
+    def rank(self) -> list[str]:
+        """Returns all keys, best first. Keys in backoff come last, soonest available first."""
+
+        def sort_key(key: str) -> tuple[bool, float]:
+            state = self.keys[key]
+            if self._in_backoff(state):
+                return (True, state.backoff_until)
+            return (False, -min(state.requests.headroom, state.tokens.headroom))
+
+        return sorted(self.keys, key=sort_key)
+
+    def record_request(self, key: str, estimated_tokens: int = 0) -> None:
+        """Takes one request and the estimated input tokens of a request that is being sent."""
+        if state := self.keys.get(key):
+            state.requests.debit(1)
+            state.tokens.debit(estimated_tokens)
+            state.total_requests += 1
+
+    def record_usage(self, key: str, token_count: int, estimated_tokens: int = 0) -> None:
+        """Replaces the estimate taken by `record_request` with the reported token count."""
+        if state := self.keys.get(key):
+            state.tokens.debit(token_count - estimated_tokens)
+            state.total_tokens += token_count
+
+    def record_rate_limited(self, key: str) -> None:
+        if state := self.keys.get(key):
+            state.backoff_until = time.monotonic() + self.backoff_seconds
+            state.rate_limited_count += 1
+            log.warning(
+                f"API key {self.fingerprint(key)} was rate limited. "
+                f"Backing off for {self.backoff_seconds}s."
+            )
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """Current bucket state per key. Keys are identified by their fingerprint only."""
+        now = time.monotonic()
+        snapshot = {}
+        for key, state in self.keys.items():
+            state.requests.refill()
+            state.tokens.refill()
+            snapshot[self.fingerprint(key)] = {
+                "requests_available": round(state.requests.tokens, 2),
+                "requests_capacity": state.requests.capacity,
+                "tokens_available": round(state.tokens.tokens),
+                "tokens_capacity": state.tokens.capacity,
+                "backoff_remaining": round(max(0.0, state.backoff_until - now), 2),
+                "total_requests": state.total_requests,
+                "total_tokens": state.total_tokens,
+                "rate_limited_count": state.rate_limited_count,
+            }
+        return snapshot
+
+    @staticmethod
+    def fingerprint(key: str) -> str:
+        return xxhash.xxh3_64_hexdigest(key.encode())[:8]
+
+    @staticmethod
+    def _in_backoff(state: ApiKeyState) -> bool:
+        return state.backoff_until > time.monotonic()
+
+
+class TaskRequestCoalescer:
+    """
+    Coalesces identical background task requests (title, tags, follow-up generation, ...).
+
+    Open WebUI often fires the same task several times for the same conversation
+    state. Calls that share a key while one is in flight are attached to that single
+    upstream request, and the collected response chunks are kept in a short-lived
+    cache so that repeats shortly after completion don't hit the API at all.
+    """
+
+    def __init__(self, result_cache: SimpleMemoryCache):
+        """
+        Args:
+            result_cache: An aiocache instance for mapping `request key -> list[GenerateContentResponse]`.
+                          Must be configured with `aiocache.serializers.NullSerializer`.
+        """
+        self.result_cache = result_cache
+        self.inflight: dict[str, asyncio.Task] = {}
+
+    async def run(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[list[types.GenerateContentResponse]]],
+        ttl: float,
+    ) -> list[types.GenerateContentResponse]:
+        """Returns the cached or shared result for `key`, calling `fetch` only if neither exists."""
+        cached: list[types.GenerateContentResponse] | None = await self.result_cache.get(key)
+        if cached is not None:
+            log.info(f"Task result cache HIT for key {key}. Skipping the API call.")
+            return cached
+
+        task = self.inflight.get(key)
+        if task is None:
+            log.debug(f"Task result cache MISS for key {key}. Sending the request.")
+            task = asyncio.create_task(self._fetch_and_cache(key, fetch, ttl))
+            self.inflight[key] = task
+        else:
+            log.info(f"Identical task request for key {key} is in flight. Sharing its result.")
+
+        # Shielding keeps the shared request alive if one of the callers is cancelled.
+        return await asyncio.shield(task)
+
+    async def _fetch_and_cache(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[list[types.GenerateContentResponse]]],
+        ttl: float,
+    ) -> list[types.GenerateContentResponse]:
+        try:
+            result = await fetch()
+            if ttl > 0:
+                await self.result_cache.set(key, result, ttl=ttl)
+            return result
+        finally:
+            self.inflight.pop(key, None)
+
+
+class StreamMetrics:
+    """Collects chunk arrival times of a response to report latency and throughput."""
+
+    def __init__(self, start_time: float, replayed: bool = False):
+        """
+        Args:
+            start_time: `time.monotonic()` timestamp of when the pipe started handling the request.
+            replayed: Whether the response is replayed from memory (a cached or coalesced response).
+                      Its chunk times say nothing about the backend, so no latency is reported for it.
+        """
+        self.start_time = start_time
+        self.replayed = replayed
+        self.chunk_times: list[float] = []
+
+    def record_chunk(self) -> None:
+        self.chunk_times.append(time.monotonic())
+
+    def summary(self, output_tokens: int | None) -> dict[str, float | bool]:
+        """
+        Returns the metrics for the usage payload. Gap percentiles and the decode rate
+        need at least two chunks, so they are only reported for streamed responses.
+        Replayed responses are only marked with `cached`.
+        """
+        if self.replayed:
+            return {"cached": True}
+        if not self.chunk_times:
+            return {}
+        first, last = self.chunk_times[0], self.chunk_times[-1]
+        metrics = {"time_to_first_token": round(first - self.start_time, 3)}
+        if len(self.chunk_times) < 2:
+            return metrics
+
+        gaps = sorted(b - a for a, b in zip(self.chunk_times, self.chunk_times[1:]))
+        stream_duration = last - first
+        metrics["stream_duration"] = round(stream_duration, 3)
+        for percentile in (50, 90, 99):
+            metrics[f"chunk_gap_p{percentile}_ms"] = round(
+                self._percentile(gaps, percentile) * 1000, 1
+            )
+        if output_tokens and stream_duration > 0:
+            metrics["decode_tokens_per_second"] = round(output_tokens / stream_duration, 1)
+        return metrics
+
+    @staticmethod
+    def _percentile(sorted_values: list[float], percentile: int) -> float:
+        """Nearest-rank percentile of an already sorted list."""
+        rank = max(1, -(-len(sorted_values) * percentile // 100))
+        return sorted_values[rank - 1]
 
 
 class Pipe:
@@ -1451,6 +2722,35 @@ class Pipe:
             If not provided, the main GEMINI_API_KEY will be used.
             An image generation model is identified by the Image Model Pattern regex below.""",
         )
+        GEMINI_API_KEYS: str | None = Field(
+            default=None,
+            description="""Optional comma-separated list of additional Gemini API keys to use together with GEMINI_API_KEY.
+            Requests are sent with the key that has the most headroom under API_KEY_RPM_LIMIT and API_KEY_TPM_LIMIT,
+            and a chat stays on the same key while that key is not rate limited.
+            A request that gets a 429 is retried with another key, unless it references Files API uploads.
+            Not used for user-provided keys or IMAGE_GEN_GEMINI_API_KEY.
+            Default value is None.""",
+        )
+        API_KEY_RPM_LIMIT: int = Field(
+            default=0,
+            ge=0,
+            description="""Requests per minute allowed for each pooled API key. 0 means no limit.
+            Default value is 0.""",
+        )
+        API_KEY_TPM_LIMIT: int = Field(
+            default=0,
+            ge=0,
+            description="""Tokens per minute allowed for each pooled API key. 0 means no limit.
+            Estimated input tokens are reserved when a request is sent and replaced
+            by the usage reported at the end of the response.
+            Default value is 0.""",
+        )
+        API_KEY_RATE_LIMIT_BACKOFF: float = Field(
+            default=60.0,
+            gt=0,
+            description="""Seconds to avoid a pooled API key after it receives a 429 response.
+            Default value is 60.0.""",
+        )
         USER_MUST_PROVIDE_AUTH_CONFIG: bool = Field(
             default=False,
             description="""Whether to require users (including admins) to provide their own authentication configuration.
@@ -1484,6 +2784,81 @@ class Pipe:
             description="""The Google Cloud region to use with Vertex AI.
             Default value is 'global'.""",
         )
+        BACKEND_ROUTING_POLICY: Literal["pinned", "failover", "hedged"] = Field(
+            default="pinned",
+            description="""How to route requests for models that are available on both Gemini Developer API and Vertex AI.
+            Only applies when GEMINI_API_KEY, USE_VERTEX_AI and VERTEX_PROJECT are all set.
+            - pinned: always use the configured backend.
+            - failover: retry on the other backend when the first one fails with 429, 500, 503 or 504 before the first chunk arrives.
+            - hedged: like failover, but also send a second request to the other backend if the first chunk
+              has not arrived within HEDGE_TTFB_DEADLINE seconds. The slower request is cancelled.
+            Requests that reference Files API uploads are always pinned, because uploads are not shared between backends.
+            Default value is pinned.""",
+        )
+        HEDGE_TTFB_DEADLINE: float = Field(
+            default=5.0,
+            gt=0,
+            description="""Seconds to wait for the first chunk before sending a hedged request to the other backend.
+            Only used when BACKEND_ROUTING_POLICY is hedged.
+            Default value is 5.0.""",
+        )
+        MAX_CONCURRENT_INTERACTIVE_REQUESTS: int = Field(
+            default=0,
+            ge=0,
+            description="""Number of concurrent chat requests to the Google API guaranteed a slot.
+            A slot is held until the response has finished streaming.
+            Chat requests can also use task slots that are not in use.
+            When all slots are taken, chat requests are admitted before waiting task requests.
+            0 means chat requests are not limited.
+            Default value is 0.""",
+        )
+        MAX_CONCURRENT_TASK_REQUESTS: int = Field(
+            default=0,
+            ge=0,
+            description="""Maximum number of concurrent background task requests (titles, tags, follow-ups, ...).
+            Task requests wait while any chat request is waiting for a slot.
+            0 means task requests are not limited.
+            Default value is 0.""",
+        )
+        ADMISSION_QUEUE_TIMEOUT: float = Field(
+            default=30.0,
+            ge=0,
+            description="""Seconds a request waits for a free slot (see the two settings above) before it fails
+            with an error instead of waiting longer. 0 means requests wait until a slot is free.
+            Default value is 30.0.""",
+        )
+        TASK_RESULT_CACHE_TTL: int = Field(
+            default=60,
+            ge=0,
+            description="""Seconds to keep the results of background task requests (titles, tags, follow-ups, ...).
+            Identical task requests within this time reuse the cached result instead of calling the API.
+            Identical task requests that arrive while one is in flight always share its result.
+            Set to 0 to disable the cache.
+            Default value is 60.""",
+        )
+        RESPONSE_CACHE_TTL: int = Field(
+            default=0,
+            ge=0,
+            description="""Seconds to keep the responses to deterministic chat requests.
+            A request is deterministic when its temperature is 0, it uses no tools (search, code execution, URL context)
+            and the model does not generate images. An identical request within this time gets the cached response
+            replayed as a stream instead of calling the API. Only complete responses without grounding are cached.
+            Set to 0 to disable the cache.
+            Default value is 0.""",
+        )
+        RESPONSE_CACHE_MAX_SIZE_MB: int = Field(
+            default=64,
+            ge=1,
+            description="""Maximum memory in megabytes used by the response cache.
+            The least recently used responses are evicted first.
+            Default value is 64.""",
+        )
+        RESPONSE_CACHE_SHARED: bool = Field(
+            default=False,
+            description="""Whether cached responses are shared between users.
+            When disabled, a user only gets responses cached from their own requests.
+            Default value is False.""",
+        )
         MODEL_WHITELIST: str = Field(
             default="*",
             description="""Comma-separated list of allowed model names.
@@ -1548,6 +2923,59 @@ class Pipe:
             If disabled, files are sent as raw bytes in the request.
             Default value is True.""",
         )
+        FILES_API_REFRESH_HOT_FILES: bool = Field(
+            default=False,
+            description="""Whether to upload a fresh copy of frequently used files in the background before they expire.
+            Files uploaded to the Files API are deleted after 48 hours; without a refresh the next message
+            that needs an expired file waits for it to be uploaded again.
+            Default value is False.""",
+        )
+        FILES_API_REFRESH_MIN_USES: int = Field(
+            default=2,
+            ge=1,
+            description="""Number of messages that must use a file before it is refreshed.
+            Default value is 2.""",
+        )
+        FILES_API_REFRESH_LEAD_TIME: int = Field(
+            default=6,
+            ge=1,
+            le=47,
+            description="""Hours before expiry when a frequently used file is refreshed.
+            Files that have not been used in the last 24 hours are not refreshed.
+            Default value is 6.""",
+        )
+        INLINE_IMAGE_OPTIMIZATION: bool = Field(
+            default=False,
+            description="""Whether to downscale and re-encode images that are sent as raw bytes in the request
+            (when USE_FILES_API is disabled, with Vertex AI, or in temporary chats).
+            Requires Pillow. Animated images are sent unchanged.
+            Default value is False.""",
+        )
+        INLINE_IMAGE_MAX_EDGE: int = Field(
+            default=2048,
+            ge=64,
+            description="""Maximum length in pixels of the longest image edge when INLINE_IMAGE_OPTIMIZATION is enabled.
+            Default value is 2048.""",
+        )
+        INLINE_IMAGE_MAX_PIXELS: int = Field(
+            default=3_145_728,
+            ge=4096,
+            description="""Maximum number of pixels (width * height) when INLINE_IMAGE_OPTIMIZATION is enabled.
+            Default value is 3145728 (3 megapixels).""",
+        )
+        INLINE_IMAGE_FORMAT: Literal["webp", "jpeg"] = Field(
+            default="webp",
+            description="""Format to re-encode images to when INLINE_IMAGE_OPTIMIZATION is enabled.
+            JPEG does not keep transparency.
+            Default value is webp.""",
+        )
+        INLINE_IMAGE_QUALITY: int = Field(
+            default=85,
+            ge=1,
+            le=100,
+            description="""Encoder quality (1-100) when INLINE_IMAGE_OPTIMIZATION is enabled.
+            Default value is 85.""",
+        )
         PARSE_YOUTUBE_URLS: bool = Field(
             default=True,
             description="""Whether to parse YouTube URLs from user messages and provide them as context to the model.
@@ -1684,6 +3112,12 @@ class Pipe:
             Set to True to force use, False to disable.
             Default is None (use the admin's setting).""",
         )
+        INLINE_IMAGE_OPTIMIZATION: bool | None | Literal[""] = Field(
+            default=None,
+            description="""Override the default setting for downscaling and re-encoding images sent as raw bytes.
+            Set to True to enable, False to disable.
+            Default is None (use the admin's setting).""",
+        )
         PARSE_YOUTUBE_URLS: bool | None | Literal[""] = Field(
             default=None,
             description="""Override the default setting for parsing YouTube URLs.
@@ -1722,6 +3156,23 @@ class Pipe:
         self.valves = self.Valves()
         self.file_content_cache = SimpleMemoryCache(serializer=NullSerializer())
         self.file_id_to_hash_cache = SimpleMemoryCache(serializer=NullSerializer())
+        self.data_uri_cache = BoundedLRUCache(DATA_URI_CACHE_MAX_BYTES)
+        self.image_variant_cache = BoundedLRUCache(IMAGE_VARIANT_CACHE_MAX_BYTES)
+        # Uploads in progress, shared by all requests so that they can wait on each other's uploads.
+        self.inflight_uploads: dict[str, InflightUpload] = {}
+        self.hot_file_refresher = HotFileRefresher(
+            self.file_content_cache, self.file_id_to_hash_cache
+        )
+        # Maps model ID -> backends that serve it. Populated when models are fetched from both backends.
+        self.model_backends: dict[str, set[Literal["gemini", "vertex"]]] = {}
+        self.admission = AdmissionController()
+        self.api_key_pool = ApiKeyPool()
+        self.task_coalescer = TaskRequestCoalescer(
+            SimpleMemoryCache(serializer=NullSerializer())
+        )
+        self.response_cache = BoundedLRUCache(
+            self.valves.RESPONSE_CACHE_MAX_SIZE_MB * 1024 * 1024
+        )
         log.success("Function has been initialized.")
 
     async def pipes(self) -> list["ModelData"]:
@@ -1799,6 +3250,10 @@ class Pipe:
         client = self._get_user_client(valves, __user__["email"])
         __metadata__["is_vertex_ai"] = client.vertexai
 
+        client, pooled_key = self._get_pooled_client(
+            client, valves, __metadata__.get("chat_id")
+        )
+
         if __metadata__.get("task"):
             log.info(f'{__metadata__["task"]=}, disabling event emissions.') # type: ignore
             # Task model is not user facing, so we should not emit any events.
@@ -1814,6 +3269,15 @@ class Pipe:
             file_cache=self.file_content_cache,
             id_hash_cache=self.file_id_to_hash_cache,
             event_emitter=event_emitter,
+            cache_namespace=ApiKeyPool.fingerprint(pooled_key) if pooled_key else "",
+            inflight_uploads=self.inflight_uploads,
+            hot_file_refresher=self.hot_file_refresher,
+            use_id=self._get_file_use_id(__metadata__),
+        )
+        self.hot_file_refresher.configure(
+            valves.FILES_API_REFRESH_HOT_FILES,
+            valves.FILES_API_REFRESH_MIN_USES,
+            valves.FILES_API_REFRESH_LEAD_TIME,
         )
 
         # Check if user is chatting with an error model for some reason.
@@ -1836,9 +3300,11 @@ class Pipe:
             event_emitter=event_emitter,
             valves=valves,
             files_api_manager=files_api_manager,
+            data_uri_cache=self.data_uri_cache,
+            image_variant_cache=self.image_variant_cache,
         )
         # This is our first timed event, marking the start of payload preparation.
-        asyncio.create_task(event_emitter.emit_status("Preparing request..."))
+        await event_emitter.emit_status("Preparing request...")
         contents = await builder.build_contents(start_time=start_time)
 
         gen_content_conf = self._build_gen_content_config(body, __metadata__, valves)
@@ -1873,54 +3339,170 @@ class Pipe:
         request_type_str = "streaming" if is_streaming else "non-streaming"
 
         # Emit a status update with timing before making the actual API call.
-        asyncio.create_task(event_emitter.emit_status(f"Sending {request_type_str} request to Google API... {time_str}"))
+        await event_emitter.emit_status(
+            f"Sending {request_type_str} request to Google API... {time_str}"
+        )
 
-        if is_streaming:
-            # Streaming response
-            response_stream: AsyncIterator[types.GenerateContentResponse] = (
-                await client.aio.models.generate_content_stream(**gen_content_args)  # type: ignore
+        # A request can be served by more than one backend if the model is available on both.
+        backends = []
+        for name, backend_client, backend_key in self._get_request_backends(
+            client, pooled_key, valves, model_name, contents, __metadata__.get("chat_id")
+        ):
+            if backend_key:
+                # Uploaded files only exist in the project of the key that uploaded them.
+                keys = [backend_key]
+                if self._is_portable_contents(contents):
+                    keys += [key for key in self.api_key_pool.rank() if key != backend_key]
+                opener = partial(
+                    self._open_with_key_pool, keys, valves, gen_content_args, is_streaming
+                )
+            else:
+                opener = partial(
+                    self._open_response_stream, backend_client, gen_content_args, is_streaming
+                )
+            backends.append((name, opener))
+        router = BackendRouter(valves.BACKEND_ROUTING_POLICY, valves.HEDGE_TTFB_DEADLINE)
+        self.admission.configure(
+            valves.MAX_CONCURRENT_INTERACTIVE_REQUESTS,
+            valves.MAX_CONCURRENT_TASK_REQUESTS,
+        )
+        admission_timeout = valves.ADMISSION_QUEUE_TIMEOUT or None
+
+        if task := __metadata__.get("task"):
+            # Background tasks are often fired several times for the same conversation state,
+            # so identical ones share a single upstream request and a short-lived result.
+            task_key = self._hash_request(
+                __user__["id"], model_name, task, contents, gen_content_conf
             )
 
-            log.info(
-                "Streaming enabled. Returning AsyncGenerator from unified processor."
+            async def fetch_task_response() -> list[types.GenerateContentResponse]:
+                await self._acquire_admission("task", admission_timeout, event_emitter)
+                try:
+                    return [chunk async for chunk in await router.open(backends)]
+                finally:
+                    self.admission.release("task")
+
+            task_chunks = await self.task_coalescer.run(
+                task_key, fetch_task_response, ttl=valves.TASK_RESULT_CACHE_TTL
             )
-            log.debug("pipe method has finished.")
-            return self._unified_response_processor(
-                response_stream,
-                __request__,
-                model_name,
-                event_emitter,
-                __user__["id"],
-                chat_id,
-                message_id,
-                start_time=start_time,
+            response_stream = self._replay_response(task_chunks)
+            replayed = True
+        elif (
+            response_cache_key := self._get_response_cache_key(
+                valves, __user__["id"], model_name, contents, gen_content_conf
+            )
+        ) and (cached_chunks := self.response_cache.get(response_cache_key)):
+            log.info(
+                f"Response cache HIT for key {response_cache_key}. Replaying {len(cached_chunks)} chunk(s) "
+                f"(hits: {self.response_cache.hits}, misses: {self.response_cache.misses})."
             )
+            response_stream = self._replay_response(cached_chunks)
+            replayed = True
         else:
-            # Non-streaming response.
-            res = await client.aio.models.generate_content(**gen_content_args)
-
-            # Adapter: Create a simple, one-shot async generator that yields the
-            # single response object, making it behave like a stream.
-            async def single_item_stream(
-                response: types.GenerateContentResponse,
-            ) -> AsyncGenerator[types.GenerateContentResponse, None]:
-                yield response
+            replayed = False
+            await self._acquire_admission("interactive", admission_timeout, event_emitter)
+            try:
+                response_stream = await router.open(backends)
+            except BaseException:
+                self.admission.release("interactive")
+                raise
+            # The slot is held until the response stream is fully consumed or closed.
+            response_stream = self._release_on_close(
+                response_stream, partial(self.admission.release, "interactive")
+            )
+            if response_cache_key:
+                response_stream = self._cache_response(
+                    response_stream, response_cache_key, valves.RESPONSE_CACHE_TTL
+                )
 
+        if is_streaming:
+            log.info(
+                "Streaming enabled. Returning AsyncGenerator from unified processor."
+            )
+        else:
             log.info(
                 "Streaming disabled. Adapting full response and returning "
                 "AsyncGenerator from unified processor."
             )
-            log.debug("pipe method has finished.")
-            return self._unified_response_processor(
-                single_item_stream(res),
-                __request__,
-                model_name,
-                event_emitter,
-                __user__["id"],
-                chat_id,
-                message_id,
-                start_time=start_time,
-            )
+        log.debug("pipe method has finished.")
+        return self._unified_response_processor(
+            response_stream,
+            __request__,
+            model_name,
+            event_emitter,
+            __user__["id"],
+            chat_id,
+            message_id,
+            start_time=start_time,
+            max_output_tokens=gen_content_conf.max_output_tokens,
+            replayed=replayed,
+        )
+
+    async def preupload_files(
+        self,
+        file_ids: list[str],
+        model_id: str,
+        __user__: "UserData",
+        __metadata__: "Metadata",
+    ) -> None:
+        """
+        Uploads Open WebUI files to the Files API ahead of the request that will reference them.
+
+        Called in the background by the companion filter's `inlet`. The upload is registered
+        in the shared in-progress registry, so the request either finds the file ACTIVE in
+        the cache or waits for this upload instead of starting its own.
+        """
+        self._add_log_handler(self.valves.LOG_LEVEL)
+        valves: Pipe.Valves = self._get_merged_valves(
+            self.valves, __user__.get("valves"), __user__.get("email")
+        )
+        model_name = re.sub(r"^.*?[./]", "", model_id)
+        chat_id = __metadata__.get("chat_id")
+        if not valves.USE_FILES_API or chat_id == "local":
+            log.debug("Files API is not used for this request. Skipping pre-upload.")
+            return
+        if self._is_image_model(model_name, valves.IMAGE_MODEL_PATTERN):
+            log.debug("Image generation models don't take documents. Skipping pre-upload.")
+            return
+
+        client = self._get_user_client(valves, __user__["email"])
+        if client.vertexai:
+            log.debug("Files API is not available on Vertex AI. Skipping pre-upload.")
+            return
+        client, pooled_key = self._get_pooled_client(client, valves, chat_id)
+
+        files_api_manager = FilesAPIManager(
+            client=client,
+            file_cache=self.file_content_cache,
+            id_hash_cache=self.file_id_to_hash_cache,
+            event_emitter=EventEmitter(None),
+            cache_namespace=ApiKeyPool.fingerprint(pooled_key) if pooled_key else "",
+            inflight_uploads=self.inflight_uploads,
+            hot_file_refresher=self.hot_file_refresher,
+            use_id=self._get_file_use_id(__metadata__),
+        )
+        self.hot_file_refresher.configure(
+            valves.FILES_API_REFRESH_HOT_FILES,
+            valves.FILES_API_REFRESH_MIN_USES,
+            valves.FILES_API_REFRESH_LEAD_TIME,
+        )
+
+        async def preupload(file_id: str) -> None:
+            file_bytes, mime_type = await GeminiContentBuilder._get_file_data(file_id)
+            if file_bytes and mime_type:
+                await files_api_manager.get_or_upload_file(
+                    file_bytes, mime_type, owui_file_id=file_id
+                )
+
+        start_time = time.monotonic()
+        log.info(f"Pre-uploading {len(file_ids)} file(s) for chat {chat_id}.")
+        results = await asyncio.gather(
+            *(preupload(file_id) for file_id in file_ids), return_exceptions=True
+        )
+        for file_id, result in zip(file_ids, results):
+            if isinstance(result, BaseException):
+                log.warning(f"Pre-upload of file {file_id} failed: {result}")
+        log.info(f"Pre-upload finished in {time.monotonic() - start_time:.2f}s.")
 
     # region 2. Helper methods inside the Pipe class
 
@@ -2010,6 +3592,371 @@ class Pipe:
         ]
         return [getattr(source_valves, attr) for attr in ATTRS]
 
+    def _get_request_backends(
+        self,
+        client: genai.Client,
+        pooled_key: str | None,
+        valves: "Pipe.Valves",
+        model_name: str,
+        contents: list[types.Content],
+        chat_id: str | None,
+    ) -> list[tuple[str, genai.Client, str | None]]:
+        """
+        Returns the ordered list of `(name, client, pooled key)` backends that may serve this request.
+        The user's client always comes first. The other backend is only added when routing
+        is enabled, both backends are configured, the model is served by both, and the
+        contents do not reference Files API uploads (which are bound to the Gemini Developer API).
+        A Gemini Developer API backend uses the key pool when one is configured.
+        """
+        primary_name = "Vertex AI" if client.vertexai else "Gemini Developer API"
+        backends: list[tuple[str, genai.Client, str | None]] = [
+            (primary_name, client, pooled_key)
+        ]
+
+        if valves.BACKEND_ROUTING_POLICY == "pinned":
+            return backends
+        if not (valves.USE_VERTEX_AI and valves.VERTEX_PROJECT and valves.GEMINI_API_KEY):
+            log.debug("Only one backend is configured, routing is not possible.")
+            return backends
+        if self.model_backends.get(model_name, set()) != {"gemini", "vertex"}:
+            log.debug(f"Model '{model_name}' is not known to be served by both backends.")
+            return backends
+        if not self._is_portable_contents(contents):
+            log.info(
+                "Request references Files API uploads, which are not available on Vertex AI. "
+                f"Pinning the request to {primary_name}."
+            )
+            return backends
+
+        try:
+            if client.vertexai:
+                alternate = self._get_or_create_genai_client(
+                    api_key=valves.GEMINI_API_KEY,
+                    base_url=valves.GEMINI_API_BASE_URL,
+                    use_vertex_ai=False,
+                    vertex_project=None,
+                    vertex_location=None,
+                )
+                alternate, alternate_key = self._get_pooled_client(alternate, valves, chat_id)
+                backends.append(("Gemini Developer API", alternate, alternate_key))
+            else:
+                alternate = self._get_or_create_genai_client(
+                    api_key=None,
+                    base_url=valves.GEMINI_API_BASE_URL,
+                    use_vertex_ai=True,
+                    vertex_project=valves.VERTEX_PROJECT,
+                    vertex_location=valves.VERTEX_LOCATION,
+                )
+                backends.append(("Vertex AI", alternate, None))
+        except GenaiApiError as e:
+            log.warning(f"Could not initialize the alternate backend, routing is disabled: {e}")
+
+        return backends
+
+    def _get_pooled_client(
+        self, client: genai.Client, valves: "Pipe.Valves", chat_id: str | None
+    ) -> tuple[genai.Client, str | None]:
+        """
+        With a key pool, returns a client for the key picked for this chat instead of GEMINI_API_KEY,
+        together with that key. Otherwise returns the given client and None.
+        """
+        if client.vertexai or not self._configure_api_key_pool(valves):
+            return client, None
+        pooled_key = self.api_key_pool.pick(chat_id if chat_id != "local" else None)
+        log.info(f"Using pooled API key {ApiKeyPool.fingerprint(pooled_key)}.")
+        pooled_client = self._get_or_create_genai_client(
+            api_key=pooled_key,
+            base_url=valves.GEMINI_API_BASE_URL,
+            use_vertex_ai=False,
+            vertex_project=None,
+            vertex_location=None,
+        )
+        return pooled_client, pooled_key
+
+    def _configure_api_key_pool(self, valves: "Pipe.Valves") -> bool:
+        """
+        Applies the key pool settings and returns whether the pool should be used for this request.
+        The pool only replaces the admin's GEMINI_API_KEY, never a key provided by the user.
+        """
+        if not valves.GEMINI_API_KEYS or valves.GEMINI_API_KEY != self.valves.GEMINI_API_KEY:
+            return False
+        candidates = [valves.GEMINI_API_KEY or "", *valves.GEMINI_API_KEYS.split(",")]
+        keys = list(dict.fromkeys(key.strip() for key in candidates if key.strip()))
+        self.api_key_pool.configure(
+            keys,
+            rpm_limit=valves.API_KEY_RPM_LIMIT,
+            tpm_limit=valves.API_KEY_TPM_LIMIT,
+            backoff_seconds=valves.API_KEY_RATE_LIMIT_BACKOFF,
+        )
+        return bool(keys)
+
+    async def _open_with_key_pool(
+        self,
+        keys: list[str],
+        valves: "Pipe.Valves",
+        gen_content_args: dict[str, Any],
+        is_streaming: bool,
+    ) -> AsyncIterator[types.GenerateContentResponse]:
+        """Sends the request with the first key, failing over to the next keys on 429 and server errors."""
+        estimated_tokens = self._estimate_input_tokens(gen_content_args)
+        key_backends = []
+        for key in keys:
+            key_client = self._get_or_create_genai_client(
+                api_key=key,
+                base_url=valves.GEMINI_API_BASE_URL,
+                use_vertex_ai=False,
+                vertex_project=None,
+                vertex_location=None,
+            )
+            key_backends.append(
+                (
+                    f"Gemini Developer API (key {ApiKeyPool.fingerprint(key)})",
+                    partial(
+                        self._open_metered_stream,
+                        key,
+                        key_client,
+                        gen_content_args,
+                        is_streaming,
+                        estimated_tokens,
+                    ),
+                )
+            )
+        router = BackendRouter("failover", valves.HEDGE_TTFB_DEADLINE)
+        return await router.open(key_backends)
+
+    async def _open_metered_stream(
+        self,
+        key: str,
+        client: genai.Client,
+        gen_content_args: dict[str, Any],
+        is_streaming: bool,
+        estimated_tokens: int,
+    ) -> AsyncIterator[types.GenerateContentResponse]:
+        """Opens the response stream with a pooled key and records the key's usage."""
+        self.api_key_pool.record_request(key, estimated_tokens)
+        try:
+            stream = await self._open_response_stream(client, gen_content_args, is_streaming)
+        except BaseException as e:
+            # The request was not processed, so the reserved tokens are given back.
+            self.api_key_pool.record_usage(key, 0, estimated_tokens)
+            if isinstance(e, genai_errors.APIError) and e.code == 429:
+                self.api_key_pool.record_rate_limited(key)
+            raise
+        return self._meter_key_usage(stream, key, estimated_tokens)
+
+    async def _meter_key_usage(
+        self,
+        response_stream: AsyncIterator[types.GenerateContentResponse],
+        key: str,
+        estimated_tokens: int,
+    ) -> AsyncGenerator[types.GenerateContentResponse, None]:
+        usage: types.GenerateContentResponseUsageMetadata | None = None
+        try:
+            async for chunk in response_stream:
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                yield chunk
+        except genai_errors.APIError as e:
+            if e.code == 429:
+                self.api_key_pool.record_rate_limited(key)
+            raise
+        finally:
+            # Without reported usage (e.g. an aborted response), the estimate stays debited.
+            if usage and usage.total_token_count:
+                self.api_key_pool.record_usage(
+                    key, usage.total_token_count, estimated_tokens
+                )
+            log.debug("API key pool state:", payload=self.api_key_pool.snapshot())
+            await BackendRouter._close_stream(response_stream)
+
+    @staticmethod
+    def _get_file_use_id(__metadata__: "Metadata") -> str | None:
+        """Identifies the message of a request, so a file used by it is counted once as hot."""
+        if message_id := __metadata__.get("message_id"):
+            return f"{__metadata__.get('chat_id')}:{message_id}"
+        return None
+
+    @staticmethod
+    def _estimate_input_tokens(gen_content_args: dict[str, Any]) -> int:
+        """Roughly estimates the input tokens of a request from its text length and media parts."""
+        config: types.GenerateContentConfig = gen_content_args["config"]
+        chars = len(config.system_instruction) if isinstance(config.system_instruction, str) else 0
+        media_parts = 0
+        for content in gen_content_args["contents"]:
+            for part in content.parts or []:
+                if part.text:
+                    chars += len(part.text)
+                elif part.inline_data or part.file_data:
+                    media_parts += 1
+        return chars // ESTIMATED_CHARS_PER_TOKEN + media_parts * ESTIMATED_TOKENS_PER_MEDIA_PART
+
+    @staticmethod
+    def _is_portable_contents(contents: list[types.Content]) -> bool:
+        """Whether the contents can be sent to any backend, i.e. they only reference public URIs."""
+        for content in contents:
+            for part in content.parts or []:
+                if (file_data := part.file_data) and file_data.file_uri:
+                    if not file_data.file_uri.startswith("https://www.youtube.com/"):
+                        return False
+        return True
+
+    @staticmethod
+    async def _open_response_stream(
+        client: genai.Client,
+        gen_content_args: dict[str, Any],
+        is_streaming: bool,
+    ) -> AsyncIterator[types.GenerateContentResponse]:
+        """
+        Sends the request with the given client. Non-streaming responses are adapted
+        into a one-item async generator, so both cases can be handled the same way.
+        """
+        if is_streaming:
+            return await client.aio.models.generate_content_stream(**gen_content_args)  # type: ignore
+
+        response = await client.aio.models.generate_content(**gen_content_args)
+
+        async def single_item_stream() -> AsyncGenerator[types.GenerateContentResponse, None]:
+            yield response
+
+        return single_item_stream()
+
+    @staticmethod
+    def _hash_request(*parts: Any) -> str:
+        """
+        Builds a stable key for a request from its parts (models, lists, dicts, strings).
+        Inline bytes are hashed through their base64 form.
+        """
+        serialized = pydantic_core.to_json(
+            parts, exclude_none=True, bytes_mode="base64", fallback=str
+        )
+        return xxhash.xxh3_128_hexdigest(serialized)
+
+    async def _acquire_admission(
+        self, lane: RequestLane, timeout: float | None, event_emitter: EventEmitter
+    ) -> None:
+        """Takes an admission slot, telling the user while the request waits for one."""
+
+        queued = False
+
+        async def on_queued() -> None:
+            nonlocal queued
+            queued = True
+            await event_emitter.emit_status("Waiting for a free request slot...")
+
+        try:
+            await self.admission.acquire(lane, timeout, on_queued)
+        except asyncio.TimeoutError:
+            log.warning(f"Admission: {lane} request did not get a slot within {timeout}s.")
+            await event_emitter.emit_status("No free request slot.", done=True)
+            raise GenaiApiError(
+                "The server is handling too many requests right now. Please try again shortly."
+            ) from None
+        if queued:
+            await event_emitter.emit_status("Request slot acquired.", done=True, hidden=True)
+
+    @staticmethod
+    def _release_on_close(
+        response_stream: AsyncIterator[types.GenerateContentResponse],
+        release: Callable[[], None],
+    ) -> AsyncGenerator[types.GenerateContentResponse, None]:
+        """
+        Passes the stream through and calls `release` once it is exhausted or closed.
+
+        The `finally` block of a generator only runs once the generator has been started,
+        so if the returned generator is dropped unstarted (e.g. the client disconnected before
+        the first chunk), `release` is called and the stream is closed when it is garbage collected.
+        """
+
+        async def passthrough() -> AsyncGenerator[types.GenerateContentResponse, None]:
+            try:
+                async for chunk in response_stream:
+                    yield chunk
+            finally:
+                finalizer.detach()
+                release()
+                await BackendRouter._close_stream(response_stream)
+
+        def release_dropped() -> None:
+            release()
+            loop.create_task(BackendRouter._close_stream(response_stream))
+
+        def on_collected() -> None:
+            # Garbage collection can happen outside the event loop, so the work is handed to it.
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(release_dropped)
+
+        loop = asyncio.get_running_loop()
+        wrapper = passthrough()
+        # The callback must not reference `wrapper`, otherwise it would never be collected.
+        finalizer = weakref.finalize(wrapper, on_collected)
+        return wrapper
+
+    def _get_response_cache_key(
+        self,
+        valves: "Pipe.Valves",
+        user_id: str,
+        model_name: str,
+        contents: list[types.Content],
+        gen_content_conf: types.GenerateContentConfig,
+    ) -> str | None:
+        """Returns the response cache key for a deterministic request, or None if it must not be cached."""
+        if not valves.RESPONSE_CACHE_TTL:
+            return None
+        if gen_content_conf.temperature != 0 or gen_content_conf.tools:
+            return None
+        if "IMAGE" in (gen_content_conf.response_modalities or []):
+            return None
+        self.response_cache.max_size = valves.RESPONSE_CACHE_MAX_SIZE_MB * 1024 * 1024
+        owner = "shared" if valves.RESPONSE_CACHE_SHARED else user_id
+        return self._hash_request(owner, model_name, contents, gen_content_conf)
+
+    async def _cache_response(
+        self,
+        response_stream: AsyncIterator[types.GenerateContentResponse],
+        cache_key: str,
+        ttl: float,
+    ) -> AsyncGenerator[types.GenerateContentResponse, None]:
+        """
+        Passes the stream through and stores its chunks in the response cache once it is exhausted.
+        Aborted, failed, unfinished and grounded responses are not stored.
+        """
+        chunks: list[types.GenerateContentResponse] = []
+        try:
+            async for chunk in response_stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await BackendRouter._close_stream(response_stream)
+
+        if not self._is_cacheable_response(chunks):
+            log.debug(f"Response for cache key {cache_key} is not cacheable.")
+            return
+        size = len(pydantic_core.to_json(chunks, exclude_none=True, bytes_mode="base64"))
+        self.response_cache.set(cache_key, chunks, size=size, ttl=ttl)
+        log.debug(f"Cached response for key {cache_key} ({size:,} bytes, TTL: {ttl}s).")
+
+    @staticmethod
+    def _is_cacheable_response(chunks: list[types.GenerateContentResponse]) -> bool:
+        if not chunks or not (candidates := chunks[-1].candidates):
+            return False
+        if candidates[0].finish_reason != types.FinishReason.STOP:
+            return False
+        for chunk in chunks:
+            for candidate in chunk.candidates or []:
+                if candidate.grounding_metadata or candidate.url_context_metadata:
+                    return False
+            if any(part.inline_data for part in chunk.parts or []):
+                return False
+        return True
+
+    @staticmethod
+    async def _replay_response(
+        chunks: list[types.GenerateContentResponse],
+    ) -> AsyncGenerator[types.GenerateContentResponse, None]:
+        """Yields previously collected response chunks as a response stream."""
+        for chunk in chunks:
+            yield chunk
+
     # endregion 2.1 Client initialization
 
     # region 2.2 Model retrival from Google API
@@ -2089,10 +4036,14 @@ class Pipe:
             # 3. Combine and de-duplicate
             # Prioritize models from Gemini Developer API in case of ID collision
             combined_models_dict: dict[str, types.Model] = {}
+            # Remember which backends serve each model, so requests can be routed across them.
+            model_backends: dict[str, set[Literal["gemini", "vertex"]]] = {}
 
             for model in gemini_models_list:
                 if model.name:
                     model_id = Pipe.strip_prefix(model.name)
+                    if model_id:
+                        model_backends.setdefault(model_id, set()).add("gemini")
                     if model_id and model_id not in combined_models_dict:
                         combined_models_dict[model_id] = model
                 else:
@@ -2104,6 +4055,7 @@ class Pipe:
                 if model.name:
                     model_id = Pipe.strip_prefix(model.name)
                     if model_id:
+                        model_backends.setdefault(model_id, set()).add("vertex")
                         if model_id not in combined_models_dict:
                             combined_models_dict[model_id] = model
                         else:
@@ -2116,6 +4068,7 @@ class Pipe:
                     )
 
             all_raw_models = list(combined_models_dict.values())
+            self.model_backends = model_backends
 
             log.info(
                 f"Fetched {len(gemini_models_list)} models from Gemini API, "
@@ -2488,6 +4441,8 @@ class Pipe:
         chat_id: str,
         message_id: str,
         start_time: float,
+        max_output_tokens: int | None = None,
+        replayed: bool = False,
     ) -> AsyncGenerator[dict, None]:
         """
         Processes an async iterator of GenerateContentResponse objects, yielding
@@ -2497,9 +4452,15 @@ class Pipe:
         responses, eliminating code duplication. It processes all parts within each
         response chunk, counts tag substitutions for a final toast notification,
         and handles post-processing in a finally block.
+
+        If the response is aborted (the user stops it or disconnects), the upstream
+        stream is closed right away and post-processing is skipped.
         """
         final_response_chunk: types.GenerateContentResponse | None = None
         error_occurred = False
+        cancelled_at: float | None = None
+        stream_metrics = StreamMetrics(start_time, replayed=replayed)
+        handed_off_uris: set[str] = set()
         total_substitutions = 0
         first_chunk_received = False
         chunk_counter = 0
@@ -2508,17 +4469,21 @@ class Pipe:
             async for chunk in response_stream:
                 log.trace(f"Processing response chunk #{chunk_counter}:", payload=chunk)
                 chunk_counter += 1
+                stream_metrics.record_chunk()
                 final_response_chunk = chunk  # Keep the latest chunk for metadata
 
+                # Source URLs can be resolved by the companion filter while the rest of the answer streams.
+                self._add_grounding_uris_to_state(
+                    chunk, __request__, chat_id, message_id, handed_off_uris
+                )
+
                 if not first_chunk_received:
                     # This is the first (and possibly only) chunk.
                     elapsed_time = time.monotonic() - start_time
                     time_str = f"(+{elapsed_time:.2f}s)"
-                    asyncio.create_task(
-                        event_emitter.emit_status(
-                            f"Response received {time_str}",
-                            done=True,
-                        )
+                    await event_emitter.emit_status(
+                        f"Response received {time_str}",
+                        done=True,
                     )
                     first_chunk_received = True
 
@@ -2547,6 +4512,11 @@ class Pipe:
                         structured_chunk = {"choices": [{"delta": payload}]}
                         yield structured_chunk
 
+        except (asyncio.CancelledError, GeneratorExit):
+            # The consumer went away. Nothing can be yielded anymore, so just clean up and re-raise.
+            cancelled_at = time.monotonic()
+            raise
+
         except Exception as e:
             error_occurred = True
             error_msg = f"Response processing ended with error: {e}"
@@ -2554,38 +4524,82 @@ class Pipe:
             await event_emitter.emit_error(error_msg)
 
         finally:
-            # The async for loop has completed, meaning we have received all data
-            # from the API. Now, we perform final internal processing.
+            # Closing releases the connection and stops generation on Google's side.
+            await BackendRouter._close_stream(response_stream)
 
-            if total_substitutions > 0 and not error_occurred:
-                plural_s = "s" if total_substitutions > 1 else ""
-                toast_msg = (
-                    f"For clarity, {total_substitutions} special tag{plural_s} "
-                    "were disabled in the response by injecting a zero-width space (ZWS)."
+            if cancelled_at is not None:
+                self._log_cancellation(
+                    final_response_chunk, cancelled_at, start_time, max_output_tokens
                 )
-                event_emitter.emit_toast(toast_msg, "info")
+            else:
+                # The async for loop has completed, meaning we have received all data
+                # from the API. Now, we perform final internal processing.
+
+                if total_substitutions > 0 and not error_occurred:
+                    plural_s = "s" if total_substitutions > 1 else ""
+                    toast_msg = (
+                        f"For clarity, {total_substitutions} special tag{plural_s} "
+                        "were disabled in the response by injecting a zero-width space (ZWS)."
+                    )
+                    event_emitter.emit_toast(toast_msg, "info")
 
-            if not error_occurred:
-                yield "data: [DONE]"
-                log.info("Response processing finished successfully!")
+                if not error_occurred:
+                    yield "data: [DONE]"
+                    log.info("Response processing finished successfully!")
 
-            try:
-                await self._do_post_processing(
-                    final_response_chunk,
-                    event_emitter,
-                    __request__,
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    stream_error_happened=error_occurred,
-                    start_time=start_time,
-                )
-            except Exception as e:
-                error_msg = f"Post-processing failed with error:\n\n{e}"
-                event_emitter.emit_toast(error_msg, "error")
-                log.exception(error_msg)
+                try:
+                    await self._do_post_processing(
+                        final_response_chunk,
+                        event_emitter,
+                        __request__,
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        stream_error_happened=error_occurred,
+                        start_time=start_time,
+                        stream_metrics=stream_metrics,
+                    )
+                except Exception as e:
+                    error_msg = f"Post-processing failed with error:\n\n{e}"
+                    event_emitter.emit_toast(error_msg, "error")
+                    log.exception(error_msg)
 
+                # The final status must not be left waiting for the coalescing window.
+                await event_emitter.flush()
+
+            # URIs the companion filter did not pick up while streaming are not needed anymore.
+            __request__.app.state._state.pop(f"grounding_uris_{chat_id}_{message_id}", None)
             log.debug("Unified response processor has finished.")
 
+    @staticmethod
+    def _log_cancellation(
+        last_chunk: types.GenerateContentResponse | None,
+        cancelled_at: float,
+        start_time: float,
+        max_output_tokens: int | None,
+    ) -> None:
+        """Logs how quickly an aborted response was torn down and how much generation it avoided."""
+        close_latency_ms = (time.monotonic() - cancelled_at) * 1000
+        usage = last_chunk.usage_metadata if last_chunk else None
+        output_tokens = (
+            ((usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0))
+            if usage
+            else None
+        )
+        if output_tokens is None:
+            tokens_str = "No usage was reported before cancellation."
+        elif max_output_tokens:
+            tokens_str = (
+                f"{output_tokens} output tokens were generated; "
+                f"up to {max(0, max_output_tokens - output_tokens)} more were avoided "
+                f"(max_output_tokens is {max_output_tokens})."
+            )
+        else:
+            tokens_str = f"{output_tokens} output tokens were generated before cancellation."
+        log.info(
+            f"Response was cancelled after {cancelled_at - start_time:.2f}s. "
+            f"Upstream stream closed in {close_latency_ms:.1f}ms. {tokens_str}"
+        )
+
     async def _process_part(
         self,
         part: types.Part,
@@ -2648,17 +4662,8 @@ class Pipe:
         if not text:
             return "", 0
 
-        # The regex finds '<' followed by an optional '/' and then one of the special tags.
-        # The inner parentheses group the tags, so the optional '/' applies to all of them.
-        TAG_REGEX = re.compile(
-            r"<(/?"
-            + "("
-            + "|".join(re.escape(tag) for tag in SPECIAL_TAGS_TO_DISABLE)
-            + ")"
-            + r")"
-        )
         # The substitution injects a ZWS, e.g., '</think>' becomes '<ZWS/think'.
-        modified_text, num_substitutions = TAG_REGEX.subn(rf"<{ZWS}\1", text)
+        modified_text, num_substitutions = SPECIAL_TAG_REGEX.subn(rf"<{ZWS}\1", text)
         return modified_text, num_substitutions
 
     async def _process_image_part(
@@ -2817,6 +4822,7 @@ class Pipe:
         *,
         stream_error_happened: bool = False,
         start_time: float,
+        stream_metrics: StreamMetrics | None = None,
     ):
         """Handles emitting usage, grounding, and sources after the main response/stream is done."""
         log.info("Post-processing the model response.")
@@ -2886,6 +4892,17 @@ class Pipe:
         if usage_data := self._get_usage_data(model_response):
             # Inject the total processing time into the usage payload.
             usage_data["completion_time"] = round(elapsed_time, 2)
+            # Latency and throughput, so models and backends can be compared on real traffic.
+            if stream_metrics:
+                output_tokens = (usage_data["completion_tokens"] or 0) + usage_data.get(
+                    "thoughts_token_count", 0
+                )
+                latency_data = stream_metrics.summary(output_tokens)
+                log.info(
+                    f"Latency metrics for {model_response.model_version}:",
+                    payload=latency_data,
+                )
+                usage_data.update(latency_data)
             await event_emitter.emit_usage(usage_data)
 
         self._add_grounding_data_to_state(
@@ -2918,6 +4935,37 @@ class Pipe:
         else:
             log.debug(f"Response {message_id} does not have grounding metadata.")
 
+    def _add_grounding_uris_to_state(
+        self,
+        chunk: types.GenerateContentResponse,
+        request: Request,
+        chat_id: str,
+        message_id: str,
+        handed_off_uris: set[str],
+    ) -> None:
+        """
+        Hands the source URIs of a streamed chunk's grounding metadata to the companion filter,
+        which starts resolving them before the response has finished. Each URI is handed off once.
+        """
+        candidate = chunk.candidates[0] if chunk.candidates else None
+        grounding_metadata = candidate.grounding_metadata if candidate else None
+        if not (grounding_metadata and grounding_metadata.grounding_chunks):
+            return
+
+        new_uris: list[str] = []
+        for grounding_chunk in grounding_metadata.grounding_chunks:
+            source = grounding_chunk.web or grounding_chunk.maps
+            if source and source.uri and source.uri not in handed_off_uris:
+                handed_off_uris.add(source.uri)
+                new_uris.append(source.uri)
+        if not new_uris:
+            return
+
+        uris_key = f"grounding_uris_{chat_id}_{message_id}"
+        log.debug(f"Handing off {len(new_uris)} grounding URI(s) using key {uris_key}.")
+        # The companion filter pops the list when it picks it up, so URIs found later go into a new list.
+        request.app.state._state.setdefault(uris_key, []).extend(new_uris)
+
     @staticmethod
     def _get_usage_data(
         response: types.GenerateContentResponse,
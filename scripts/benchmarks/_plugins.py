@@ -0,0 +1,145 @@
+"""
+Helpers for loading plugin files as modules in benchmark scripts.
+
+Plugins import Open WebUI at module level, so benchmarks either have to run in an
+environment where `open_webui` (and the plugin's own requirements) are installed,
+or call `install_open_webui_stubs` before loading the plugin.
+"""
+
+import importlib.util
+import io
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+
+def load_plugin(relative_path: str, module_name: str) -> ModuleType:
+    """Imports a plugin file from the repository by its path relative to the repo root."""
+    path = REPO_ROOT / relative_path
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"Cannot load plugin from {path}")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def silence_loguru() -> None:
+    """Removes loguru's default handler so plugin logging doesn't distort timings."""
+    from loguru import logger
+
+    logger.remove()
+
+
+class StubChats:
+    """In-memory stand-in for `open_webui.models.chats.Chats`."""
+
+    def __init__(self):
+        self.chats: dict[str, SimpleNamespace] = {}
+
+    def add_chat(self, chat_id: str, messages: list[dict[str, Any]]) -> None:
+        """Stores a chat. `messages` must end with the (empty) assistant message being generated."""
+        self.chats[chat_id] = SimpleNamespace(id=chat_id, chat={"messages": messages})
+
+    def get_chat_by_id_and_user_id(self, id: str, user_id: str) -> SimpleNamespace | None:
+        return self.chats.get(id)
+
+
+class StubFiles:
+    """In-memory stand-in for `open_webui.models.files.Files`. File contents live on disk."""
+
+    def __init__(self, storage_dir: Path):
+        self.storage_dir = storage_dir
+        self.files: dict[str, SimpleNamespace] = {}
+
+    def add_file(self, content: bytes, content_type: str, file_id: str | None = None) -> str:
+        """Writes `content` to the stub storage and registers it. Returns the file ID."""
+        file_id = file_id or str(uuid.uuid4())
+        path = self.storage_dir / file_id
+        path.write_bytes(content)
+        self.files[file_id] = SimpleNamespace(
+            id=file_id, path=str(path), meta={"content_type": content_type}
+        )
+        return file_id
+
+    def get_file_by_id(self, id: str) -> SimpleNamespace | None:
+        return self.files.get(id)
+
+    def insert_new_file(self, user_id: str, form_data: SimpleNamespace) -> SimpleNamespace:
+        file = SimpleNamespace(user_id=user_id, **vars(form_data))
+        self.files[file.id] = file
+        return file
+
+
+class StubStorage:
+    """Stand-in for `open_webui.storage.provider.Storage` that writes to a local directory."""
+
+    def __init__(self, storage_dir: Path):
+        self.storage_dir = storage_dir
+
+    def upload_file(
+        self, file: io.BytesIO, filename: str, tags: dict[str, str]
+    ) -> tuple[bytes, str]:
+        contents = file.read()
+        path = self.storage_dir / filename
+        path.write_bytes(contents)
+        return contents, str(path)
+
+
+class StubFunctions:
+    """Stand-in for `open_webui.models.functions.Functions` with no other functions installed."""
+
+    def get_function_by_id(self, id: str) -> None:
+        return None
+
+    def get_function_valves_by_id(self, id: str) -> None:
+        return None
+
+    def get_user_valves_by_id_and_user_id(self, id: str, user_id: str) -> dict:
+        return {}
+
+
+def _pop_system_message(
+    messages: list[dict[str, Any]],
+) -> tuple[dict[str, Any] | None, list[dict[str, Any]]]:
+    system_message = next((m for m in messages if m["role"] == "system"), None)
+    return system_message, [m for m in messages if m["role"] != "system"]
+
+
+def install_open_webui_stubs() -> SimpleNamespace:
+    """
+    Registers in-memory replacements for the `open_webui` modules the Gemini plugins import,
+    so they can be loaded without an Open WebUI installation or database.
+
+    Returns a namespace with the `chats`, `files` and `storage` stubs, which benchmarks use
+    to seed chats and attachments.
+    """
+    storage_dir = Path(tempfile.mkdtemp(prefix="owui-stub-storage-"))
+    stubs = SimpleNamespace(
+        chats=StubChats(),
+        files=StubFiles(storage_dir),
+        storage=StubStorage(storage_dir),
+        functions=StubFunctions(),
+    )
+    modules = {
+        "open_webui": {},
+        "open_webui.models": {},
+        "open_webui.models.chats": {"Chats": stubs.chats},
+        "open_webui.models.files": {"Files": stubs.files, "FileForm": SimpleNamespace},
+        "open_webui.models.functions": {"Functions": stubs.functions},
+        "open_webui.storage": {},
+        "open_webui.storage.provider": {"Storage": stubs.storage},
+        "open_webui.utils": {},
+        "open_webui.utils.misc": {"pop_system_message": _pop_system_message},
+    }
+    for name, attributes in modules.items():
+        module = ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+    return stubs
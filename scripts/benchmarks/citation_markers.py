@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Benchmark for citation marker handling in Gemini Manifold.
+
+Compares the pipe's `GeminiContentBuilder._remove_citation_markers` and the companion
+filter's `Filter._get_text_w_citation_markers` against their previous quadratic
+implementations on synthetic grounded answers and checks that they produce the expected output.
+Answers contain nested supports and supports that end at the same offset. 500 supports make an answer of roughly 50 KB.
+
+Usage:
+    python scripts/benchmarks/citation_markers.py
+    python scripts/benchmarks/citation_markers.py --supports 50 200 500 --repeat 5
+"""
+
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _plugins import install_open_webui_stubs, load_plugin, silence_loguru  # noqa: E402
+
+from google.genai import types  # noqa: E402
+
+PIPE_PATH = "plugins/pipes/gemini_mainfold/gemini_manifold.py"
+COMPANION_PATH = "plugins/filters/gemini_manifold_companion/gemini_manifold_companion.py"
+WORDS = "the model cites several sources for each claim made in this grounded answer".split()
+
+
+def legacy_remove_citation_markers(text: str, sources: list[dict]) -> str:
+    """The implementation before the linear rewrite, kept for comparison."""
+    processed: set[str] = set()
+    for source in sources:
+        supports = [
+            metadata["supports"]
+            for metadata in source.get("metadata", [])
+            if "supports" in metadata
+        ]
+        supports = [item for sublist in supports for item in sublist]
+        for support in supports:
+            support = types.GroundingSupport(**support)
+            indices = support.grounding_chunk_indices
+            segment = support.segment
+            if not (indices and segment):
+                continue
+            segment_text = segment.text
+            if not segment_text:
+                continue
+            segment_end = segment_text[-32:]
+            if segment_end in processed:
+                continue
+            processed.add(segment_end)
+            citation_markers = "".join(f"[{index + 1}]" for index in indices)
+            pos = text.find(segment_text + citation_markers)
+            if pos != -1:
+                text = (
+                    text[: pos + len(segment_text)]
+                    + text[pos + len(segment_text) + len(citation_markers) :]
+                )
+    return text
+
+
+def legacy_insert_citation_markers(
+    text: str, grounding_metadata: types.GroundingMetadata
+) -> str:
+    """The companion's implementation before the single-pass rewrite, kept for comparison."""
+    modified_content_bytes = bytearray(text.encode("utf-8"))
+    for support in reversed(grounding_metadata.grounding_supports or []):
+        segment = support.segment
+        indices = support.grounding_chunk_indices
+        if not (indices is not None and segment and segment.end_index is not None):
+            continue
+        end_pos = segment.end_index
+        if not (0 <= end_pos <= len(modified_content_bytes)):
+            continue
+        citation_markers = "".join(f"[{index + 1}]" for index in indices)
+        modified_content_bytes[end_pos:end_pos] = citation_markers.encode("utf-8")
+    return modified_content_bytes.decode("utf-8")
+
+
+def make_grounded_answer(
+    num_supports: int, num_chunks: int, seed: int = 0
+) -> tuple[str, str, list[dict], types.GroundingMetadata]:
+    """
+    Builds a grounded answer with `num_supports` cited sentences, grouped into paragraphs.
+    Some paragraphs also get a support of their own, which contains the markers of its
+    sentences and ends at the same offset as its last sentence, sometimes citing the same chunks.
+    Returns the plain text, the text with citation markers, the stored sources
+    and the grounding metadata the pipe hands to the companion.
+    """
+    rng = random.Random(seed)
+    plain_parts: list[str] = []
+    # (end, tie breaker, start, text, indices) of every support.
+    segments: list[tuple[int, float, int, str, list[int]]] = []
+    byte_offset = 0
+    claim = 0
+    while claim < num_supports:
+        paragraph_start = byte_offset
+        paragraph_parts: list[str] = []
+        for _ in range(min(rng.randint(1, 3), num_supports - claim)):
+            # The claim number goes last, because segments are deduplicated by their tail.
+            sentence = (
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+                + f" (claim {claim}). "
+            )
+            indices = sorted(rng.sample(range(num_chunks), rng.randint(1, 3)))
+            end = byte_offset + len(sentence.encode("utf-8"))
+            segments.append((end, rng.random(), byte_offset, sentence, indices))
+            paragraph_parts.append(sentence)
+            byte_offset = end
+            claim += 1
+        if len(paragraph_parts) > 1 and rng.random() < 0.3:
+            # Some paragraphs cite the same chunks as their last sentence, so the two
+            # supports share the segment tail and the markers, and only differ in offsets.
+            if rng.random() < 0.3:
+                indices = segments[-1][4]
+            else:
+                indices = sorted(rng.sample(range(num_chunks), rng.randint(1, 3)))
+            segments.append(
+                (byte_offset, rng.random(), paragraph_start, "".join(paragraph_parts), indices)
+            )
+        plain_parts.extend(paragraph_parts)
+    plain = "".join(plain_parts)
+
+    # Like the API, list the supports by segment end. Supports that end at the same
+    # offset come in random order, which decides the order of their markers.
+    segments.sort()
+    supports_by_chunk: dict[int, list[dict]] = {i: [] for i in range(num_chunks)}
+    all_supports: list[dict] = []
+    marked_parts: list[str] = []
+    cursor = 0
+    for end, _, start, segment_text, indices in segments:
+        support = types.GroundingSupport(
+            segment=types.Segment(start_index=start, end_index=end, text=segment_text),
+            grounding_chunk_indices=indices,
+        ).model_dump()
+        all_supports.append(support)
+        for index in indices:
+            supports_by_chunk[index].append(support)
+        # The text is ASCII, so byte offsets are character offsets.
+        marked_parts.append(plain[cursor:end])
+        marked_parts.append("".join(f"[{index + 1}]" for index in indices))
+        cursor = end
+    marked_parts.append(plain[cursor:])
+    sources = [
+        {"source": {"name": f"source-{i}"}, "metadata": [{"supports": supports}]}
+        for i, supports in supports_by_chunk.items()
+    ]
+    grounding_metadata = types.GroundingMetadata(
+        grounding_supports=all_supports,
+        grounding_chunks=[
+            types.GroundingChunk(
+                web=types.GroundingChunkWeb(uri=f"https://example.com/{i}", title=f"source-{i}")
+            )
+            for i in range(num_chunks)
+        ],
+    )
+    return plain, "".join(marked_parts), sources, grounding_metadata
+
+
+def bench(label: str, func, repeat: int) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f"  {label:<28} {best * 1000:10.2f} ms")
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--supports", type=int, nargs="+", default=[50, 200, 500, 1000])
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    silence_loguru()
+    install_open_webui_stubs()
+    pipe_module = load_plugin(PIPE_PATH, "gemini_manifold")
+    remove_citation_markers = pipe_module.GeminiContentBuilder._remove_citation_markers
+    companion_module = load_plugin(COMPANION_PATH, "gemini_manifold_companion")
+    insert_citation_markers = companion_module.Filter()._get_text_w_citation_markers
+    silence_loguru()
+
+    for num_supports in args.supports:
+        plain, marked, sources, grounding_metadata = make_grounded_answer(
+            num_supports, args.chunks
+        )
+        print(f"\n{num_supports} supports, {len(marked.encode('utf-8')):,} bytes:")
+
+        legacy_result = legacy_insert_citation_markers(plain, grounding_metadata)
+        result = insert_citation_markers(grounding_metadata, plain)
+        if result != legacy_result or result != marked:
+            print("  ERROR: insert implementations disagree")
+            return 1
+
+        legacy_time = bench(
+            "insert (legacy)",
+            lambda: legacy_insert_citation_markers(plain, grounding_metadata),
+            args.repeat,
+        )
+        new_time = bench(
+            "insert (single pass)",
+            lambda: insert_citation_markers(grounding_metadata, plain),
+            args.repeat,
+        )
+        print(f"  {'speedup':<28} {legacy_time / new_time:10.1f}x")
+
+        # The legacy remover leaves markers behind when supports end at the same offset,
+        # so the result is checked against the plain text only.
+        if remove_citation_markers(marked, sources) != plain:
+            print("  ERROR: citation markers are not fully removed")
+            return 1
+
+        legacy_time = bench(
+            "remove (legacy)",
+            lambda: legacy_remove_citation_markers(marked, sources),
+            args.repeat,
+        )
+        new_time = bench(
+            "remove (single pass)",
+            lambda: remove_citation_markers(marked, sources),
+            args.repeat,
+        )
+        print(f"  {'speedup':<28} {legacy_time / new_time:10.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the Gemini Manifold pipe.
+
+Runs `Pipe.pipe` for many concurrent synthetic chats against a scripted fake
+`genai.Client`, so hot-path changes can be measured without Gemini quota.
+Open WebUI is replaced by the in-memory stubs from `_plugins`, and the fake
+client is plugged in through `Pipe._get_or_create_genai_client`.
+
+The fake backend streams a configurable number of chunks with a configurable
+time to first byte and inter-chunk delay. It can attach grounding metadata
+and an inline image to the response, and simulates Files API upload and
+processing delays for attached documents.
+
+Reported per run: time to first token, total latency, CPU time per request,
+peak RSS, events sent to the front-end and calls made to the fake backend.
+
+Usage:
+    python scripts/benchmarks/gemini_manifold_load_test.py
+    python scripts/benchmarks/gemini_manifold_load_test.py --chats 200 --concurrency 50 --grounding
+    python scripts/benchmarks/gemini_manifold_load_test.py --files 3 --shared-files --upload-ms 400
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _plugins import install_open_webui_stubs, load_plugin, silence_loguru  # noqa: E402
+
+from fastapi.datastructures import State  # noqa: E402
+from google.genai import errors as genai_errors  # noqa: E402
+from google.genai import types  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PIPE_PATH = "plugins/pipes/gemini_mainfold/gemini_manifold.py"
+PIPE_ID = "gemini_manifold_google_genai"
+WORDS = "the model streams a synthetic answer with enough variety to look like real text".split()
+
+
+class FakeModels:
+    """Scripted stand-in for `client.aio.models`."""
+
+    def __init__(self, args: argparse.Namespace, calls: Counter):
+        self.args = args
+        self.calls = calls
+        self.image = os.urandom(args.image_kb * 1024) if args.image else b""
+
+    async def generate_content_stream(
+        self, *, model: str, contents: list[types.Content], config: Any = None
+    ):
+        self.calls["generate_content_stream"] += 1
+        return self._stream(model, contents)
+
+    async def generate_content(
+        self, *, model: str, contents: list[types.Content], config: Any = None
+    ) -> types.GenerateContentResponse:
+        self.calls["generate_content"] += 1
+        chunks = [chunk async for chunk in self._stream(model, contents)]
+        parts = [part for chunk in chunks for part in chunk.parts or []]
+        final = chunks[-1]
+        final.candidates[0].content.parts = parts  # type: ignore
+        return final
+
+    async def _stream(self, model: str, contents: list[types.Content]):
+        args = self.args
+        await asyncio.sleep(args.ttfb_ms / 1000)
+        prompt_tokens = sum(len(str(content.parts)) for content in contents) // 4
+        text = ""
+        for i in range(args.chunks):
+            if i:
+                await asyncio.sleep(args.chunk_interval_ms / 1000)
+            chunk_text = " ".join(random.choices(WORDS, k=max(1, args.chunk_chars // 6)))
+            chunk_text = chunk_text[: args.chunk_chars] + " "
+            parts = [types.Part(text=chunk_text)]
+            is_last = i == args.chunks - 1
+            if is_last and self.image:
+                parts.append(
+                    types.Part(inline_data=types.Blob(mime_type="image/png", data=self.image))
+                )
+            candidate = types.Candidate(
+                content=types.Content(role="model", parts=parts),
+                finish_reason=types.FinishReason.STOP if is_last else None,
+                grounding_metadata=(
+                    self._grounding_metadata(text, chunk_text)
+                    if is_last and args.grounding
+                    else None
+                ),
+            )
+            text += chunk_text
+            yield types.GenerateContentResponse(
+                candidates=[candidate],
+                model_version=model,
+                usage_metadata=types.GenerateContentResponseUsageMetadata(
+                    prompt_token_count=prompt_tokens,
+                    candidates_token_count=len(text) // 4,
+                    total_token_count=prompt_tokens + len(text) // 4,
+                ),
+            )
+
+    def _grounding_metadata(self, text: str, last_chunk: str) -> types.GroundingMetadata:
+        text += last_chunk
+        sources = self.args.grounding_sources
+        chunks = [
+            types.GroundingChunk(
+                web=types.GroundingChunkWeb(
+                    uri=f"https://vertexaisearch.cloud.google.com/grounding-api-redirect/{i}",
+                    title=f"source-{i}.example.com",
+                )
+            )
+            for i in range(sources)
+        ]
+        supports = []
+        segment_length = max(1, len(text) // sources)
+        for i in range(sources):
+            start = i * segment_length
+            end = min(len(text), start + segment_length)
+            supports.append(
+                types.GroundingSupport(
+                    segment=types.Segment(start_index=start, end_index=end, text=text[start:end]),
+                    grounding_chunk_indices=[i],
+                )
+            )
+        return types.GroundingMetadata(
+            grounding_chunks=chunks,
+            grounding_supports=supports,
+            web_search_queries=["synthetic query"],
+        )
+
+
+class FakeFiles:
+    """Scripted stand-in for `client.aio.files` with upload and processing delays."""
+
+    def __init__(self, args: argparse.Namespace, calls: Counter):
+        self.args = args
+        self.calls = calls
+        # name -> (file, monotonic time when processing finishes)
+        self.files: dict[str, tuple[types.File, float]] = {}
+
+    async def get(self, *, name: str) -> types.File:
+        self.calls["files.get"] += 1
+        await asyncio.sleep(self.args.api_latency_ms / 1000)
+        if name not in self.files:
+            # The Files API answers 403 for names that do not exist.
+            raise genai_errors.ClientError(
+                403,
+                {"error": {"code": 403, "message": "Not found.", "status": "PERMISSION_DENIED"}},
+            )
+        file, ready_at = self.files[name]
+        state = types.FileState.ACTIVE if time.monotonic() >= ready_at else types.FileState.PROCESSING
+        return file.model_copy(update={"state": state})
+
+    async def upload(self, *, file: Any, config: types.UploadFileConfig) -> types.File:
+        self.calls["files.upload"] += 1
+        await asyncio.sleep(self.args.upload_ms / 1000)
+        name = config.name or f"files/{len(self.files)}"
+        uploaded = types.File(
+            name=name,
+            uri=f"https://generativelanguage.googleapis.com/v1beta/{name}",
+            mime_type=config.mime_type,
+            state=types.FileState.PROCESSING,
+            expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+        )
+        self.files[name] = (uploaded, time.monotonic() + self.args.processing_ms / 1000)
+        return uploaded
+
+
+def make_fake_client(args: argparse.Namespace, calls: Counter) -> SimpleNamespace:
+    return SimpleNamespace(
+        vertexai=False,
+        aio=SimpleNamespace(models=FakeModels(args, calls), files=FakeFiles(args, calls)),
+    )
+
+
+def make_chat(args: argparse.Namespace, stubs: SimpleNamespace, index: int, file_ids: list[str]):
+    """Seeds a chat with history and attachments. Returns the pipe arguments for its next message."""
+    chat_id = f"chat-{index}"
+    messages: list[dict[str, Any]] = []
+    for turn in range(args.turns):
+        messages.append({"role": "user", "content": f"Question {turn} in chat {index}?"})
+        messages.append({"role": "assistant", "content": " ".join(WORDS) * 4})
+    messages.append({"role": "user", "content": f"Final question in chat {index}?"})
+
+    db_messages = [dict(message) for message in messages]
+    db_messages[-1]["files"] = [{"type": "file", "id": file_id} for file_id in file_ids]
+    # The assistant message being generated is the last one in the database.
+    stubs.chats.add_chat(chat_id, db_messages + [{"role": "assistant", "content": ""}])
+
+    model_id = f"{PIPE_ID}.{args.model}"
+    return {
+        "body": {"model": model_id, "messages": messages, "stream": not args.no_stream},
+        "__user__": {
+            "id": f"user-{index % args.users}",
+            "email": f"user-{index % args.users}@example.com",
+            "name": "Load Test",
+            "role": "user",
+            "valves": None,
+        },
+        "__metadata__": {
+            "chat_id": chat_id,
+            "message_id": f"message-{index}",
+            # Set by the companion filter when it hands attachments to the pipe instead of RAG.
+            "features": {"stream": not args.no_stream, "upload_documents": bool(file_ids)},
+            "model": {"id": model_id, "info": {}},
+        },
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def run_chat(pipe: Any, chat_args: dict, request: Any, events: Counter, results: list):
+    async def event_emitter(event: dict) -> None:
+        events[event["type"]] += 1
+
+    start = time.monotonic()
+    ttft = None
+    response = await pipe.pipe(
+        **chat_args, __request__=request, __event_emitter__=event_emitter
+    )
+    if isinstance(response, str):
+        ttft = time.monotonic() - start
+    else:
+        async for chunk in response:
+            if ttft is None and isinstance(chunk, dict):
+                ttft = time.monotonic() - start
+    results.append({"ttft": ttft, "latency": time.monotonic() - start})
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    stubs = install_open_webui_stubs()
+    silence_loguru()
+    module = load_plugin(PIPE_PATH, "gemini_manifold_load_test_target")
+
+    calls: Counter = Counter()
+    fake_client = make_fake_client(args, calls)
+    module.Pipe._get_or_create_genai_client = staticmethod(lambda *a, **kw: fake_client)
+
+    pipe = module.Pipe()
+    pipe.valves = pipe.Valves(GEMINI_API_KEY="fake-key", LOG_LEVEL=args.log_level)
+    request = SimpleNamespace(
+        app=SimpleNamespace(
+            state=State(),
+            url_path_for=lambda name, **params: f"/api/v1/files/{params['id']}/content",
+        )
+    )
+
+    shared_file_ids = [
+        stubs.files.add_file(os.urandom(args.file_kb * 1024), "application/pdf")
+        for _ in range(args.files if args.shared_files else 0)
+    ]
+    chats = []
+    for index in range(args.chats):
+        file_ids = shared_file_ids or [
+            stubs.files.add_file(os.urandom(args.file_kb * 1024), "application/pdf")
+            for _ in range(args.files)
+        ]
+        chats.append(make_chat(args, stubs, index, file_ids))
+
+    events: Counter = Counter()
+    results: list[dict[str, float | None]] = []
+    semaphore = asyncio.Semaphore(args.concurrency or args.chats)
+
+    async def limited(chat_args: dict) -> None:
+        async with semaphore:
+            await run_chat(pipe, chat_args, request, events, results)
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    await asyncio.gather(*(limited(chat_args) for chat_args in chats))
+    wall_time = time.monotonic() - wall_start
+    cpu_time = time.process_time() - cpu_start
+
+    ttfts = [r["ttft"] * 1000 for r in results if r["ttft"] is not None]
+    latencies = [r["latency"] * 1000 for r in results if r["latency"] is not None]
+    return {
+        "chats": args.chats,
+        "concurrency": args.concurrency or args.chats,
+        "wall_time_s": round(wall_time, 3),
+        "requests_per_s": round(args.chats / wall_time, 1),
+        "ttft_ms": {q: round(percentile(ttfts, q), 1) for q in (50, 90, 99, 100)},
+        "latency_ms": {q: round(percentile(latencies, q), 1) for q in (50, 90, 99, 100)},
+        "cpu_ms_per_request": round(cpu_time * 1000 / args.chats, 2),
+        "peak_rss_mb": round(rss, 1) if (rss := peak_rss_mb()) else None,
+        "events_per_request": {
+            event_type: round(count / args.chats, 2) for event_type, count in events.items()
+        },
+        "backend_calls": dict(calls),
+    }
+
+
+def print_report(report: dict[str, Any]) -> None:
+    print(
+        f"{report['chats']} chats, concurrency {report['concurrency']}: "
+        f"{report['wall_time_s']}s wall, {report['requests_per_s']} req/s"
+    )
+    for name in ("ttft_ms", "latency_ms"):
+        values = report[name]
+        print(
+            f"  {name:<12} p50 {values[50]:>9.1f}  p90 {values[90]:>9.1f}  "
+            f"p99 {values[99]:>9.1f}  max {values[100]:>9.1f}"
+        )
+    print(f"  CPU per request: {report['cpu_ms_per_request']} ms")
+    if report["peak_rss_mb"] is not None:
+        print(f"  Peak RSS: {report['peak_rss_mb']} MB")
+    print(f"  Events per request: {report['events_per_request']}")
+    print(f"  Backend calls: {report['backend_calls']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chats", type=int, default=100, help="Number of synthetic chats.")
+    parser.add_argument("--concurrency", type=int, default=0, help="Maximum chats in flight (0: all).")
+    parser.add_argument("--users", type=int, default=10, help="Number of distinct users.")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--turns", type=int, default=3, help="Previous turns in each chat.")
+    parser.add_argument("--no-stream", action="store_true", help="Send non-streaming requests.")
+    parser.add_argument("--ttfb-ms", type=float, default=300, help="Delay before the first chunk.")
+    parser.add_argument("--chunks", type=int, default=40, help="Chunks per response.")
+    parser.add_argument("--chunk-chars", type=int, default=80, help="Characters per chunk.")
+    parser.add_argument("--chunk-interval-ms", type=float, default=20, help="Delay between chunks.")
+    parser.add_argument("--grounding", action="store_true", help="Attach grounding metadata.")
+    parser.add_argument("--grounding-sources", type=int, default=5)
+    parser.add_argument("--image", action="store_true", help="Attach an inline image to the response.")
+    parser.add_argument("--image-kb", type=int, default=256)
+    parser.add_argument("--files", type=int, default=0, help="Documents attached to each chat.")
+    parser.add_argument("--file-kb", type=int, default=512)
+    parser.add_argument("--shared-files", action="store_true", help="Attach the same documents to every chat.")
+    parser.add_argument("--upload-ms", type=float, default=500, help="Files API upload delay.")
+    parser.add_argument("--processing-ms", type=float, default=0, help="Time until an upload is ACTIVE.")
+    parser.add_argument("--api-latency-ms", type=float, default=30, help="Files API get delay.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--log-level", default="CRITICAL", help="LOG_LEVEL valve of the pipe.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the size of the grounding sources the companion filter emits.
+
+Builds the sources of synthetic grounded answers in the default and the compact
+(`COMPACT_SOURCES`) form, and compares their serialized size and serialization time.
+Also checks that the Manifold pipe still strips the citation markers using compact sources.
+
+Usage:
+    python scripts/benchmarks/sources_payload.py
+    python scripts/benchmarks/sources_payload.py --supports 50 200 500 --chunks 20 --repeat 5
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from _plugins import install_open_webui_stubs, load_plugin, silence_loguru  # noqa: E402
+from citation_markers import COMPANION_PATH, PIPE_PATH, bench, make_grounded_answer  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--supports", type=int, nargs="+", default=[50, 200, 500, 1000])
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    silence_loguru()
+    install_open_webui_stubs()
+    pipe_module = load_plugin(PIPE_PATH, "gemini_manifold")
+    remove_citation_markers = pipe_module.GeminiContentBuilder._remove_citation_markers
+    companion_module = load_plugin(COMPANION_PATH, "gemini_manifold_companion")
+    companion = companion_module.Filter()
+    silence_loguru()
+    # Measure the compact encoding itself, without the size cap kicking in.
+    companion.valves.COMPACT_SOURCES_MAX_SIZE_KB = 0
+
+    for num_supports in args.supports:
+        plain, marked, _, grounding_metadata = make_grounded_answer(
+            num_supports, args.chunks
+        )
+        build_args = (
+            grounding_metadata.grounding_chunks,
+            grounding_metadata.grounding_supports,
+            companion._get_source_uris(grounding_metadata.grounding_chunks),
+            {},
+        )
+        default_sources = companion._build_sources(*build_args)
+        compact_sources = companion._build_compact_sources(*build_args)
+        print(f"\n{num_supports} supports, {len(marked.encode('utf-8')):,} bytes:")
+
+        if remove_citation_markers(marked, compact_sources) != plain:
+            print("  ERROR: citation markers are not removed with compact sources")
+            return 1
+
+        default_size = len(json.dumps(default_sources).encode("utf-8"))
+        compact_size = len(json.dumps(compact_sources).encode("utf-8"))
+        print(f"  {'size (default)':<28} {default_size / 1024:10.1f} KB")
+        print(f"  {'size (compact)':<28} {compact_size / 1024:10.1f} KB")
+        print(f"  {'reduction':<28} {default_size / compact_size:10.1f}x")
+
+        default_time = bench(
+            "serialize (default)", lambda: json.dumps(default_sources), args.repeat
+        )
+        compact_time = bench(
+            "serialize (compact)", lambda: json.dumps(compact_sources), args.repeat
+        )
+        print(f"  {'speedup':<28} {default_time / compact_time:10.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())